@@ -0,0 +1,55 @@
+"""
+Benchmark JsonIn parsing with different numbers of worker processes.
+
+Writes a temporary JSONL file of N records with IODA-like keys, reads it with
+sources.JsonIn for each workers setting, and reports thousands of records per
+second.  Parsed records are pickled back from the worker processes, so the
+pool only pays off when there are spare CPU cores for it; compare the rows
+on the machine that will run the pipeline before setting workers.
+
+Usage: python test/bench_jsonin.py [N [WORKERS ...]]
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(".")
+from watchtower.sentry.sources.JsonIn import JsonIn
+
+
+def make_file(path, n):
+    with open(path, 'w') as f:
+        for i in range(n):
+            f.write(json.dumps([
+                "active.ping-slash24.geo.netacuity.NA.US.%d.up_slash24_cnt"
+                    % (i % 5000),
+                i % 1000, 1600000000 + i // 5000 * 300]) + '\n')
+
+
+def bench(path, workers):
+    source = JsonIn({"module": "sources.JsonIn", "file": path,
+        "workers": workers}, None, {})
+    start = time.time()
+    n = sum(1 for entry in source.run())
+    return n, time.time() - start
+
+
+def main(n, workers_list):
+    print("cpus: %d" % os.cpu_count())
+    print("%8s %14s" % ("workers", "krecords/s"))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "bench.jsonl")
+        make_file(path, n)
+        for workers in workers_list:
+            count, sec = min((bench(path, workers) for i in range(3)),
+                key=lambda result: result[1])
+            assert count == n
+            print("%8d %14.1f" % (workers, count / sec / 1000))
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(args[0] if args else 1000000, args[1:] or [0, 1, 2, 4])
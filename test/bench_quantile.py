@@ -0,0 +1,57 @@
+"""
+Benchmark MovingStat quantile backends: sorted list vs. indexable skiplist.
+
+Simulates a full sliding window of N points (one insert, one remove, and one
+rank lookup per step) and reports microseconds per update for each backend.
+
+Usage: python test/bench_quantile.py [N ...]
+"""
+
+import sys
+import random
+import timeit
+
+sys.path.append(".")
+from watchtower.sentry.filters.MovingStat import _sortedlist_add_remove
+from watchtower.sentry.filters._Skiplist import Skiplist
+
+STEPS = 20000
+
+
+def make_data(n):
+    rand = random.Random(0)
+    return [int(rand.gauss(10000, 1000)) for i in range(n + STEPS)]
+
+
+def bench_list(data, n):
+    window = sorted(data[:n])
+    rank = n // 2
+    for i in range(n, n + STEPS):
+        _sortedlist_add_remove(window, data[i], data[i - n])
+        window[rank]
+
+
+def bench_skiplist(data, n):
+    window = Skiplist(sorted(data[:n]))
+    rank = n // 2
+    for i in range(n, n + STEPS):
+        if data[i] != data[i - n]:
+            window.remove(data[i - n])
+            window.insert(data[i])
+        window[rank]
+
+
+def main(sizes):
+    print("%10s %12s %12s" % ("window", "list us/op", "skiplist us/op"))
+    for n in sizes:
+        data = make_data(n)
+        results = []
+        for func in (bench_list, bench_skiplist):
+            sec = min(timeit.repeat(lambda: func(data, n), number=1, repeat=3))
+            results.append(sec / STEPS * 1e6)
+        print("%10d %12.2f %12.2f" % (n, *results))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or
+        [1008, 10080, 43200, 100800])
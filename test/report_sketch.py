@@ -0,0 +1,89 @@
+"""
+Report accuracy and memory of MovingStat's approximate quantile types
+compared to the exact types, on synthetic data.
+
+For each configuration, reports the relative error of the approximate
+predictions (compared to the exact predictions for the same key and time),
+and the memory used per key by the per-key state after the run.
+
+Exact memory grows with the number of values in the history, while
+approximate memory does not, so the difference is larger with a shorter
+interval between values.
+
+Usage: python test/report_sketch.py [nkeys [days [interval]]]
+"""
+
+import sys
+import tracemalloc
+
+sys.path.append(".")
+from watchtower.sentry.sources.Synthetic import Synthetic
+from watchtower.sentry.filters.MovingStat import MovingStat
+
+HISTORY = 7 * 86400
+
+
+def synthetic(nkeys, days, interval):
+    return list(Synthetic({
+        "module": "sources.Synthetic",
+        "hierarchy": [nkeys],
+        "steps": days * 86400 // interval,
+        "interval": interval,
+        "outagerate": 0.001,
+        "shiftrate": 0.0005,
+    }, None, {}).run())
+
+
+def run(data, stattype, **options):
+    """Return predictions and bytes of per-key state per key."""
+    config = {
+        "module": "filters.MovingStat",
+        "type": stattype,
+        "history": HISTORY,
+        "warmup": 86400,
+        "normalize": False,
+    }
+    config.update(options)
+    ms = MovingStat(config, lambda: iter(data), {})
+    predictions = {(key, t): value for key, value, t in ms.run()}
+    # Run again to measure memory, without keeping the output
+    tracemalloc.start()
+    ms = MovingStat(config, lambda: iter(data), {})
+    for entry in ms.run():
+        pass
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return predictions, memory / len(ms.data)
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1,
+        int(p * len(sorted_values)))]
+
+
+def main(nkeys, days, interval):
+    data = synthetic(nkeys, days, interval)
+    print("%d keys, %d days at %ds interval, %d points; history %d days" %
+        (nkeys, days, interval, len(data), HISTORY // 86400))
+    print("%-19s %8s %10s %9s %9s %9s %11s" % ("type", "accuracy",
+        "subwindows", "p50 err", "p99 err", "max err", "bytes/key"))
+    for exact_type, approx_type in ((['median'], ['approxmedian']),
+            (['quantile', 1, 10], ['approxquantile', 1, 10])):
+        exact, memory = run(data, exact_type)
+        print("%-19s %8s %10s %9s %9s %9s %11.0f" %
+            (','.join(map(str, exact_type)), '-', '-', '-', '-', '-', memory))
+        for accuracy, subwindows in ((0.01, 16), (0.01, 4), (0.001, 16),
+                (0.05, 16)):
+            approx, memory = run(data, approx_type, approximation={
+                "accuracy": accuracy, "subwindows": subwindows})
+            errors = sorted(abs(approx[kt] - v) / v
+                for kt, v in exact.items() if v)
+            print("%-19s %8g %10d %8.3f%% %8.3f%% %8.3f%% %11.0f" %
+                (','.join(map(str, approx_type)), accuracy, subwindows,
+                100 * percentile(errors, 0.5), 100 * percentile(errors, 0.99),
+                100 * errors[-1], memory))
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [50, 10, 600][len(args):]))
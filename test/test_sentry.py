@@ -1,8 +1,22 @@
 import sys
+import bz2
+import contextlib
+import gc
+import gzip
+import io
 import json
 import logging
+import lzma
 import math
+import os
 import random
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.request
+import warnings
 
 loghandler = logging.StreamHandler()
 loghandler.setFormatter(logging.Formatter(
@@ -18,6 +32,17 @@ rootlogger.setLevel(logging.DEBUG)
 sys.path.append("watchtower/sentry")
 sys.path.append(".")
 from watchtower.sentry.sentry import Sentry
+from watchtower.sentry import SentryModule
+from watchtower.sentry import StateServer
+from watchtower.sentry.filters.AggSum import AggSum
+from watchtower.sentry.filters.Dedup import Dedup
+from watchtower.sentry.filters.Join import Join
+from watchtower.sentry.filters.MovingStat import MovingStat
+from watchtower.sentry.filters.Resample import Resample
+from watchtower.sentry.filters.TimeOrder import TimeOrder
+from watchtower.sentry.sinks.JsonOut import JsonOut
+from watchtower.sentry.sources.SocketIn import SocketIn, BINARY_LEN, BINARY_VT
+from watchtower.sentry.sinks.SQLite import SQLite
 
 def interleave(lists):
     result = []
@@ -178,6 +203,22 @@ for (k, v, t) in indata:
 assert len(filtered_in) == len(outdata)
 assert sorted(filtered_in) == sorted(outdata)
 
+# buffered data for a key that goes silent is released after timeout, when
+# any later input arrives (e.g. a heartbeat), not just at end of stream
+def timeorder_input():
+    yield ("a", 1, 0)
+    yield ("a", 3, 2 * timestep) # a@1 is missing
+    yield ("b", 1, 0)
+    time.sleep(0.2)
+    yield (None, SentryModule.HEARTBEAT, time.time())
+    yield ("b", 2, timestep)
+timeorder = TimeOrder({"module": "filters.TimeOrder", "interval": timestep,
+    "timeout": 0.1}, timeorder_input, {})
+result = list(timeorder.run())
+assert result[:3] == [("a", 1, 0), ("b", 1, 0), ("a", 3, 2 * timestep)]
+assert result[3][:2] == (None, SentryModule.HEARTBEAT)
+assert result[4:] == [("b", 2, timestep)]
+
 print("TimeOrder test passed")
 
 
@@ -186,7 +227,7 @@ print("TimeOrder test passed")
 
 cfg['pipeline'].insert(-1, {
         "module": "filters.AggSum",
-        "expression": "aaa.(*).*.zzz",
+        "expressions": ["aaa.(*).*.zzz"],
         "groupsize": 2,
         "timeout": 1,
         "droppartial": False,
@@ -301,5 +342,964 @@ for entry in outdata:
 print("MovingStat test passed")
 
 
+####################################################################
+# Test 4: binary file round trip
+
+binfile = tempfile.NamedTemporaryFile(suffix='.wtsb')
+bindata = [(k, (v, v * 2, None) if v % 3 else v, t) for k, v, t in indata]
+cfg = {
+    "pipeline": [{
+        "module": "sources.DataIn",
+        "input": bindata,
+    }, {
+        "module": "sinks.BinOut",
+        "file": binfile.name,
+        "blocksize": 100,
+    }]
+}
+s = Sentry(None, cfg)
+s.run()
+
+cfg = {
+    "pipeline": [{
+        "module": "sources.BinIn",
+        "file": binfile.name,
+    }, {
+        "module": "sinks.DataOut",
+        "output": outdata,
+    }]
+}
+outdata.clear()
+s = Sentry(None, cfg)
+s.run()
+binfile.close()
+
+assert outdata == bindata
+
+print("BinIn/BinOut test passed")
+
+
+####################################################################
+# Test 5: synthetic data source
+
+syncfg = {
+    "module": "sources.Synthetic",
+    "hierarchy": [3, 4],
+    "steps": 100,
+    "interval": timestep,
+    "outagerate": 0.01,
+    "shiftrate": 0.01,
+    "outoforder": 0.05,
+    "late": 0.02,
+    "latedelay": 3,
+    "seed": 1,
+}
+cfg = {"pipeline": [syncfg, {"module": "sinks.DataOut", "output": outdata}]}
+outdata.clear()
+s = Sentry(None, cfg)
+s.run()
+syndata = list(outdata)
+
+assert len(syndata) == 3 * 4 * 100
+assert len(set(k for k, v, t in syndata)) == 3 * 4
+assert len(set((k, t) for k, v, t in syndata)) == len(syndata)
+assert syndata != sorted(syndata, key=lambda e: e[2]) # some are out of order
+
+# same seed generates same data
+outdata.clear()
+s = Sentry(None, cfg)
+s.run()
+assert outdata == syndata
+
+print("Synthetic test passed")
+
+
+####################################################################
+# Test 6: multiple aggregate functions
+
+cfg = {
+    "pipeline": [{
+        "module": "sources.DataIn",
+        "input": [e for e in indata if e[0].split('.')[1] != 'order'],
+    }, {
+        "module": "filters.AggSum",
+        "expressions": ["aaa.(*).*.zzz"],
+        "groupsize": 2,
+        "timeout": 1,
+        "functions": ["sum", "count", "mean", "max"],
+    }, {
+        "module": "sinks.DataOut",
+        "output": outdata,
+    }]
+}
+outdata.clear()
+s = Sentry(None, cfg)
+s.run()
+
+results = dict()
+for key, value, t in outdata:
+    _, group, _, _, function = key.split(sep='.')
+    results[(group, function, t)] = value
+for (group, function, t), value in results.items():
+    i = (t - timebase) // timestep
+    if function == "sum":
+        assert value == exp_aggsum[group][i]
+    elif function == "mean":
+        assert value == results[(group, "sum", t)] / results[(group, "count", t)]
+    elif function == "max":
+        assert value <= results[(group, "sum", t)]
+assert results[("hole", "count", timebase + 73 * timestep)] == 1
+assert results[("hole", "count", timebase + 72 * timestep)] == 2
+
+# exact values for a small input, including a null value and an all-null group
+functions = ["sum", "count", "mean", "min", "max", "nullcount"]
+aggsum = AggSum({"module": "filters.AggSum", "expressions": ["x.(*).*"],
+    "groupsize": 3, "timeout": 3600, "functions": functions},
+    lambda: iter([
+        (b"x.a.1", 5, 0), (b"x.a.2", None, 0), (b"x.a.3", -2, 0),
+        (b"x.b.1", None, 0), (b"x.b.2", None, 0), (b"x.b.3", None, 0),
+        (b"x.a.1", 1.5, 10), (b"x.a.2", 2.5, 10), (b"x.a.3", 2, 10)]), {})
+expected = [("a", 0, [3, 2, 1.5, -2, 5, 1]),
+    ("b", 0, [0, 0, None, None, None, 3]),
+    ("a", 10, [6, 3, 2, 1.5, 2.5, 0])]
+assert list(aggsum.run()) == [(b"x.%s.*.%s" % (bytes(g, 'ascii'),
+    bytes(f, 'ascii')), v, t)
+    for g, t, values in expected for f, v in zip(functions, values)]
+
+print("AggSum functions test passed")
+
+
+####################################################################
+# Test 7: hierarchical rollup
+
+def run_aggsum(aggcfg):
+    cfg = {
+        "pipeline": [{
+            "module": "sources.Synthetic",
+            "hierarchy": [3, 4, 5],
+            "steps": 20,
+            "seed": 2,
+        }, aggcfg, {
+            "module": "sinks.DataOut",
+            "output": outdata,
+        }]
+    }
+    outdata.clear()
+    s = Sentry(None, cfg)
+    s.run()
+    return sorted(outdata)
+
+rollup = run_aggsum({
+    "module": "filters.AggSum",
+    "expressions": ["synthetic.(*).(*).*.cnt"],
+    "groupsize": 5,
+    "timeout": 60,
+    "rollup": True,
+    "functions": ["sum", "max"],
+})
+level2 = run_aggsum({
+    "module": "filters.AggSum",
+    "expressions": ["synthetic.(*).(*).*.cnt"],
+    "groupsize": 5,
+    "timeout": 60,
+    "functions": ["sum", "max"],
+})
+level1 = run_aggsum({
+    "module": "filters.AggSum",
+    "expressions": ["synthetic.(*).*.*.cnt"],
+    "groupsize": 20,
+    "timeout": 60,
+    "functions": ["sum", "max"],
+})
+assert len(level2) == 3 * 4 * 20 * 2
+assert len(level1) == 3 * 20 * 2
+assert rollup == sorted(level2 + level1)
+
+# All groups are complete, so droppartial drops nothing, including the first
+# timestep of the coarser level (at which all its child groups are new).
+rollup = run_aggsum({
+    "module": "filters.AggSum",
+    "expressions": ["synthetic.(*).(*).*.cnt"],
+    "groupsize": 5,
+    "timeout": 60,
+    "rollup": True,
+    "droppartial": True,
+    "functions": ["sum", "max"],
+})
+assert rollup == sorted(level2 + level1)
+first_t = min(t for k, v, t in level1)
+first_level1 = [e for e in level1 if e[2] == first_t]
+assert len(first_level1) == 3 * 2
+assert [e for e in rollup if e in first_level1] == first_level1
+
+print("AggSum rollup test passed")
+
+
+####################################################################
+# Test 8: MovingStat quantile backends
+
+def run_movingstat(**options):
+    mscfg = {
+        "module": "filters.MovingStat",
+        "warmup": 12 * timestep,
+        "history": 48 * timestep,
+        "includeabsolute": True,
+        "inpainting": {"min": 0.5, "max": 2, "maxduration": 18 * timestep},
+    }
+    mscfg.update(options)
+    mscfg = {k: v for k, v in mscfg.items() if v is not None}
+    cfg = {
+        "pipeline": [{
+            "module": "sources.Synthetic",
+            "hierarchy": [4, 5],
+            "steps": 300,
+            "interval": timestep,
+            "outagerate": 0.01,
+            "outageduration": [1, 24],
+            "shiftrate": 0.005,
+            "seed": 3,
+        }, mscfg, {
+            "module": "sinks.DataOut",
+            "output": outdata,
+        }]
+    }
+    outdata.clear()
+    s = Sentry(None, cfg)
+    s.run()
+    return list(outdata)
+
+for stattype in (['quantile', 1, 4], ['median']):
+    listresult = run_movingstat(type=stattype)
+    assert len(listresult) > 4 * 5 * 250
+    assert run_movingstat(type=stattype, backend='skiplist') == listresult
+
+print("MovingStat backend test passed")
+
+# min and max are equivalent to the extreme quantiles
+assert run_movingstat(type=['min']) == run_movingstat(type=['quantile', 0, 1])
+assert run_movingstat(type=['max']) == run_movingstat(type=['quantile', 1, 1])
+
+print("MovingStat min/max test passed")
+
+# approximate median is close to exact median (value errors are bounded by
+# accuracy, but the sketch's window boundaries are coarser, so allow a few
+# larger errors)
+exact = run_movingstat(type=['median'])
+approx = run_movingstat(type=['approxmedian'],
+    approximation={"accuracy": 0.01, "subwindows": 16})
+assert [(k, t) for k, v, t in approx] == [(k, t) for k, v, t in exact]
+errors = sorted(abs(a[1][2] - e[1][2]) / e[1][2]
+    for a, e in zip(approx, exact) if e[1][2])
+assert errors[len(errors) // 2] < 0.01
+assert errors[len(errors) * 95 // 100] < 0.02
+
+print("MovingStat approximate quantile test passed")
+
+
+####################################################################
+# Test 9: MovingStat forecasting types
+
+def forecast_errors(stattype):
+    cfg = {
+        "pipeline": [{
+            "module": "sources.Synthetic",
+            "hierarchy": [5, 4],
+            "steps": 24 * 21,
+            "interval": 3600,
+            "noise": 0.02,
+            "outagerate": 0.002,
+            "seed": 4,
+        }, {
+            "module": "filters.MovingStat",
+            "type": stattype,
+            "history": 7 * 86400,
+            "warmup": 2 * 86400,
+            "includeabsolute": True,
+            "inpainting": {"min": 0.5, "max": 2, "maxduration": 2 * 86400},
+        }, {
+            "module": "sinks.DataOut",
+            "output": outdata,
+        }]
+    }
+    outdata.clear()
+    s = Sentry(None, cfg)
+    s.run()
+    assert len(outdata) == 20 * 24 * 19
+    return sorted(abs(ratio - 1) for k, (ratio, v, p), t in outdata)
+
+median_errors = forecast_errors(['median'])
+for stattype in (['ewma'], ['holt']):
+    errors = forecast_errors(stattype)
+    assert errors[len(errors) // 2] < 2 * median_errors[len(errors) // 2]
+# seasonal forecast tracks the daily cycle that the median can't
+errors = forecast_errors(['holtwinters', 86400])
+assert errors[len(errors) // 2] < median_errors[len(errors) // 2] / 4
+
+print("MovingStat forecasting test passed")
+
+
+####################################################################
+# Test 10: MovingStat with multiple stats
+
+stats = [
+    {"type": ['median']},
+    {"type": ['quantile', 1, 4], "history": 24 * timestep},
+    {"type": ['mean']},
+    {"type": ['min'], "history": 16 * timestep},
+    {"type": ['approxmedian'], "history": 36 * timestep},
+    {"type": ['ewma']},
+]
+# without inpainting, each stat is the same as if calculated separately
+multi = run_movingstat(stats=stats, inpainting=None)
+for i, stat in enumerate(stats):
+    single = run_movingstat(type=stat["type"],
+        history=stat.get("history", 48 * timestep), inpainting=None)
+    if i == 0:
+        expected = single
+    else:
+        expected = [(k, (r, p), t) for k, (r, v, p), t in single]
+    assert [(k, value[:3] if i == 0 else value[1+2*i:3+2*i], t)
+        for k, value, t in multi] == expected
+
+# with inpainting, the primary stat is the same as if calculated separately
+multi = run_movingstat(stats=stats)
+assert [(k, value[:3], t) for k, value, t in multi] == \
+    run_movingstat(type=['median'])
+
+print("MovingStat multiple stats test passed")
+
+
+####################################################################
+# Test 11: MovingStat grid mode
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def close(a, b):
+    if isinstance(a, tuple):
+        return len(a) == len(b) and all(close(x, y) for x, y in zip(a, b))
+    if a is None or b is None:
+        return a is b
+    return abs(a - b) <= 1e-9 * abs(b)
+
+if numpy is None:
+    print("MovingStat grid test skipped (numpy not available)")
+else:
+    grid = {"interval": timestep}
+    for stattype in (['median'], ['quantile', 1, 4], ['min'], ['max']):
+        assert run_movingstat(type=stattype, grid=grid) == \
+            run_movingstat(type=stattype)
+    gridresult = run_movingstat(type=['mean'], grid=grid)
+    scalarresult = run_movingstat(type=['mean'])
+    assert len(gridresult) == len(scalarresult)
+    assert all(g[0] == s[0] and g[2] == s[2] and close(g[1], s[1])
+        for g, s in zip(gridresult, scalarresult))
+    gstats = [stat for stat in stats if stat["type"][0] in ('median',
+        'quantile', 'mean', 'min')]
+    gridresult = run_movingstat(stats=gstats, grid=grid)
+    scalarresult = run_movingstat(stats=gstats)
+    assert len(gridresult) == len(scalarresult)
+    assert all(g[0] == s[0] and g[2] == s[2] and close(g[1], s[1])
+        for g, s in zip(gridresult, scalarresult))
+
+    # values that arrive within lateness are used; later ones are dropped
+    def run_grid(data, lateness):
+        ms = MovingStat({"module": "filters.MovingStat", "type": ['max'],
+            "history": 4 * timestep, "warmup": 2 * timestep, "normalize": False,
+            "grid": {"interval": timestep, "lateness": lateness}},
+            lambda: iter(data), {})
+        return sorted(ms.run())
+    data = [(key, 10 * i, i * timestep) for i in range(8) for key in "ab"]
+    expected = run_grid(data, 0)
+    assert len(expected) == 2 * 6
+    late = list(data)
+    late.insert(9, late.pop(6)) # a@3 arrives after b@4
+    assert run_grid(late, timestep) == expected
+    result = run_grid(late, 0) # a@3 is dropped
+    assert ("a", 30, 4 * timestep) in expected
+    assert ("a", 20, 4 * timestep) in result
+    assert len(result) == len(expected) - 1
+
+    print("MovingStat grid test passed")
+
+
+####################################################################
+# Test 12: watermarks
+
+def run_module(moduleclass, config, entries):
+    return list(moduleclass(config, lambda: iter(entries), {}).run())
+
+watermark = (None, SentryModule.WATERMARK, timestep)
+
+# AggSum completes (non-partial) aggregates before the watermark without
+# waiting for timeout, including rollups
+result = run_module(AggSum, {"module": "filters.AggSum",
+    "expressions": ["x.(*).(*).*"], "timeout": 3600, "droppartial": True,
+    "rollup": True}, [
+        (b"x.a.b.1", 1, 0), (b"x.a.b.2", 2, 0), (b"x.a.c.1", 4, 0),
+        watermark, (b"x.a.b.1", 8, timestep)])
+assert sorted(result[:2]) == [(b"x.a.b.*", 3, 0), (b"x.a.c.*", 4, 0)]
+assert result[2:] == [(b"x.a.*.*", 7, 0), watermark]
+
+# TimeOrder releases buffered data whose missing predecessor is older than
+# the watermark
+result = run_module(TimeOrder, {"module": "filters.TimeOrder",
+    "interval": timestep, "timeout": 3600}, [
+        ("a", 1, 0), ("a", 3, 2 * timestep), ("b", 1, 0),
+        (None, SentryModule.WATERMARK, timestep),
+        (None, SentryModule.WATERMARK, 2 * timestep), ("b", 2, timestep)])
+assert result == [("a", 1, 0), ("b", 1, 0),
+    (None, SentryModule.WATERMARK, timestep), ("a", 3, 2 * timestep),
+    (None, SentryModule.WATERMARK, 2 * timestep), ("b", 2, timestep)]
+
+# MovingStat grid mode completes timesteps before the watermark
+if numpy is not None:
+    data = [(key, 10 * i, i * timestep) for i in range(4) for key in "ab"]
+    result = run_module(MovingStat, {"module": "filters.MovingStat",
+        "type": ['max'], "history": 4 * timestep, "warmup": 2 * timestep,
+        "normalize": False,
+        "grid": {"interval": timestep, "lateness": 3600}},
+        data + [(None, SentryModule.WATERMARK, 3 * timestep)])
+    assert result == [("a", 10, 2 * timestep), ("b", 10, 2 * timestep),
+        (None, SentryModule.WATERMARK, 3 * timestep),
+        ("a", 20, 3 * timestep), ("b", 20, 3 * timestep)]
+
+print("Watermark test passed")
+
+
+####################################################################
+# Test 13: Resample
+
+def resample(function, entries, **options):
+    config = {"module": "filters.Resample", "interval": 3 * timestep,
+        "function": function}
+    config.update(options)
+    return run_module(Resample, config, entries)
+
+data = [("a", v, i * timestep) for i, v in enumerate([4, 1, 6, 2, None, 9, 5])]
+assert resample("sum", data) == \
+    [("a", 11, 0), ("a", 11, 3 * timestep), ("a", 5, 6 * timestep)]
+assert resample("mean", data) == \
+    [("a", 11/3, 0), ("a", 5.5, 3 * timestep), ("a", 5, 6 * timestep)]
+assert resample("min", data)[:2] == [("a", 1, 0), ("a", 2, 3 * timestep)]
+assert resample("max", data)[:2] == [("a", 6, 0), ("a", 9, 3 * timestep)]
+assert resample("last", data)[:2] == [("a", 6, 0), ("a", 9, 3 * timestep)]
+assert resample("sum", [("a", None, 0)]) == [("a", None, 0)]
+
+# with inputinterval, an interval is output as soon as it's complete; a
+# watermark completes an interval; late data is dropped
+entries = [("a", 1, 0), ("b", 1, 0), ("a", 2, timestep), ("a", 3, 2 * timestep),
+    ("b", 5, 2 * timestep), ("a", 9, timestep),
+    ("a", 1, 3 * timestep), ("b", 1, 3 * timestep),
+    (None, SentryModule.WATERMARK, 6 * timestep)]
+assert resample("sum", entries, inputinterval=timestep) == [
+    ("a", 6, 0), ("b", 6, 0), ("a", 1, 3 * timestep), ("b", 1, 3 * timestep),
+    (None, SentryModule.WATERMARK, 6 * timestep)]
+
+print("Resample test passed")
+
+
+####################################################################
+# Test 14: Dedup
+
+entries = [("a", 1, 0), ("b", 1, 0), ("a", 2, 10), ("a", 2, 10), ("b", 1, 0),
+    ("a", 4, 30), ("a", 3, 20), ("a", 3, 20), ("a", 2, 10),
+    ("a", 5, 40), ("a", 6, 50), (None, SentryModule.HEARTBEAT, 0),
+    ("a", 1, 0)]
+result = run_module(Dedup, {"module": "filters.Dedup", "window": 4}, entries)
+assert result == [("a", 1, 0), ("b", 1, 0), ("a", 2, 10), ("a", 4, 30),
+    ("a", 3, 20), ("a", 5, 40), ("a", 6, 50),
+    (None, SentryModule.HEARTBEAT, 0)] # a@0 is too old to check
+
+# An accepted out-of-order entry must not displace a newer time from the
+# window
+entries = [("k", 1, 10), ("k", 2, 5), ("k", 3, 11), ("k", 4, 12), ("k", 5, 10)]
+result = run_module(Dedup, {"module": "filters.Dedup", "window": 3}, entries)
+assert result == entries[:4]
+
+print("Dedup test passed")
+
+
+####################################################################
+# Test 15: Join
+
+def join(entries, **options):
+    config = {"module": "filters.Join", "left": "x.(*).(*).up",
+        "right": "x.(*).(*).probed", "output": "y.(*).(*).ratio",
+        "timeout": 3600}
+    config.update(options)
+    return run_module(Join, config, entries)
+
+entries = [(b"x.a.1.up", 3, 0), (b"x.a.2.up", 1, 0), (b"z", 1, 0),
+    (b"x.a.1.probed", 4, 0), (b"x.a.1.probed", 6, timestep),
+    (b"x.a.2.probed", 0, 0), (b"x.a.1.up", 3, timestep),
+    (b"x.a.2.probed", 5, timestep), (b"x.a.2.up", None, timestep)]
+assert join(entries) == [(b"y.a.1.ratio", 0.75, 0), (b"y.a.2.ratio", None, 0),
+    (b"y.a.1.ratio", 0.5, timestep), (b"y.a.2.ratio", None, timestep)]
+assert join(entries, operator="-")[:3:2] == \
+    [(b"y.a.1.ratio", -1, 0), (b"y.a.1.ratio", -3, timestep)]
+assert len(join(entries, keepinputs=True)) == len(entries) + 4
+
+# unpaired values are dropped after timeout, when the buffer is full, or
+# when a watermark passes them
+assert join([(b"x.a.1.up", 3, 0), (b"x.a.2.up", 3, 0),
+    (b"x.a.2.probed", 1, 0), (b"x.a.1.probed", 1, 0)], maxbuffer=1) == \
+    [(b"y.a.2.ratio", 3, 0)]
+assert join([(b"x.a.1.up", 3, 0), (None, SentryModule.WATERMARK, timestep),
+    (b"x.a.1.probed", 1, 0)]) == [(None, SentryModule.WATERMARK, timestep)]
+def join_input():
+    yield (b"x.a.1.up", 3, 0)
+    time.sleep(0.2)
+    yield (b"x.a.1.probed", 1, 0)
+assert list(Join({"module": "filters.Join", "left": "x.(*).(*).up",
+    "right": "x.(*).(*).probed", "output": "y.(*).(*).ratio",
+    "timeout": 0.1}, join_input, {}).run()) == []
+
+print("Join test passed")
+
+
+####################################################################
+# Test 16: AlertKafka (with disable set, alerts are printed, not produced)
+
+try:
+    from watchtower.sentry.sinks.AlertKafka import AlertKafka
+except ImportError:
+    AlertKafka = None
+
+def run_alertkafka(entries, includeabsolute=True, **options):
+    config = {"module": "sinks.AlertKafka", "fqid": "f", "name": "n",
+        "brokers": "localhost:9092", "topic": "t", "min": 0.5,
+        "disable": True}
+    config.update(options)
+    alertkafka = AlertKafka(config, lambda: iter(entries),
+        {"method": "m", "includeabsolute": includeabsolute})
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        alertkafka.run()
+    return [json.loads(line) for line in output.getvalue().splitlines()]
+
+def violations(records):
+    return sorted((v["expression"], v["time"], v["condition"])
+        for record in records for v in record["violations"])
+
+if AlertKafka is None:
+    print("AlertKafka test skipped (confluent_kafka not available)")
+else:
+    entries = [(b"k%d" % i, (0.1 if i % 2 else 1.0, 1, 2), timestep)
+        for i in range(10)] + \
+        [(b"k%d" % i, 1.0, 2 * timestep) for i in range(10)] + \
+        [(None, SentryModule.WATERMARK, 3 * timestep)]
+    single = run_alertkafka(entries)
+    assert len(single) == 10
+    assert all(len(record["violations"]) == 1 for record in single)
+    coalesced = run_alertkafka(entries, coalesce={})
+    assert [(r["level"], r["time"], len(r["violations"]))
+        for r in coalesced] == [("critical", timestep, 5),
+        ("normal", 2 * timestep, 5)]
+    assert violations(coalesced) == violations(single)
+    coalesced = run_alertkafka(entries,
+        coalesce={"window": 3 * timestep, "maxviolations": 3})
+    assert [(r["level"], r["time"], len(r["violations"]))
+        for r in coalesced] == [("critical", 0, 3), ("normal", 0, 3),
+        ("critical", 0, 2), ("normal", 0, 2)]
+    assert violations(coalesced) == violations(single)
+
+    # MovingStat with stats but without includeabsolute outputs only ratios,
+    # which are not actual and predicted values
+    for nstats in [2, 3]:
+        records = run_alertkafka([(b"k", (0.1,) + (2.0,) * (nstats - 1), 0),
+            (b"k", (1.0,) * nstats, timestep)], includeabsolute=False)
+        assert [(r["violations"][0]["value"],
+            r["violations"][0]["history_value"]) for r in records] == \
+            [(0.1, None), (1.0, None)]
+    records = run_alertkafka([(b"k", (0.1, 1, 10, 0.2, 5), 0)])
+    assert (records[0]["violations"][0]["value"],
+        records[0]["violations"][0]["history_value"]) == (1, 10)
+
+    print("AlertKafka test passed")
+
+
+####################################################################
+# Test 17: JsonOut compression, rotation, and writer thread
+
+def run_jsonout(data, **options):
+    config = {"module": "sinks.JsonOut"}
+    config.update(options)
+    Sentry(None, {"pipeline": [
+        {"module": "sources.DataIn", "input": data}, config]}).run()
+
+def jsonout_order(name):
+    # "out-HHMM.jsonl.gz", then "out-HHMM-1.jsonl.gz", ...
+    parts = name.split('.')[0].split('-')
+    return (parts[1], int(parts[2]) if len(parts) > 2 else 0)
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    run_jsonout(indata, file=tmpdir + "/plain.jsonl", compact=False)
+    with open(tmpdir + "/plain.jsonl") as f:
+        assert f.read() == ''.join(json.dumps((k, v, t)) + '\n'
+            for k, v, t in indata)
+    os.remove(tmpdir + "/plain.jsonl")
+
+    sorteddata = sorted(indata, key=lambda entry: entry[2])
+    run_jsonout(sorteddata, file=tmpdir + "/out-%H%M.jsonl.gz", compression="gzip",
+        rotate={"interval": 600, "size": 10000}, thread=True)
+    names = sorted(os.listdir(tmpdir), key=jsonout_order)
+    assert names[0] == "out-0140.jsonl.gz"
+    assert names[-1].startswith("out-0210")
+    assert len(names) > 5 # some intervals were split by size
+    jsondata = []
+    for name in names:
+        with gzip.open(os.path.join(tmpdir, name), 'rt') as f:
+            text = f.read()
+        assert len(text) < 10000 + 100
+        filedata = [tuple(entry) for entry in map(json.loads, text.splitlines())]
+        assert all(time.strftime("%H%M", time.gmtime(t - t % 600)) ==
+            jsonout_order(name)[0] for k, v, t in filedata)
+        jsondata += filedata
+    assert jsondata == sorteddata
+
+    # If the pipeline fails, completed files are renamed, and the incomplete
+    # file keeps its ".part" name.
+    nwritten = 1200
+    def failing_gen():
+        for i, (k, v, t) in enumerate(sorteddata[:nwritten]):
+            yield (bytes(k, 'ascii'), v, t)
+            if i % 100 == 99: # write out the batch
+                yield (None, SentryModule.HEARTBEAT, t)
+        raise RuntimeError("pipeline failed")
+    for thread in (False, True):
+        subdir = os.path.join(tmpdir, "fail%d" % thread)
+        os.mkdir(subdir)
+        try:
+            JsonOut({"module": "sinks.JsonOut",
+                "file": subdir + "/out-%H%M.jsonl",
+                "rotate": {"interval": 600}, "thread": thread},
+                failing_gen, {}).run()
+            assert False, "expected RuntimeError"
+        except RuntimeError as e:
+            assert str(e) == "pipeline failed"
+        t = sorteddata[nwritten - 1][2]
+        last = time.strftime("out-%H%M.jsonl", time.gmtime(t - t % 600))
+        names = sorted(os.listdir(subdir))
+        assert len(names) > 1
+        assert names[-1] == last + ".part"
+        assert last not in names
+        assert not any(name.endswith(".part") for name in names[:-1])
+        with open(os.path.join(subdir, names[-1])) as f:
+            assert json.loads(f.readlines()[-1]) == \
+                list(sorteddata[nwritten - 1])
+
+    # Without rotate, output goes directly to the named file.
+    try:
+        JsonOut({"module": "sinks.JsonOut", "file": tmpdir + "/direct.jsonl"},
+            failing_gen, {}).run()
+        assert False, "expected RuntimeError"
+    except RuntimeError:
+        pass
+    assert os.path.exists(tmpdir + "/direct.jsonl")
+    assert not os.path.exists(tmpdir + "/direct.jsonl.part")
+
+print("JsonOut test passed")
+
+
+####################################################################
+# Test 18: SQLite result and alert store
+
+def query(db, sql, *args):
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute(sql, args).fetchall()
+    finally:
+        conn.close()
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    db = tmpdir + "/results.db"
+    cfg = {"pipeline": [
+        {"module": "sources.DataIn", "input": indata},
+        {"module": "sinks.SQLite", "file": db, "batchsize": 100}]}
+    Sentry(None, cfg).run()
+    assert query(db, "SELECT count(*) FROM results") == [(len(indata),)]
+    assert query(db, "PRAGMA journal_mode") == [("wal",)]
+    start, end = timebase + 50 * timestep, timebase + 60 * timestep
+    rows = query(db, "SELECT key, time, value FROM keys JOIN results "
+        "ON results.key_id = keys.id WHERE key GLOB 'aaa.hole.*' "
+        "AND time >= ? AND time < ? ORDER BY key, time", start, end)
+    assert rows == sorted((k, t, v) for k, v, t in indata
+        if k.startswith("aaa.hole.") and start <= t < end)
+
+    # MovingStat-style values, appended to the same database
+    entries = [(b"k1", (0.5, 10, 20), 0), (b"k2", None, 0),
+        (b"k1", (2.0, 40, 20, 7), 10)]
+    SQLite({"module": "sinks.SQLite", "file": db}, lambda: iter(entries),
+        {"includeabsolute": True}).run()
+    assert query(db, "SELECT key, time, value, actual, predicted FROM keys "
+        "JOIN results ON results.key_id = keys.id WHERE key GLOB 'k*' "
+        "ORDER BY time, key") == [("k1", 0, 0.5, 10, 20),
+        ("k2", 0, None, None, None), ("k1", 10, 2.0, 40, 20)]
+
+    # multi-stat MovingStat output
+    msdata = [(k, v, t) for k, v, t in indata if k == "aaa.outage.prober-1.zzz"]
+    def run_multistat(dbfile, **options):
+        msconfig = {"module": "filters.MovingStat", "history": 100,
+            "warmup": 50, "stats": [{"type": ["mean"]}, {"type": ["median"]}]}
+        msconfig.update(options)
+        outdata.clear()
+        Sentry(None, {"pipeline": [
+            {"module": "sources.DataIn", "input": msdata}, msconfig,
+            {"module": "sinks.DataOut", "output": outdata}]}).run()
+        expected = list(outdata)
+        Sentry(None, {"pipeline": [
+            {"module": "sources.DataIn", "input": msdata}, msconfig,
+            {"module": "sinks.SQLite", "file": dbfile}]}).run()
+        return expected
+    expected = run_multistat(tmpdir + "/multi.db", includeabsolute=True)
+    assert len(expected) > 0 and len(expected[0][1]) == 5
+    assert query(tmpdir + "/multi.db", "SELECT key, time, value, actual, "
+        "predicted FROM keys JOIN results ON results.key_id = keys.id "
+        "ORDER BY time") == [(k, t, *v[:3]) for k, v, t in expected]
+    try:
+        run_multistat(tmpdir + "/ratios.db")
+        assert False, "tuple of ratios was accepted"
+    except SentryModule.UserError:
+        pass
+
+    if AlertKafka is not None:
+        entries = [(b"k1", (0.1, 1, 10), 0), (b"k1", (1.0, 10, 10), 10)]
+        run_alertkafka(entries, database=db)
+        assert query(db, "SELECT key, time, level, condition, value, "
+            "predicted FROM keys JOIN alerts ON alerts.key_id = keys.id") == \
+            [("k1", 0, "critical", "< 0.5", 1, 10),
+            ("k1", 10, "normal", "normal", 10, 10)]
+
+print("SQLite test passed")
+
+
+####################################################################
+# Test 19: state server
+
+def stateserver_source():
+    # Constant values, then a spike that starts inpainting.  After that, the
+    # state doesn't change, and heartbeats let the server answer queries.
+    for t in range(0, 300, 10):
+        for i in range(3):
+            yield (b"geo.k%d.x" % i, 10 + i if t < 280 else 100, t)
+        yield (b"other.k", 5, t)
+    yield (None, SentryModule.WATERMARK, 300) # completes grid timestep 290
+    while True:
+        yield (None, SentryModule.HEARTBEAT, 0)
+
+def stateserver_query(server, it, query):
+    results = []
+    def get():
+        url = "http://%s:%d/state?%s" % (*server.httpd.server_address[:2],
+            query)
+        try:
+            with urllib.request.urlopen(url) as response:
+                results.append(json.loads(response.read()))
+        except urllib.error.HTTPError as e:
+            results.append(e.code)
+    thread = threading.Thread(target=get)
+    thread.start()
+    while thread.is_alive():
+        next(it)
+    return results[0]
+
+for extra in [{}, {"grid": {"interval": 10}}]:
+    server = StateServer.StateServer({"listen": "127.0.0.1:0",
+        "maxresults": 2})
+    config = {"module": "filters.MovingStat", "type": ["median"],
+        "history": 100, "warmup": 50, "includeabsolute": True,
+        "inpainting": {"max": 2, "maxduration": 300}}
+    config.update(extra)
+    movingstat = MovingStat(config, server.wrap(stateserver_source), {})
+    server.register(movingstat)
+    server.start()
+    try:
+        it = movingstat.run()
+        for key, value, t in it:
+            if value == SentryModule.HEARTBEAT:
+                break # all data has been processed
+        result = stateserver_query(server, it, "glob=geo.k[02]&window=1")
+        assert sorted(result["keys"]) == ["geo.k0.x", "geo.k2.x"]
+        assert not result["truncated"]
+        state = result["keys"]["geo.k2.x"]["filters.MovingStat"]
+        assert state["prediction"] == 12 and not state["warmingup"]
+        assert state["inpainting"] == 280 and state["raw"] == [[100, 280], [100, 290]]
+        # history holds the inpainted value
+        assert state["window"] == [[12, t] for t in range(200, 300, 10)]
+        result = stateserver_query(server, it, "glob=geo")
+        assert len(result["keys"]) == 2 and result["truncated"]
+        result = stateserver_query(server, it, "key=other.k")
+        assert result["keys"]["other.k"]["filters.MovingStat"] == \
+            {"time": 290, "warmingup": False, "prediction": 5,
+            "inpainting": None}
+        assert stateserver_query(server, it, "key=nope") == \
+            {"keys": {}, "truncated": False}
+        assert stateserver_query(server, it, "glob=geo&key=geo") == 400
+    finally:
+        server.stop()
+
+# new_state_keys returns each key once: all keys at the first call, then
+# only the keys created since the previous call
+for extra in [{}, {"grid": {"interval": 10}}]:
+    config = {"module": "filters.MovingStat", "type": ["median"],
+        "history": 100, "warmup": 50}
+    config.update(extra)
+    feed = []
+    movingstat = MovingStat(config, lambda: iter(feed), {})
+    def push(*entries):
+        feed[:] = entries
+        return list(movingstat.run())
+    push((b"a", 1, 0), (b"b", 1, 0), (b"a", 1, 10))
+    assert sorted(movingstat.new_state_keys()) == [b"a", b"b"]
+    assert movingstat.new_state_keys() == []
+    push((b"c", 1, 20), (b"a", 1, 20), (b"d", 1, 20), (b"c", 1, 30))
+    assert movingstat.new_state_keys() == [b"c", b"d"]
+    assert movingstat.new_state_keys() == []
+
+print("StateServer test passed")
+
+
+####################################################################
+# Test 20: JsonIn with multiple (compressed) files and worker processes
+
+def run_jsonin(**options):
+    config = {"module": "sources.JsonIn"}
+    config.update(options)
+    result = []
+    Sentry(None, {"pipeline": [config, {"module": "sinks.DataOut",
+        "output": result}]}).run()
+    return result
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    openers = [("a", open), ("b", gzip.open), ("c", bz2.open),
+        ("d", lzma.open)]
+    part = (len(indata) + len(openers) - 1) // len(openers)
+    for i, (name, opener) in enumerate(openers):
+        with opener(os.path.join(tmpdir, "in-%s.jsonl" % name), 'wt') as f:
+            for entry in indata[i * part : (i + 1) * part]:
+                f.write(json.dumps(entry) + '\n')
+    with open(os.path.join(tmpdir, "extra.jsonl"), 'w') as f:
+        f.write(json.dumps(indata[0]) + '\n')
+    for workers in [0, 2]:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always", ResourceWarning)
+            # "in-*" is expanded in sorted order, after the file listed first
+            result = run_jsonin(files=[tmpdir + "/extra.jsonl",
+                tmpdir + "/in-*.jsonl"], workers=workers, chunksize=1000)
+            gc.collect()
+        assert result == [indata[0]] + indata
+        assert not [w for w in caught if w.category is ResourceWarning], \
+            "unclosed file"
+    try:
+        run_jsonin(files=[tmpdir + "/nomatch-*.jsonl"])
+        assert False, "expected UserError"
+    except SentryModule.UserError:
+        pass
+
+print("JsonIn test passed")
+
+
+####################################################################
+# Test 21: SocketIn line and binary ingestion, and overlong records
+
+def binary_record(key, value, t):
+    return BINARY_LEN.pack(BINARY_VT.size + len(key)) + \
+        BINARY_VT.pack(t, value) + key
+
+def run_socketin(fmt, messages):
+    """Send each message in its own connection to a SocketIn, and return
+    the tuples it produced, and whether each connection was closed by the
+    server."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = tmpdir + "/sock"
+        source = SocketIn({"module": "sources.SocketIn",
+            "listen": ["unix:" + path], "format": fmt, "maxrecord": 100,
+            "idletimeout": 1}, None, {})
+        closed = []
+        def client():
+            while not os.path.exists(path):
+                time.sleep(0.01)
+            for message in messages:
+                with socket.socket(socket.AF_UNIX) as sock:
+                    sock.connect(path)
+                    for part in message:
+                        sock.sendall(part)
+                        time.sleep(0.05)
+                    # the server never writes; recv() returns b'' only if
+                    # the server closed the connection
+                    sock.settimeout(0.5)
+                    try:
+                        closed.append(sock.recv(1) == b'')
+                    except socket.timeout:
+                        closed.append(False)
+        thread = threading.Thread(target=client)
+        thread.start()
+        result = [entry for entry in source.run() if entry[0] is not None]
+        thread.join()
+        return result, closed
+
+result, closed = run_socketin("line", [
+    [b"a.b 1 100\nc.d nan 110\ne.f 2.5 1", b"20\n"],
+    [b"g.h 3 130\n" + b"x" * 200 + b" 4 140\ni.j 5 150\n"],
+    [b"k.l 6 160\n", b"y" * 200],
+    [b"m.n 7 170\n"]])
+assert result == [(b"a.b", 1, 100), (b"c.d", None, 110), (b"e.f", 2.5, 120),
+    (b"g.h", 3, 130), (b"i.j", 5, 150), (b"k.l", 6, 160), (b"m.n", 7, 170)]
+assert closed == [False, False, True, False]
+
+result, closed = run_socketin("binary", [
+    [binary_record(b"a.b", 1.0, 100) + binary_record(b"c.d", math.nan, 110)[:9],
+        binary_record(b"c.d", math.nan, 110)[9:]],
+    [binary_record(b"e.f", 2.0, 120) + BINARY_LEN.pack(1 << 30) + b"zzz"],
+    [binary_record(b"g.h", 3.0, 130)]])
+assert result == [(b"a.b", 1.0, 100), (b"c.d", None, 110), (b"e.f", 2.0, 120),
+    (b"g.h", 3.0, 130)]
+assert closed == [False, True, False]
+
+# A unix socket path is replaced only if it is a (stale) socket
+with tempfile.TemporaryDirectory() as tmpdir:
+    path = tmpdir + "/notasocket"
+    with open(path, 'w') as f:
+        f.write("data")
+    source = SocketIn({"module": "sources.SocketIn",
+        "listen": ["unix:" + path]}, None, {})
+    try:
+        list(source.run())
+        assert False, "expected UserError"
+    except SentryModule.UserError:
+        pass
+    with open(path) as f:
+        assert f.read() == "data"
+
+print("SocketIn test passed")
+
+
+####################################################################
+# Test 22: ConsumerLag catch-up mode hysteresis
+
+lag = SentryModule.ConsumerLag(100)
+# (message time, now, expected catchup, expected change)
+for msg_time, now, catchup, changed in [
+        (1000, 1050, False, False),
+        (1000, 1100, False, False), # not above threshold
+        (1000, 1101, True, True),
+        (1000, 1150, True, False),
+        (1000, 1060, True, False),  # below threshold, but not below half
+        (1000, 1050, True, False),  # not below half
+        (1000, 1049, False, True),
+        (1000, 1090, False, False),
+        (2000, 2200, True, True)]:
+    assert lag.update(msg_time, now) == changed
+    assert lag.catchup == catchup and lag.lag == now - msg_time
+
+lag = SentryModule.ConsumerLag(None) # catch-up mode disabled
+assert not lag.update(0, 10**6) and not lag.catchup and lag.lag == 10**6
+
+print("ConsumerLag test passed")
+
+
 ####################################################################
 print("All tests passed.")
@@ -0,0 +1,210 @@
+"""
+Compact columnar binary file format for (key, value, time) tuples.
+
+All integers are little-endian.  A file consists of:
+
+    header:   magic "WTSB", uint32 version
+    blocks:   a sequence of blocks of up to blocksize tuples each.  Each block
+              contains three arrays, each starting on an 8-byte boundary:
+                  key ids:  uint32[n]   (indexes into the key dictionary)
+                  times:    int64[n]
+                  values:   int64[n*max(w,1)] or float64[n*max(w,1)]
+              where w is the block's value width: 0 for scalar values, or the
+              length of the tuple for multi-value data points (e.g. the
+              (ratio, actual, predicted) triples from MovingStat).  In float64
+              blocks, null values are stored as NaN.
+    footer:   key dictionary: uint32 nkeys, then for each key, a uint16
+                  length followed by the key bytes;
+              block index (8-byte aligned): uint32 nblocks, uint32 padding,
+                  then one BLOCK_INDEX entry per block, containing the block's
+                  offset, number of tuples, value type, value width, and
+                  minimum and maximum times (used to seek to a time range
+                  without reading blocks outside the range).
+    trailer:  uint64 footer offset, magic "WTSB", uint32 padding
+
+Tuples are stored in the order they were written.  Within a block, values
+are stored as int64 if every value is an int (and not null), otherwise as
+float64; so an int value in a block that also contains a float or null value
+will be read back as a float.
+"""
+
+import array
+import mmap
+import struct
+import sys
+
+MAGIC = b'WTSB'
+VERSION = 1
+HEADER = struct.Struct('<4sI')
+TRAILER = struct.Struct('<Q4sI')
+BLOCK_INDEX = struct.Struct('<QIBBHqq') # offset, n, vtype, width, pad, tmin, tmax
+COUNT = struct.Struct('<II')
+KEYLEN = struct.Struct('<H')
+
+VTYPE_INT = ord('q')
+VTYPE_FLOAT = ord('d')
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+NAN = float('nan')
+
+
+def _pad8(f, pos):
+    """Write zeros to f to advance pos to a multiple of 8; return new pos."""
+    pad = -pos % 8
+    if pad:
+        f.write(b'\0' * pad)
+    return pos + pad
+
+
+class Writer:
+    """Writes (key, value, time) tuples to a binary file.  The file is not
+    readable until close() has written the footer."""
+
+    def __init__(self, filename, blocksize):
+        self.f = open(filename, 'wb')
+        self.blocksize = blocksize
+        self.key_ids = dict()   # key_ids[key] = index in key dictionary
+        self.block_index = []
+        self.pos = self.f.write(HEADER.pack(MAGIC, VERSION))
+        self.pos = _pad8(self.f, self.pos)
+        self._clear_block()
+
+    def _clear_block(self):
+        self.b_kids = array.array('I')
+        self.b_times = array.array('q')
+        self.b_values = []
+        self.b_width = None
+
+    def write(self, key, value, t):
+        width = len(value) if isinstance(value, tuple) else 0
+        if width != self.b_width:
+            self.flush_block()
+            self.b_width = width
+        kid = self.key_ids.get(key)
+        if kid is None:
+            kid = self.key_ids[key] = len(self.key_ids)
+        self.b_kids.append(kid)
+        self.b_times.append(t)
+        if width == 0:
+            self.b_values.append(value)
+        else:
+            self.b_values.extend(value)
+        if len(self.b_kids) >= self.blocksize:
+            self.flush_block()
+
+    def _values_array(self):
+        values = self.b_values
+        if all(type(v) is int and INT64_MIN <= v <= INT64_MAX
+                for v in values):
+            return VTYPE_INT, array.array('q', values)
+        return VTYPE_FLOAT, array.array('d',
+            [NAN if v is None else v for v in values])
+
+    def flush_block(self):
+        n = len(self.b_kids)
+        if n == 0:
+            return
+        vtype, values = self._values_array()
+        offset = self.pos
+        self.pos += self.f.write(self.b_kids.tobytes())
+        self.pos = _pad8(self.f, self.pos)
+        self.pos += self.f.write(self.b_times.tobytes())
+        self.pos += self.f.write(values.tobytes())
+        self.block_index.append((offset, n, vtype, self.b_width, 0,
+            min(self.b_times), max(self.b_times)))
+        self._clear_block()
+
+    def close(self):
+        self.flush_block()
+        footer_pos = self.pos
+        write = self.f.write
+        self.pos += write(struct.pack('<I', len(self.key_ids)))
+        for key in self.key_ids: # dict preserves insertion (i.e. id) order
+            self.pos += write(KEYLEN.pack(len(key)))
+            self.pos += write(key)
+        self.pos = _pad8(self.f, self.pos)
+        self.pos += write(COUNT.pack(len(self.block_index), 0))
+        for entry in self.block_index:
+            self.pos += write(BLOCK_INDEX.pack(*entry))
+        write(TRAILER.pack(footer_pos, MAGIC, 0))
+        self.f.close()
+
+
+class Reader:
+    """Reads (key, value, time) tuples from a memory-mapped binary file.
+    Arrays are read in place from the mapping, without copying (except on
+    big-endian hosts, where they must be byte-swapped)."""
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mv = memoryview(self.mm)
+        self.mv = mv
+        if len(mv) < HEADER.size + TRAILER.size or \
+                HEADER.unpack_from(mv, 0) != (MAGIC, VERSION):
+            raise ValueError("%s: not a binary time series file (version %d)"
+                % (filename, VERSION))
+        footer_pos, magic, _ = TRAILER.unpack_from(mv, len(mv) - TRAILER.size)
+        if magic != MAGIC:
+            raise ValueError("%s: truncated binary time series file"
+                % filename)
+        pos = footer_pos
+        nkeys, = struct.unpack_from('<I', mv, pos)
+        pos += 4
+        self.keys = []
+        for _ in range(nkeys):
+            klen, = KEYLEN.unpack_from(mv, pos)
+            pos += KEYLEN.size
+            self.keys.append(bytes(mv[pos:pos+klen]))
+            pos += klen
+        pos += -pos % 8
+        nblocks, _ = COUNT.unpack_from(mv, pos)
+        pos += COUNT.size
+        self.block_index = [BLOCK_INDEX.unpack_from(mv, pos + i * BLOCK_INDEX.size)
+            for i in range(nblocks)]
+
+    def _array(self, pos, nbytes, fmt):
+        if sys.byteorder == 'little':
+            return self.mv[pos:pos+nbytes].cast(fmt)
+        a = array.array(fmt)
+        a.frombytes(self.mv[pos:pos+nbytes])
+        a.byteswap()
+        return a
+
+    def _block(self, offset, n, vtype, width):
+        kids = self._array(offset, 4 * n, 'I')
+        pos = offset + 4 * n
+        pos += -pos % 8
+        times = self._array(pos, 8 * n, 'q')
+        pos += 8 * n
+        values = self._array(pos, 8 * n * max(width, 1), chr(vtype))
+        if vtype == VTYPE_FLOAT:
+            # NaN represents null
+            values = [None if v != v else v for v in values]
+        if width > 0:
+            values = [tuple(values[i:i+width])
+                for i in range(0, n * width, width)]
+        return kids, values, times
+
+    def read(self, start=None, end=None):
+        """Generate (key, value, time) tuples with start <= time < end."""
+        keys = self.keys
+        for offset, n, vtype, width, _, tmin, tmax in self.block_index:
+            if (start is not None and tmax < start) or \
+                    (end is not None and tmin >= end):
+                continue # block is entirely outside of time range
+            kids, values, times = self._block(offset, n, vtype, width)
+            if (start is None or tmin >= start) and \
+                    (end is None or tmax < end):
+                # block is entirely inside time range
+                for kid, value, t in zip(kids, values, times):
+                    yield (keys[kid], value, t)
+            else:
+                for kid, value, t in zip(kids, values, times):
+                    if (start is None or t >= start) and \
+                            (end is None or t < end):
+                        yield (keys[kid], value, t)
+
+    def close(self):
+        self.mv.release()
+        self.mm.close()
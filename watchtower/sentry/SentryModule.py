@@ -10,6 +10,13 @@ that yields (key, value, time) tuples.
 Filters and sinks must implement run(self) as function that reads
 (key, value, time) tuples by iterating over the gen() generator.
 The module should do any necessary cleanup in a `finally` clause in run().
+
+In addition to data, the stream may contain out-of-band markers (see
+HEARTBEAT and WATERMARK below) in the form (None, kind, time).  Filters must pass markers
+through (possibly after acting on them), and sinks must ignore them.
+
+A module can make its per-key state queryable over HTTP by implementing
+new_state_keys() and key_state() (see StateServer).
 """
 
 import calendar
@@ -34,6 +41,19 @@ class UserError(RuntimeError):
     pass
 
 
+# Marker kinds.  A marker is an entry of the form (None, kind, time).
+# HEARTBEAT: the source is idle; time is the current wall-clock time.  This
+#   gives modules with wall-clock timeouts a chance to act while no data is
+#   arriving.
+HEARTBEAT = 'heartbeat'
+# WATERMARK: no more data with a time earlier than the marker's time will
+#   follow.  This lets modules that wait for all the data for a time (e.g.,
+#   AggSum, TimeOrder) finish that time immediately instead of waiting for a
+#   timeout.  Modules that reorder or aggregate data should pass a watermark
+#   through only after all their output for earlier times.
+WATERMARK = 'watermark'
+
+
 class SentryModule:
     def __init__(self, config, logger, gen):
         if 'loglevel' in config:
@@ -47,6 +67,36 @@ class Source(SentryModule):
 class Sink(SentryModule):
     pass
 
+
+class ConsumerLag:
+    """Consumer lag (wall time minus message time) of a live source.
+
+    A source that can fall behind real time stores an instance in ctx['lag'],
+    where downstream modules can check `catchup` to trade latency for
+    throughput.  Catch-up mode starts when lag exceeds `threshold` and ends
+    when it falls below half of `threshold`, so that we don't flap between
+    modes when lag hovers around the threshold.  A threshold of None disables
+    catch-up mode; lag is still tracked.
+    """
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.lag = None
+        self.catchup = False
+
+    # Returns True if the catch-up mode changed.
+    def update(self, msg_time, now):
+        self.lag = now - msg_time
+        if self.threshold is None:
+            return False
+        if self.catchup:
+            if self.lag < self.threshold / 2:
+                self.catchup = False
+                return True
+        elif self.lag > self.threshold:
+            self.catchup = True
+            return True
+        return False
+
 # Convert a time string in 'YYYY-mm-dd [HH:MM[:SS]]' format (in UTC) to a
 # unix timestamp
 def strtimegm(s):
@@ -0,0 +1,241 @@
+"""
+Embedded HTTP server for querying the per-key state of a running pipeline.
+
+Enabled by the top-level "stateserver" config parameter:
+    listen*: (string) Address to listen on, in the form "HOST:PORT".
+    maxresults: (integer, default 1000) Max number of keys in a response.
+    timeout: (number, default 10) Max time (in seconds) to wait for the
+        pipeline to answer a query.
+
+Queries:
+    GET /state?key=KEY
+        State of KEY in each module that has state for it.
+    GET /state?glob=PATTERN[&window=1]
+        State of all keys that match the DBATS-style glob PATTERN, or that
+        have a prefix (ending at a '.') that matches it.  E.g., "geo.US" and
+        "geo.*" both match "geo.US.up_cnt".
+    Add window=1 to include the history window of each key.
+The response is a JSON object {"keys": {KEY: {MODULE: STATE}}, "truncated":
+BOOLEAN}, where truncated is true if more than maxresults keys matched.
+MODULE is the module name (followed by "#2", "#3", ... for later modules of
+the same name).
+
+A module exposes its state by implementing:
+    new_state_keys(): return a list of the keys the module has started
+        tracking since the previous call
+    key_state(key, window): return a JSON-serializable summary of the state
+        of key (including the history window if window is true), or None if
+        the module has no state for key
+Module state is only consistent between tuples, so the server never reads it
+directly.  Instead, the server thread queues a call, and the pipeline thread
+runs it the next time the source produces an entry (at which point every
+other module is waiting for input).  This costs the pipeline one check per
+entry while there are no queries.  While the source is idle, queries wait for
+the next entry, so a source heartbeat should be configured.  The index of
+keys (a trie) is kept by the server threads, so large result sets and new
+keys cost the pipeline little.
+"""
+
+import http.server
+import json
+import logging
+import re
+import threading
+import urllib.parse
+from . import SentryModule
+
+logger = logging.getLogger(__name__)
+
+cfg_schema = {
+    "type": "object",
+    "properties": {
+        "listen":     {"type": "string"},
+        "maxresults": {"type": "integer", "exclusiveMinimum": 0},
+        "timeout":    {"type": "number", "exclusiveMinimum": 0},
+    },
+    "additionalProperties": False,
+    "required": ["listen"],
+}
+
+
+class KeyTrie:
+    """Index of keys by their '.'-separated components"""
+
+    def __init__(self):
+        # Each node is a dict mapping a component to a child node; the
+        # entry for None (if any) is the key that ends at the node.
+        self.root = dict()
+
+    def add(self, key):
+        node = self.root
+        for part in key.split(b'.'):
+            child = node.get(part)
+            if child is None:
+                child = node[part] = dict()
+            node = child
+        node[None] = key
+
+    def match(self, glob, limit):
+        """Return a list of up to limit keys that match glob or have a
+        prefix that matches glob, and whether there were more."""
+        nodes = [self.root]
+        for part in glob.split('.'):
+            if not any(c in part for c in '*?[]{}\\'):
+                part = bytes(part, 'ascii')
+                nodes = [node[part] for node in nodes if part in node]
+                continue
+            regex = re.compile(bytes(SentryModule.glob_to_regex(part),
+                'ascii'))
+            nodes = [child for node in nodes
+                for name, child in node.items()
+                if name is not None and regex.match(name)]
+        keys = []
+        while nodes:
+            node = nodes.pop()
+            for name, child in node.items():
+                if name is None:
+                    if len(keys) == limit:
+                        return keys, True
+                    keys.append(child)
+                else:
+                    nodes.append(child)
+        return keys, False
+
+
+class StateServer:
+    def __init__(self, config):
+        self.maxresults = config.get('maxresults', 1000)
+        self.timeout = config.get('timeout', 10)
+        host, sep, port = config['listen'].rpartition(':')
+        if not sep or not port.isdigit():
+            raise SentryModule.UserError("stateserver: invalid listen "
+                "address %r" % config['listen'])
+        self.address = (host.strip('[]'), int(port))
+        self.modules = [] # (label, module)
+        self.calls = [] # calls queued for the pipeline thread
+        self.new_keys = [] # lists of keys not yet added to trie
+        self.trie = KeyTrie()
+        self.trie_lock = threading.Lock()
+        self.httpd = None
+
+    def register(self, module):
+        labels = [label for label, m in self.modules]
+        label = module.modname
+        n = 1
+        while label in labels:
+            n += 1
+            label = "%s#%d" % (module.modname, n)
+        self.modules.append((label, module))
+
+    def wrap(self, gen):
+        """Return a generator function that yields the entries of gen(), and
+        runs queued calls between them."""
+        calls = self.calls
+        def wrapper():
+            for entry in gen():
+                if calls:
+                    self._run_calls()
+                yield entry
+        return wrapper
+
+    def _run_calls(self):
+        # in the pipeline thread
+        while self.calls:
+            call = self.calls.pop(0)
+            try:
+                call['result'] = call['fn']()
+            except Exception as e:
+                call['error'] = e
+            call['done'].set()
+
+    def _call(self, fn):
+        """Run fn() in the pipeline thread, and return its result."""
+        call = {'fn': fn, 'done': threading.Event()}
+        self.calls.append(call)
+        if not call['done'].wait(self.timeout):
+            raise TimeoutError("pipeline did not respond within %ss "
+                "(is the source idle?)" % self.timeout)
+        if 'error' in call:
+            raise call['error']
+        return call['result']
+
+    def _collect_keys(self):
+        # in the pipeline thread.  The keys are stored here instead of
+        # returned, so they're not lost if the caller has timed out.
+        for label, module in self.modules:
+            self.new_keys.append(module.new_state_keys())
+
+    def _states(self, keys, window):
+        # in the pipeline thread
+        result = dict()
+        for key in keys:
+            states = dict()
+            for label, module in self.modules:
+                state = module.key_state(key, window)
+                if state is not None:
+                    states[label] = state
+            if states:
+                result[str(key, 'ascii')] = states
+        return result
+
+    def query(self, key=None, glob=None, window=False):
+        truncated = False
+        if key is not None:
+            keys = [bytes(key, 'ascii')]
+        else:
+            self._call(self._collect_keys)
+            with self.trie_lock:
+                while self.new_keys:
+                    for k in self.new_keys.pop(0):
+                        self.trie.add(k)
+                keys, truncated = self.trie.match(glob, self.maxresults)
+        states = self._call(lambda: self._states(keys, window))
+        return {"keys": states, "truncated": truncated}
+
+    def start(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                params = urllib.parse.parse_qs(url.query)
+                key = params.get('key', [None])[0]
+                glob = params.get('glob', [None])[0]
+                window = params.get('window', ['0'])[0] not in ('0', '')
+                if url.path != '/state':
+                    self.send_error(404)
+                    return
+                if (key is None) == (glob is None):
+                    self.send_error(400, "expected key or glob parameter")
+                    return
+                try:
+                    result = server.query(key, glob, window)
+                except (UnicodeError, SentryModule.UserError) as e:
+                    self.send_error(400, str(e))
+                    return
+                except TimeoutError as e:
+                    self.send_error(503, str(e))
+                    return
+                body = bytes(json.dumps(result), 'ascii')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                logger.debug("%s %s", self.address_string(), fmt % args)
+
+        self.httpd = http.server.ThreadingHTTPServer(self.address, Handler)
+        self.httpd.daemon_threads = True
+        thread = threading.Thread(target=self.httpd.serve_forever,
+            daemon=True, name="StateServer")
+        thread.start()
+        logger.info("StateServer: listening on %s:%d",
+            *self.httpd.server_address[:2])
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
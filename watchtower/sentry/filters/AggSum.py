@@ -1,4 +1,4 @@
-"""Filter that sums values across a group of keys.
+"""Filter that aggregates (e.g., sums) values across a group of keys.
 
 Configuration parameters ('*' indicates required parameter):
     expressions*: (array) An array of DBATS-style glob patterns that input keys must
@@ -13,18 +13,53 @@ Configuration parameters ('*' indicates required parameter):
     droppartial: (boolean) If this is set, then groups with fewer than
         {groupsize} datapoints after {timeout} seconds should be dropped
         rather than generating output.
+    functions: (array) Aggregate functions to calculate, in a single pass
+        over the same per-group state:
+            sum        sum of non-null values
+            count      number of non-null values
+            mean       mean of non-null values (null if there are none)
+            min        minimum non-null value (null if there are none)
+            max        maximum non-null value (null if there are none)
+            nullcount  number of null values
+        If omitted, only the sum is calculated, and it is output under the
+        group's key.  Otherwise, each aggregate is output under the group's
+        key with ".{function}" appended.
+    rollup: (boolean) If set, also aggregate at every coarser level of the
+        hierarchy defined by the parenthesized subexpressions, by dropping
+        them one at a time from the right.  For example, with expression
+        "x.(*).(*).*", input key "x.EU.DE.p1" contributes to output keys
+        "x.EU.DE.*" and "x.EU.*.*" (a dropped subexpression's glob text
+        appears in the output key).  Each level is aggregated from the
+        completed aggregates of the level below it, not from the raw inputs,
+        so the per-input cost does not depend on the number of levels.  A
+        coarser aggregate is complete when it has results from all the
+        child groups that have been seen so far, or when {timeout} seconds
+        have passed since the first of them; it is partial if any of its
+        children was partial or missing.  (Since the set of children is
+        learned from the input, a coarser aggregate for a time at which a new
+        child group first appeared is held until one of its child groups
+        completes a later time, in case more new child groups appear.)
 
 Input:  (key, value, time)
 
 Output:  (key, value, time)
     key is generated from {expression}, with parenthesized groups replaced
-        with the matching part of the input key.
-    value is the sum of values for all inputs with the same time and whose key
-        maps to the same output key.
+        with the matching part of the input key (and the function name
+        appended, if {functions} is set).
+    value is the aggregate of values for all inputs with the same time and
+        whose key maps to the same output key.
     time is the same as input time.
+
+Timeouts are evaluated whenever input arrives, including heartbeat markers,
+so a source that emits heartbeats allows partial aggregates to be flushed
+even while no data is arriving.  A watermark marker completes all aggregates
+for times before the watermark immediately (finest groups first, so rollups
+complete too); such an aggregate is partial only if it has fewer than
+{groupsize} inputs or is missing a child group.
 """
 import logging
-from collections import OrderedDict
+import heapq
+import itertools
 import re
 import time
 from .. import SentryModule
@@ -41,18 +76,72 @@ add_cfg_schema = {
         "groupsize":   {"type": "integer", "exclusiveMinimum": 0},
         "timeout":     {"type": "integer", "exclusiveMinimum": 0},
         "droppartial": {"type": "boolean"},
+        "rollup":      {"type": "boolean"},
+        "functions": {
+            "type": "array",
+            "items": {"enum": ["sum", "count", "mean", "min", "max",
+                               "nullcount"]},
+            "minItems": 1,
+            "uniqueItems": True
+        },
     },
     "required": ["expressions", "timeout"]
 }
 
+# Functions that calculate an aggregate from an _Agginfo
+agg_functions = {
+    "sum":       lambda a: a.vsum,
+    "count":     lambda a: a.vcount,
+    "mean":      lambda a: a.vsum / a.vcount if a.vcount else None,
+    "min":       lambda a: a.vmin,
+    "max":       lambda a: a.vmax,
+    "nullcount": lambda a: a.nulls,
+}
+
 class AggSum(SentryModule.SentryModule):
 
     class _Agginfo:
         """Intermediate results of aggregation"""
+        __slots__ = ('first_seen', 'count', 'vcount', 'nulls', 'vsum',
+                     'vmin', 'vmax', 'partial')
         def __init__(self, first_seen, count, vsum):
             self.first_seen = first_seen
+            # number of inputs (including nulls), or, for a rollup group, the
+            # number of child aggregates
             self.count = count
+            self.vcount = 0     # number of non-null values
+            self.nulls = 0      # number of null values
             self.vsum = vsum
+            self.vmin = None
+            self.vmax = None
+            self.partial = False # a child aggregate was partial
+
+        def merge(self, other):
+            """Add the results of a child aggregate"""
+            self.count += 1
+            self.vcount += other.vcount
+            self.nulls += other.nulls
+            self.vsum += other.vsum
+            if other.vmin is not None and \
+                    (self.vmin is None or other.vmin < self.vmin):
+                self.vmin = other.vmin
+            if other.vmax is not None and \
+                    (self.vmax is None or other.vmax > self.vmax):
+                self.vmax = other.vmax
+
+    class _Group:
+        """State of an aggregation group"""
+        __slots__ = ('key', 'fkeys', 'aggs', 'times', 'old', 'parent',
+                     'nchildren', 'new_child_t')
+        def __init__(self, key, fkeys, parent):
+            self.key = key      # output key
+            self.fkeys = fkeys  # output keys for functions
+            self.aggs = dict()  # aggs[t] = agginfo
+            self.times = []     # heap of times in aggs (may have extras)
+            self.old = None     # time of most recent complete or expired data
+            self.parent = parent # next coarser group, if rolling up
+            self.nchildren = 0  # number of child groups seen, if rolling up
+            self.new_child_t = None # time at which last new child appeared
 
     def __init__(self, config, gen, ctx):
         logger.debug("AggSum.__init__")
@@ -62,141 +151,248 @@ class AggSum(SentryModule.SentryModule):
         self.timeout = config['timeout']
         self.groupsize = config.get('groupsize', None)
         self.droppartial = config.get('droppartial', False)
+        self.functions = config.get('functions', None)
+        self.minmax = bool(self.functions and
+            ('min' in self.functions or 'max' in self.functions))
+        self.rollup = config.get('rollup', False)
 
-        # agg_by_group is a 3-level dict that stores agginfo keyed by expression,
-        # groupid, then timestamp, so it's easy to find all agginfos for a given group.
-        self.agg_by_group = dict()
-        for ascii_exp in self.ascii_expressions:
-            self.agg_by_group[ascii_exp] = dict()
+        # Output key templates: the literal parts of each expression between
+        # its parenthesized subexpressions, and the glob text inside them.
+        self.templates = []
+        self.globtexts = []
+        for exp in self.ascii_expressions:
+            parts = re.split(rb"\(([^)]*)\)", exp)
+            self.templates.append(parts[0::2])
+            self.globtexts.append(parts[1::2])
 
-        # agg_by_seen stores agginfo keyed by (expression, groupid, t) and
-        # ordered by first_seen, so it's easy to find all stale agginfos.
-        self.agg_by_seen = OrderedDict()
+        # groups[i][groupid] is the _Group for expression i and groupid.
+        # (When rolling up, groupid may be a prefix of the full groupid.)
+        self.groups = [dict() for exp in self.expressions]
 
-        # old_keys stores the timestamp of the most recent complete or
-        # expired data for each group
-        self.old_keys = dict()
-        for ascii_exp in self.ascii_expressions:
-            self.old_keys[ascii_exp] = dict()
+        # deadlines is a heap of (deadline, seq, group, t, agginfo), so it's
+        # easy to find all stale agginfos.  Entries for agginfos that have
+        # already been completed are skipped when they reach the top.
+        self.deadlines = []
+        self.seq = itertools.count()
 
         regexes = [SentryModule.glob_to_regex(exp) for exp in self.expressions]
         logger.debug("expressions: %s", self.expressions)
         logger.debug("regexes:      %s", regexes)
         self.expression_res = [re.compile(bytes(r, 'ascii')) for r in regexes]
 
-    # replace parens in expression with group id
-    # (this could be optimized by pre-splitting expression)
-    def groupkey(self, groupkey, groupid):
-        for part in groupid:
-            groupkey = re.sub(rb"\([^)]*\)", part, groupkey, count=1)
-        return groupkey
-
-    def _expire_oldtimes(self, ascii_exp, groupkey, groupid, max_t):
-        logger.debug("Expiring old data for (%s, %s) with t < %d. "
-                     "Currently tracking: %r" %
-                     (ascii_exp, groupid, max_t,
-                      self.agg_by_group[ascii_exp][groupid]))
-        oldtimes = sorted([oldtime for oldtime in
-                           self.agg_by_group[ascii_exp][groupid].keys() if oldtime < max_t])
-        for oldtime in oldtimes:
-            old_agginfo = self.agg_by_group[ascii_exp][groupid][oldtime]
+    # replace parens in expression with group id (or, for a rollup groupid
+    # with fewer parts, with the glob text inside the remaining parens)
+    def groupkey(self, idx, groupid):
+        template = self.templates[idx]
+        globtext = self.globtexts[idx]
+        parts = [template[0]]
+        for i, literal in enumerate(template[1:]):
+            parts.append(groupid[i] if i < len(groupid) else globtext[i])
+            parts.append(literal)
+        return b''.join(parts)
+
+    def _get_group(self, idx, groupid, t):
+        group = self.groups[idx].get(groupid)
+        if group is None:
+            key = self.groupkey(idx, groupid)
+            fkeys = None
+            if self.functions:
+                fkeys = [key + b'.' + bytes(f, 'ascii')
+                    for f in self.functions]
+            parent = None
+            if self.rollup and len(groupid) > 1:
+                parent = self._get_group(idx, groupid[:-1], t)
+                parent.nchildren += 1
+                if parent.new_child_t is None or t > parent.new_child_t:
+                    parent.new_child_t = t
+            group = AggSum._Group(key, fkeys, parent)
+            self.groups[idx][groupid] = group
+        return group
+
+    def _new_agginfo(self, group, t, now):
+        agginfo = AggSum._Agginfo(first_seen=now, count=0, vsum=0)
+        group.aggs[t] = agginfo
+        heapq.heappush(group.times, t)
+        heapq.heappush(self.deadlines,
+            (now + self.timeout, next(self.seq), group, t, agginfo))
+        return agginfo
+
+    def _roll_up(self, group, t, agginfo):
+        """Merge a completed or expired aggregate into its parent group, and
+        complete the parent if all its children are done"""
+        parent = group.parent
+        if parent.old is not None and t < parent.old:
+            logger.warning("unexpected data for old aggregate (%r, %d) "
+                           "from %s", parent.key, t, group.key)
+            return
+        # A child has moved on to time t, so no more new children will
+        # appear for earlier times; complete any earlier aggregates that
+        # were held only because of a new child.
+        times = parent.times
+        while times and times[0] < t:
+            oldtime = times[0]
+            old_pagg = parent.aggs.get(oldtime)
+            if old_pagg is None:
+                heapq.heappop(times) # already completed
+                continue
+            if old_pagg.count < parent.nchildren:
+                break
+            logger.debug("rollup complete for %r", (parent.key, oldtime))
+            yield from self._complete(parent, oldtime, old_pagg,
+                old_pagg.partial)
+        pagg = parent.aggs.get(t)
+        if pagg is None:
+            pagg = self._new_agginfo(parent, t, time.time())
+        pagg.merge(agginfo)
+        pagg.partial |= agginfo.partial
+        if pagg.count >= parent.nchildren and t > parent.new_child_t:
+            logger.debug("rollup complete for %r", (parent.key, t))
+            yield from self._complete(parent, t, pagg, pagg.partial)
+
+    def _results(self, group, agginfo, t):
+        """Generate output for a completed or expired aggregate"""
+        if not self.functions:
+            yield (group.key, agginfo.vsum, t)
+            return
+        for f, key in zip(self.functions, group.fkeys):
+            yield (key, agg_functions[f](agginfo), t)
+
+    def _expire_oldtimes(self, group, max_t):
+        logger.debug("Expiring old data for %s with t < %d. "
+                     "Currently tracking: %r", group.key, max_t, group.aggs)
+        times = group.times
+        while times and times[0] < max_t:
+            oldtime = heapq.heappop(times)
+            old_agginfo = group.aggs.pop(oldtime, None)
+            if old_agginfo is None:
+                continue # already completed
             logger.debug("giving up on %r with %d/%d items",
-                         (groupid, oldtime), old_agginfo.count,
+                         (group.key, oldtime), old_agginfo.count,
                          self.groupsize)
-            if not self.droppartial:
-                yield (groupkey, old_agginfo.vsum, oldtime)
-            del self.agg_by_group[ascii_exp][groupid][oldtime]
-            del self.agg_by_seen[(ascii_exp, groupid, oldtime)]
+            if group.nchildren:
+                old_agginfo.partial |= old_agginfo.count < group.nchildren
+            else:
+                old_agginfo.partial = True
+            if not old_agginfo.partial or not self.droppartial:
+                yield from self._results(group, old_agginfo, oldtime)
+            if group.parent:
+                yield from self._roll_up(group, oldtime, old_agginfo)
 
-    def _is_old(self, ascii_exp, groupid, t):
-        return groupid in self.old_keys[ascii_exp] \
-               and t < self.old_keys[ascii_exp][groupid]
+    def _complete(self, group, t, agginfo, partial):
+        """Generate output for group at time t, after expiring any older
+        partial data for the group"""
+        del group.aggs[t]
+        # Assume that data for a given key will always arrive in time order.
+        # Then, if we have all the data for a group at time t, but we are
+        # missing data for that group at some earlier time, we can assume
+        # that old data will never arrive, and we can generate the old
+        # result.  (Note: if we didn't do this, then in order to preserve
+        # timestamp order for this group's results, we would have to defer
+        # outputting this aggregate until older aggregates for this group
+        # time out.)
+        yield from self._expire_oldtimes(group, t)
+        # now yield this data point (if it's complete or we want partial data)
+        agginfo.partial = partial
+        if not partial or not self.droppartial:
+            yield from self._results(group, agginfo, t)
+        # and update the old pointer
+        if group.old is None or t > group.old:
+            group.old = t
+        if group.parent:
+            yield from self._roll_up(group, t, agginfo)
 
-    def _update_oldkeys(self, ascii_exp, groupid, t):
-        if groupid not in self.old_keys[ascii_exp] \
-                or t > self.old_keys[ascii_exp][groupid]:
-            self.old_keys[ascii_exp][groupid] = t
+    def _expire_timeouts(self, now):
+        deadlines = self.deadlines
+        while deadlines and deadlines[0][0] <= now:
+            _, _, group, t, agginfo = heapq.heappop(deadlines)
+            if group.aggs.get(t) is not agginfo:
+                continue # already completed
+            logger.debug("reached timeout for %r with %d/%d items",
+                (group.key, t), agginfo.count,
+                group.nchildren or self.groupsize)
+            partial = agginfo.partial or agginfo.count < group.nchildren \
+                if group.nchildren else True
+            yield from self._complete(group, t, agginfo, partial)
+
+    def _expire_watermark(self, watermark):
+        # Rollup groups have shorter groupids than their children, so
+        # completing groups in order of decreasing groupid length completes
+        # all children of a group (which may add aggregates to the group)
+        # before the group itself.
+        groups = sorted(((len(groupid), group)
+            for groups in self.groups for groupid, group in groups.items()),
+            key=lambda item: -item[0])
+        for _, group in groups:
+            times = group.times
+            while times and times[0] < watermark:
+                t = heapq.heappop(times)
+                agginfo = group.aggs.get(t)
+                if agginfo is None:
+                    continue # already completed
+                logger.debug("reached watermark for %r with %d items",
+                    (group.key, t), agginfo.count)
+                if group.nchildren:
+                    partial = agginfo.partial or \
+                        agginfo.count < group.nchildren
+                else:
+                    partial = bool(self.groupsize) and \
+                        agginfo.count < self.groupsize
+                yield from self._complete(group, t, agginfo, partial)
 
     def run(self):
         logger.debug("AggSum.run()")
+        groupsize = self.groupsize
+        minmax = self.minmax
         for entry in self.gen():
             logger.debug("AG: %s", entry)
             key, value, t = entry
-            match = False
-            ascii_exp = None
+            if key is None: # marker
+                if value == SentryModule.WATERMARK:
+                    yield from self._expire_watermark(t)
+                yield from self._expire_timeouts(time.time())
+                yield entry
+                continue
             for idx, exp_re in enumerate(self.expression_res):
                 match = exp_re.match(key)
                 if match:
-                    ascii_exp = self.ascii_expressions[idx]
                     break
-            if not match:
+            else:
                 continue
             groupid = match.groups()
-            aggkey = (ascii_exp, groupid, t)
+            group = self.groups[idx].get(groupid)
+            if group is None:
+                group = self._get_group(idx, groupid, t)
 
             now = time.time()
 
-            agginfo = None
-            if self._is_old(ascii_exp, groupid, t):
+            if group.old is not None and t < group.old:
                 logger.error("unexpected data for old aggregate (%r, %d) "
                              "from %s", groupid, t, key)
                 continue
-            elif groupid in self.agg_by_group[ascii_exp]:
-                if t in self.agg_by_group[ascii_exp][groupid]:
-                    agginfo = self.agg_by_group[ascii_exp][groupid][t]
-            else:
-                self.agg_by_group[ascii_exp][groupid] = dict()
-            if not agginfo:
-                agginfo = AggSum._Agginfo(first_seen=now, count=0, vsum=0)
-                self.agg_by_group[ascii_exp][groupid][t] = agginfo
-                self.agg_by_seen[(ascii_exp, groupid, t)] = agginfo
+            agginfo = group.aggs.get(t)
+            if agginfo is None:
+                agginfo = self._new_agginfo(group, t, now)
 
             agginfo.count += 1
-            if value is not None:
+            if value is None:
+                agginfo.nulls += 1
+            else:
+                agginfo.vcount += 1
                 agginfo.vsum += value
+                if minmax:
+                    if agginfo.vmin is None or value < agginfo.vmin:
+                        agginfo.vmin = value
+                    if agginfo.vmax is None or value > agginfo.vmax:
+                        agginfo.vmax = value
 
-            logger.debug("ae=%s, k=%r, v=%r, t=%d; count=%d, vsum=%s",
-                         ascii_exp, groupid, value, t, agginfo.count,
-                         agginfo.vsum)
+            logger.debug("k=%r, v=%r, t=%d; count=%d, vsum=%s",
+                         group.key, value, t, agginfo.count, agginfo.vsum)
 
-            if self.groupsize and agginfo.count == self.groupsize:
-                groupkey = self.groupkey(ascii_exp, groupid)
+            if groupsize and agginfo.count == groupsize:
                 logger.debug("reached groupsize for %r after %ds",
-                    aggkey, now - agginfo.first_seen)
-                del self.agg_by_group[ascii_exp][groupid][t]
-                del self.agg_by_seen[(ascii_exp, groupid, t)]
-
-                # Assume that data for a given key will always arrive in time
-                # order.  Then, if we have all the data for a group at time t,
-                # but we are missing data for that group at some earlier time,
-                # we can assume that old data will never arrive, and we can
-                # generate the old result.  (Note: if we didn't do this, then
-                # in order to preserve timestamp order for this group's
-                # results, we would have to defer outputting this aggregate
-                # until older aggregates for this group time out.)
-                yield from self._expire_oldtimes(ascii_exp, groupkey, groupid, t)
-                # now yield this data point
-                yield (groupkey, agginfo.vsum, t)
-                # and update the old_keys pointer
-                self._update_oldkeys(ascii_exp, groupid, t)
-
-            expiry_time = now - self.timeout
-            while self.agg_by_seen:
-                aggkey, agginfo = next(iter(self.agg_by_seen.items()), None)
-                if agginfo.first_seen > expiry_time:
-                    break
-                self.agg_by_seen.popitem(False)
-                ascii_exp, groupid, t = aggkey
-                del self.agg_by_group[ascii_exp][groupid][t]
-                groupkey = self.groupkey(ascii_exp, groupid)
-                logger.debug("reached timeout for %r with %d/%d items",
-                    aggkey, agginfo.count, self.groupsize)
-                # expire any other partial data prior to this time
-                yield from self._expire_oldtimes(ascii_exp, groupkey, groupid, t)
-                # and now yield this point (if we want partial data)
-                if not self.droppartial:
-                    yield (groupkey, agginfo.vsum, t)
-                # and then update the old_keys pointer
-                self._update_oldkeys(ascii_exp, groupid, t)
+                    (group.key, t), now - agginfo.first_seen)
+                yield from self._complete(group, t, agginfo, False)
+
+            yield from self._expire_timeouts(now)
 
         logger.debug("AggSum.run() done")
@@ -0,0 +1,90 @@
+"""Filter that drops entries with a repeated (key, time).
+
+Duplicates can come from Kafka redelivery or overlapping Historical batches,
+and would otherwise, e.g., inflate AggSum counts.
+
+Configuration parameters ('*' indicates required parameter):
+    window: (integer, default 16) Number of recent times remembered per key.
+
+Input:  (key, value, time)
+
+Output:  (key, value, time)
+    Entries whose time is newer than every time seen for the same key pass
+    through unmodified, as do older entries whose time is within the window
+    but not seen before.  Entries whose time has been seen for the same key
+    are dropped.  Entries that are older than all the times in a full window
+    are also dropped, since they can't be checked.
+
+Each key has a high-water mark (its newest time) and a min-heap of at most
+{window} of its newest times seen, so memory per key is constant, the
+oldest remembered time is always at hand, and entries that arrive in time
+order (the usual case) need only a comparison and a heap replacement.
+"""
+
+import heapq
+import logging
+from .. import SentryModule
+
+logger = logging.getLogger(__name__)
+
+add_cfg_schema = {
+    "properties": {
+        "window": {"type": "integer", "exclusiveMinimum": 0},
+    },
+}
+
+
+class Dedup(SentryModule.SentryModule):
+
+    class _Seen:
+        """Times seen for a key"""
+        __slots__ = ('hw', 'times')
+        def __init__(self, t):
+            self.hw = t        # high-water mark (newest time)
+            self.times = [t]   # min-heap of the newest times
+
+        def add(self, t, window):
+            """Remember t, forgetting the oldest time if the window is full.
+            t must be newer than the oldest time in a full window."""
+            if len(self.times) < window:
+                heapq.heappush(self.times, t)
+            else:
+                heapq.heapreplace(self.times, t)
+
+    def __init__(self, config, gen, ctx):
+        logger.debug("Dedup.__init__")
+        super().__init__(config, logger, gen)
+        self.window = config.get('window', 16)
+        self.seen = dict() # seen[key] = _Seen
+        self.duplicates = 0
+        self.too_old = 0
+
+    def run(self):
+        logger.debug("Dedup.run()")
+        window = self.window
+        seen = self.seen
+        for entry in self.gen():
+            key, value, t = entry
+            if key is None: # marker
+                yield entry
+                continue
+            kseen = seen.get(key)
+            if kseen is None:
+                seen[key] = Dedup._Seen(t)
+            elif t > kseen.hw:
+                kseen.hw = t
+                kseen.add(t, window)
+            elif t == kseen.hw or t in kseen.times:
+                logger.debug("dropping duplicate (%s, %s, %s)", key, value, t)
+                self.duplicates += 1
+                continue
+            elif len(kseen.times) == window and t < kseen.times[0]:
+                logger.debug("dropping unverifiable old entry (%s, %s, %s)",
+                    key, value, t)
+                self.too_old += 1
+                continue
+            else:
+                kseen.add(t, window)
+            yield entry
+        logger.info("Dedup: dropped %d duplicates and %d entries too old to "
+            "check", self.duplicates, self.too_old)
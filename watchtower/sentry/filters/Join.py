@@ -0,0 +1,179 @@
+"""Filter that combines pairs of values from two sets of keys.
+
+For example, with left "geo.(*).up_cnt", right "geo.(*).probed_cnt", output
+"geo.(*).up_ratio", and operator "/", inputs "geo.US.up_cnt" and
+"geo.US.probed_cnt" with the same time produce output "geo.US.up_ratio" with
+their ratio.
+
+Configuration parameters ('*' indicates required parameter):
+    left*: (string) A DBATS-style glob pattern that left operand keys must
+        match.  Pairs are identified by the substring(s) that match(es)
+        parenthesized subexpression(s), as in AggSum.
+    right*: (string) A glob pattern that right operand keys must match, with
+        the same number of parenthesized subexpressions as left.
+    output*: (string) Output key template.  Its parenthesized
+        subexpressions (whose contents are ignored) are replaced with the
+        substrings matched by those of left and right.
+    operator: (string, default "/") Arithmetic operator applied to the left
+        and right values: "+", "-", "*", or "/".  The result is null if
+        either value is null, or when dividing by zero.
+    timeout*: (number) Max time (in seconds) to wait for the other operand
+        of a pair to arrive.  After this, the unpaired value is dropped.
+    maxbuffer: (integer, default 1000000) Max number of unpaired values to
+        buffer.  When the buffer is full, the oldest value is dropped.
+    keepinputs: (boolean) If set, pass all input entries through, in
+        addition to the output generated from pairs.  Otherwise, only the
+        generated output is emitted.
+
+Input:  (key, value, time)
+
+Output:  (key, value, time)
+    key is generated from {output}.
+    value is (left value) {operator} (right value).
+    time is the same as input time.
+
+Timeouts are evaluated whenever input arrives, including heartbeat markers.
+A watermark marker drops all unpaired values with times before the
+watermark immediately, since their pairs will never arrive.
+"""
+
+import logging
+import operator
+import re
+import time
+from .. import SentryModule
+
+logger = logging.getLogger(__name__)
+
+add_cfg_schema = {
+    "properties": {
+        "left":       {"type": "string"},
+        "right":      {"type": "string"},
+        "output":     {"type": "string"},
+        "operator":   {"enum": ["+", "-", "*", "/"]},
+        "timeout":    {"type": "number", "exclusiveMinimum": 0},
+        "maxbuffer":  {"type": "integer", "exclusiveMinimum": 0},
+        "keepinputs": {"type": "boolean"},
+    },
+    "required": ["left", "right", "output", "timeout"]
+}
+
+operators = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.truediv,
+}
+
+
+class Join(SentryModule.SentryModule):
+    def __init__(self, config, gen, ctx):
+        logger.debug("Join.__init__")
+        super().__init__(config, logger, gen)
+        self.timeout = config['timeout']
+        self.maxbuffer = config.get('maxbuffer', 1000000)
+        self.keepinputs = config.get('keepinputs', False)
+        self.op = operators[config.get('operator', '/')]
+
+        patterns = [config['left'], config['right']]
+        regexes = [SentryModule.glob_to_regex(p) for p in patterns]
+        logger.debug("patterns: %s", patterns)
+        logger.debug("regexes:  %s", regexes)
+        self.pattern_res = [re.compile(bytes(r, 'ascii')) for r in regexes]
+        ngroups = [regex.groups for regex in self.pattern_res]
+
+        # Output key template: the literal parts of output between its
+        # parenthesized subexpressions
+        self.template = re.split(rb"\(([^)]*)\)",
+            bytes(config['output'], 'ascii'))[0::2]
+        if not ngroups[0] == ngroups[1] == len(self.template) - 1:
+            raise SentryModule.UserError("module %s: left, right, and output "
+                "must have the same number of parenthesized subexpressions "
+                "(found %d, %d, %d)" % (self.modname, ngroups[0], ngroups[1],
+                len(self.template) - 1))
+
+        # pending[(groupid, t)] = (side, value, deadline) for unpaired values.
+        # All values wait the same timeout, so insertion order is deadline
+        # order.
+        self.pending = dict()
+        self.dropped = 0
+
+    def outkey(self, groupid):
+        template = self.template
+        parts = [template[0]]
+        for part, literal in zip(groupid, template[1:]):
+            parts.append(part)
+            parts.append(literal)
+        return b''.join(parts)
+
+    def _combine(self, left, right):
+        if left is None or right is None:
+            return None
+        try:
+            return self.op(left, right)
+        except ZeroDivisionError:
+            return None
+
+    def _drop(self, pair):
+        side, value, deadline = self.pending.pop(pair)
+        logger.debug("dropping unpaired %s value %r for %r",
+            ("left", "right")[side], value, pair)
+        self.dropped += 1
+
+    def _expire_timeouts(self, now):
+        pending = self.pending
+        while pending:
+            pair = next(iter(pending))
+            if pending[pair][2] > now:
+                break
+            self._drop(pair)
+
+    def _expire_watermark(self, watermark):
+        for pair in [pair for pair in self.pending if pair[1] < watermark]:
+            self._drop(pair)
+
+    def run(self):
+        logger.debug("Join.run()")
+        pending = self.pending
+        left_re, right_re = self.pattern_res
+        last_log = time.time()
+        for entry in self.gen():
+            key, value, t = entry
+            now = time.time()
+            self._expire_timeouts(now)
+            if key is None: # marker
+                if value == SentryModule.WATERMARK:
+                    self._expire_watermark(t)
+                yield entry
+                continue
+            if self.keepinputs:
+                yield entry
+            match = left_re.match(key)
+            side = 0
+            if not match:
+                match = right_re.match(key)
+                side = 1
+                if not match:
+                    continue
+            pair = (match.groups(), t)
+            other = pending.get(pair)
+            if other is None or other[0] == side:
+                # first operand (or a repeat of it); wait for the other
+                if other is not None:
+                    del pending[pair]
+                elif len(pending) >= self.maxbuffer:
+                    self._drop(next(iter(pending)))
+                pending[pair] = (side, value, now + self.timeout)
+            else:
+                del pending[pair]
+                if side == 0:
+                    result = self._combine(value, other[1])
+                else:
+                    result = self._combine(other[1], value)
+                yield (self.outkey(pair[0]), result, t)
+            if last_log + 60 <= now and self.dropped:
+                logger.info("Join: dropped %d unpaired values; %d pending",
+                    self.dropped, len(pending))
+                self.dropped = 0
+                last_log = now
+        logger.debug("Join.run() done")
@@ -35,5 +35,7 @@ class Keyfilter(SentryModule.SentryModule):
         logger.debug("Keyfilter.run()")
         for entry in self.gen():
             key, value, t = entry
-            if self.expression_re.match(key):
+            if key is None: # marker
+                yield entry
+            elif self.expression_re.match(key):
                 yield (key, value, t)
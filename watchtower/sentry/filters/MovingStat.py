@@ -7,9 +7,71 @@ Configuration parameters ('*' indicates required parameter):
         ['median']           middle value; equivalent to ['quantile', 1, 2]
         ['min']              minimum value; equivalent to ['quantile', 0, 1]
         ['max']              maximum value; equivalent to ['quantile', 1, 1]
+        ['approxquantile', k, q]  approximate k'th q-quantile of values (see
+                             approximation below)
+        ['approxmedian']     approximate median; equivalent to
+                             ['approxquantile', 1, 2]
+        ['ewma']             exponentially weighted moving average
+        ['holt']             Holt's linear trend forecast (double exponential
+                             smoothing)
+        ['holtwinters', s]   Holt-Winters forecast with additive seasonality
+                             with a period of s seconds (e.g., 86400 for a
+                             daily cycle).  warmup must be at least s.
+        The ewma, holt, and holtwinters types are forecasting types that
+        keep a few numbers of state per key (plus one per interval in the
+        season, for holtwinters) instead of the history window.  The
+        interval between values is learned from each key's first two values.
     history*: (integer) Number of seconds of data over which to calculate.
+    stats: (array) Instead of type, calculate several statistics over a
+        shared per-key history, e.g. to compare baselines.  Each item is an
+        object with these attributes:
+            type*: statistic type, as for the type parameter
+            history: (integer, default: history parameter) Number of seconds
+                of data over which to calculate this statistic.
+        The first statistic is the primary one: it alone is used for
+        inpainting and minprediction, and by sinks.AlertKafka (which reports
+        actual and predicted values only if includeabsolute is set).
+        Windows of the exact types share one buffer per key, holding the
+        longest of their histories.
     warmup*: (integer) Minimum number of seconds of data to collect before
         generating output.
+    backend: (string, default "list") Data structure used by the quantile
+        and median types to keep the window sorted:
+        "list"      sorted python list; each update shifts O(n) items, but
+                    with a small constant factor.  Fastest for windows of up
+                    to a few thousand points.
+        "skiplist"  indexable skiplist; O(log n) updates.  Faster for large
+                    windows (e.g., a month of 1-minute data).
+    approximation: parameters of the approximate types, which keep a compact
+        quantile sketch of each sub-window of the history instead of every
+        value.  Memory per key depends on the number of sub-windows and the
+        spread of the values, not on the number of values in the history.
+        accuracy: (number, default 0.01) Maximum relative error of a
+            quantile of the values in the window.
+        subwindows: (integer, default 16) Number of sub-windows the history
+            is divided into.  Data expires a whole sub-window at a time, so
+            the window may include up to history/subwindows seconds of data
+            older than history.
+    smoothing: parameters of the forecasting types.
+        alpha: (number, default 2/(N+1) where N is the number of intervals in
+            history) Smoothing factor of level.  Larger values adapt faster.
+        beta: (number, default 0.01) Smoothing factor of trend.
+        gamma: (number, default 0.1) Smoothing factor of seasonal
+            components.
+    grid: process the data as a grid of timesteps, updating all keys of a
+        timestep at once with vectorized numpy operations (requires the numpy
+        package).  Much faster for feeds with many keys (e.g. tens of
+        thousands) that all report at the same regular interval.  Supports
+        only the mean, median, quantile, min, and max types; history must be
+        a multiple of interval.  Output for a timestep is generated once the
+        timestep is complete, and has the same values as without grid.
+        interval*: (integer) Number of seconds between timesteps.  Values
+            whose time is not a multiple of interval are dropped.
+        lateness: (integer, default 0) A timestep is complete when a value
+            arrives with a time more than this many seconds after it, or a
+            watermark marker with a time after it arrives (or the input
+            ends).  Values that arrive for a timestep that is already
+            complete are dropped.
     includeabsolute: (boolean) Emit absolute values alongside relative
     minprediction: (number) Minimum prediction value before output is generated
     inpainting:
@@ -21,7 +83,7 @@ Configuration parameters ('*' indicates required parameter):
             I.e., the values previously considered extreme will now be
             considered the new normal.
 
-Output context variables: method
+Output context variables: method, includeabsolute
 
 Input:  (key, value, time)
 
@@ -30,28 +92,81 @@ Output:  (key, value*, time)
     value is the ratio of the input value to the statistic for all values for
         the same key where (old.time > new.time - history). If includeabsolute
         is set, then value is a triple of (ratio, actual, predicted).
+        With stats, value is a tuple of the ratios of all the statistics; or,
+        if includeabsolute is set, (ratio, actual, predicted) for the primary
+        statistic followed by (ratio, predicted) for each other statistic.
     time is the same as input time.
 """
 
 import logging
 import bisect
+import itertools
 import time
+from array import array
 from collections import deque
 from .. import SentryModule
+from ._QuantileSketch import Mapping, QuantileSketch
+from ._RingBuffer import RingBuffer, typecode_for
+from ._Skiplist import Skiplist
 
 logger = logging.getLogger(__name__)
 
+NAN = float('nan')
+
+stattype_schema = {
+    "type": "array",
+    # first item is stattype name, other are parameters
+    "items": [{"type": "string"}],
+    "additionalItems": {"type": "integer"},
+    "minItems": 1
+}
+
 add_cfg_schema = {
     "properties": {
-        "type": {
+        "type": stattype_schema,
+        "stats": {
             "type": "array",
-            # first item is stattype name, other are parameters
-            "items": [{"type": "string"}],
-            "additionalItems": {"type": "integer"},
+            "items": {
+                "type": "object",
+                "properties": {
+                    "type":    stattype_schema,
+                    "history": {"type": "integer", "exclusiveMinimum": 0},
+                },
+                "additionalProperties": False,
+                "required": ["type"],
+            },
             "minItems": 1
         },
         "history":       {"type": "integer", "exclusiveMinimum": 0},
         "warmup":        {"type": "integer", "exclusiveMinimum": 0},
+        "backend":       {"enum": ["list", "skiplist"]},
+        "approximation": {
+            "type": "object",
+            "properties": {
+                "accuracy":    {"type": "number", "exclusiveMinimum": 0,
+                                "exclusiveMaximum": 1},
+                "subwindows":  {"type": "integer", "exclusiveMinimum": 0},
+            },
+            "additionalProperties": False,
+        },
+        "smoothing": {
+            "type": "object",
+            "properties": {
+                "alpha": {"type": "number", "exclusiveMinimum": 0, "maximum": 1},
+                "beta":  {"type": "number", "exclusiveMinimum": 0, "maximum": 1},
+                "gamma": {"type": "number", "exclusiveMinimum": 0, "maximum": 1},
+            },
+            "additionalProperties": False,
+        },
+        "grid": {
+            "type": "object",
+            "properties": {
+                "interval": {"type": "integer", "exclusiveMinimum": 0},
+                "lateness": {"type": "integer", "minimum": 0},
+            },
+            "additionalProperties": False,
+            "required": ["interval"],
+        },
         "normalize": {"type": "boolean"},  # for testing/debugging
         "includeabsolute": {"type": "boolean"},
         "minprediction": {"type": "number"},
@@ -66,7 +181,8 @@ add_cfg_schema = {
             "required": ["maxduration"],
         },
     },
-    "required": ["type", "history", "warmup"],
+    "required": ["history", "warmup"],
+    "oneOf": [{"required": ["type"]}, {"required": ["stats"]}],
 }
 
 
@@ -116,10 +232,6 @@ class MovingStat(SentryModule.SentryModule):
                                          "includeabsolute is set" % self.modname)
 
         self.history_duration = config['history']
-        if self.history_duration <= self.warmup:
-            raise SentryModule.UserError('module %s: history (%d) must be '
-                'greater than warmup (%d)' %
-                (self.modname, self.history_duration, self.warmup))
 
         self.min_prediction = config.get('minprediction', None)
 
@@ -139,42 +251,213 @@ class MovingStat(SentryModule.SentryModule):
             self.inpaint_max = None
             self.should_inpaint = lambda ratio: False
 
-        stattype = config['type'][0]
-        n_params = 2 if stattype == "quantile" else 0
-        if len(config['type']) - 1 != n_params:
-            raise SentryModule.UserError("module %s: type %s expects %d "
-                "parameters (found %d)"
-                % (self.modname, stattype, n_params, len(config['type']) - 1))
-
-        stattype_params = {
-            "mean":     [MovingStat.Mean, None, None],
-            "min":      [MovingStat.Quantile, 0, 1],
-            "max":      [MovingStat.Quantile, 1, 1],
-            "median":   [MovingStat.Quantile, 1, 2],
-            "quantile": [MovingStat.Quantile, *config['type'][1:]],
-        }
-        self.statclass, self.k, self.q = stattype_params[stattype]
-        if self.q and self.k > self.q:
-            raise SentryModule.UserError("module %s: %s: first "
-                "number (%d) must be <= second (%d)"
-                % (self.modname, stattype, self.k, self.q))
-
-        ctx['method'] = ', '.join(config['type']) # for AlertKafka
+        self.skiplist = config.get('backend', 'list') == 'skiplist'
+        approx = config.get('approximation', {})
+        self.mapping = Mapping(approx.get('accuracy', 0.01))
+        self.n_subwindows = approx.get('subwindows', 16)
+        smoothing = config.get('smoothing', {})
+        self.alpha = smoothing.get('alpha', None)
+        self.beta = smoothing.get('beta', 0.01)
+        self.gamma = smoothing.get('gamma', 0.1)
+
+        if 'stats' in config:
+            self.statconfigs = [MovingStat.StatConfig(self, stat['type'],
+                stat.get('history', self.history_duration))
+                for stat in config['stats']]
+            self.multi = True
+        else:
+            self.statconfigs = [MovingStat.StatConfig(self, config['type'],
+                self.history_duration)]
+            self.multi = False
+
+        ctx['method'] = self.statconfigs[0].name # for AlertKafka
+        ctx['includeabsolute'] = self.include_absolute # for SQLite, AlertKafka
+
+        if 'grid' in config:
+            try:
+                from ._MovingStatGrid import Grid
+            except ImportError:
+                raise SentryModule.UserError("module %s: grid requires the "
+                    "numpy package" % self.modname)
+            self.grid = Grid(self, config['grid']['interval'],
+                config['grid'].get('lateness', 0))
+        else:
+            self.grid = None
 
         self.data = dict()
         self.last_key_time = dict()
+        # keys created since the last new_state_keys() call (None until the
+        # first call, so nothing is collected without a state server)
+        self.new_keys = None
+
+    class StatConfig:
+        # Parameters of one statistic, shared by the stat objects of all keys
+        # (as their ms_ctx).
+        def __init__(self, ms, stattype_list, history):
+            self.name = ', '.join(map(str, stattype_list))
+            stattype = stattype_list[0]
+            params = stattype_list[1:]
+            n_params = {"quantile": 2, "approxquantile": 2, "holtwinters": 1} \
+                .get(stattype, 0)
+            if len(params) != n_params:
+                raise SentryModule.UserError("module %s: type %s expects %d "
+                    "parameters (found %d)"
+                    % (ms.modname, stattype, n_params, len(params)))
+
+            stattype_params = {
+                "mean":     [MovingStat.Mean, None, None],
+                "min":      [MovingStat.Min, None, None],
+                "max":      [MovingStat.Max, None, None],
+                "median":   [MovingStat.Quantile, 1, 2],
+                "quantile": [MovingStat.Quantile, *params],
+                "approxmedian":   [MovingStat.SketchQuantile, 1, 2],
+                "approxquantile": [MovingStat.SketchQuantile, *params],
+                "ewma":        [MovingStat.EWMA, None, None],
+                "holt":        [MovingStat.Holt, None, None],
+                "holtwinters": [MovingStat.HoltWinters, None, None],
+            }
+            if stattype not in stattype_params:
+                raise SentryModule.UserError("module %s: unknown type %s"
+                    % (ms.modname, stattype))
+            self.statclass, self.k, self.q = stattype_params[stattype]
+            if self.statclass is MovingStat.Quantile and ms.skiplist:
+                self.statclass = MovingStat.SkiplistQuantile
+            if self.q and self.k > self.q:
+                raise SentryModule.UserError("module %s: %s: first "
+                    "number (%d) must be <= second (%d)"
+                    % (ms.modname, stattype, self.k, self.q))
+
+            self.history_duration = history
+            self.warmup = ms.warmup
+            if self.history_duration <= self.warmup:
+                raise SentryModule.UserError('module %s: history (%d) must be '
+                    'greater than warmup (%d)' %
+                    (ms.modname, self.history_duration, self.warmup))
+
+            self.mapping = ms.mapping
+            self.subwindow = history / ms.n_subwindows
+            self.alpha = ms.alpha
+            self.beta = ms.beta
+            self.gamma = ms.gamma
+            if stattype == 'holtwinters':
+                self.season = params[0]
+                if self.season <= 0:
+                    raise SentryModule.UserError("module %s: holtwinters "
+                        "season must be positive" % ms.modname)
+                if self.warmup < self.season:
+                    raise SentryModule.UserError("module %s: warmup (%d) must "
+                        "be at least holtwinters season (%d)" %
+                        (ms.modname, self.warmup, self.season))
 
+    # There is one stat object per key, so they use __slots__ and compact
+    # RingBuffers instead of deques of (v,t) tuples to minimize memory.
+    #
+    # run() uses these methods of a stat object:
+    #   warming_up(t): True if there's not yet enough data to make a
+    #       prediction at time t
+    #   add(value, t): add a value while warming up
+    #   is_initialized(), initialize(): prepare to make predictions after
+    #       warming up
+    #   expire(key, t): forget data that's too old for a prediction at t
+    #   prediction(t): predicted value at time t
+    #   push(value, t): add a (possibly inpainted) value, and forget the
+    #       oldest data if the window is full
+    #   restore(vtq): replace history with the (v,t) pairs in RingBuffer vtq,
+    #       and reset
     class StatBase:
+        __slots__ = ('ms_ctx', 'raw_vtq')
+
         def __init__(self, ms_ctx):
             self.ms_ctx = ms_ctx
-            self.vtq = deque()  # list of (v,t) ordered by t (maybe inpainted)
-            self.raw_vtq = None # list of raw (v,t) collected while inpainting
+            self.raw_vtq = None # raw (v,t) collected while inpainting
+
+    class WindowStat(StatBase):
+        # Base for stats that are calculated exactly from all the values in
+        # the window.  Subclasses maintain a data structure of the values in
+        # the window via initialize(), reset(), insert(), remove(), and
+        # insert_remove().
+        #
+        # The window is the items of vtq starting at index offset.  If vtq
+        # is shared by several stats with different histories (see Multi),
+        # expire_window() and slide_window() advance offset past expired
+        # items, and the owner of vtq pops items that have left every
+        # window.  Otherwise, expire() and push() pop expired items
+        # directly, and offset is always 0.
+        __slots__ = ('vtq', 'offset')
+
+        def __init__(self, ms_ctx):
+            super().__init__(ms_ctx)
+            self.vtq = RingBuffer() # (v,t) ordered by t (maybe inpainted)
+            self.offset = 0
+
+        def window_size(self):
+            return len(self.vtq) - self.offset
+
+        def warming_up(self, t):
+            return not self.vtq or \
+                self.vtq.first_time() > t - self.ms_ctx.warmup
+
+        def add(self, value, t):
+            self.vtq.append(value, t)
+
+        def expire(self, key, t):
+            # If window is overfull, remove old items.  This can happen when
+            # there's a time gap in new arrivals.
+            window_start = t - self.ms_ctx.history_duration
+            vtq = self.vtq
+            while vtq and vtq.first_time() < window_start:
+                oldest = vtq.popleft()
+                logger.warning("removing extra old item (%s, %d, %d)",
+                    key, oldest[0], oldest[1])
+                self.remove(oldest[0])
+
+        def push(self, value, t):
+            vtq = self.vtq
+            vtq.append(value, t)
+            if vtq.first_time() > t - self.ms_ctx.history_duration:
+                # Window is not full.  Insert value into the sorted list.
+                logger.debug("insert %d", value)
+                self.insert(value)
+            else:
+                # Window is full.  Remove the oldest value and insert the
+                # new value (which may be raw or inpainted).
+                oldest = vtq.popleft()
+                self.insert_remove(value, oldest[0])
+
+        def expire_window(self, key, t):
+            # Like expire(), for a shared vtq
+            window_start = t - self.ms_ctx.history_duration
+            vtq = self.vtq
+            while self.offset < len(vtq) and \
+                    vtq.time(self.offset) < window_start:
+                oldest = vtq[self.offset]
+                logger.warning("removing extra old item (%s, %d, %d)",
+                    key, oldest[0], oldest[1])
+                self.remove(oldest[0])
+                self.offset += 1
+
+        def slide_window(self, value, t):
+            # Like push(), for a shared vtq to which value has already been
+            # appended
+            if self.vtq.time(self.offset) > t - self.ms_ctx.history_duration:
+                logger.debug("insert %d", value)
+                self.insert(value)
+            else:
+                self.insert_remove(value, self.vtq.value(self.offset))
+                self.offset += 1
+
+        def restore(self, vtq):
+            self.vtq = vtq
+            self.offset = 0
+            self.reset()
+
+    class Quantile(WindowStat):
+        __slots__ = ('values',)
 
-    class Quantile(StatBase):
         def __init__(self, ms_ctx):
             super().__init__(ms_ctx)
             logger.debug("init quantile: %d/%d", self.ms_ctx.k, self.ms_ctx.q)
-            self.values = None # sorted list of values
+            self.values = None # sorted array of values
 
         def is_initialized(self):
             return self.values is not None
@@ -184,10 +467,17 @@ class MovingStat(SentryModule.SentryModule):
             logger.debug("reset")
 
         def initialize(self):
-            self.values = sorted([v for v, t in self.vtq])
+            self.values = array(self.vtq.values.typecode,
+                sorted(self.vtq.iter_values(self.offset)))
             logger.debug("sorted: %r", self.values)
 
+        def _fit(self, val):
+            # Switch to a float array if val doesn't fit in the int array
+            if self.values.typecode == 'q' and typecode_for(val) != 'q':
+                self.values = array('d', self.values)
+
         def insert_remove(self, ins_val, rm_val):
+            self._fit(ins_val)
             _sortedlist_add_remove(self.values, ins_val, rm_val)
             logger.debug("values: %r", self.values)
 
@@ -195,10 +485,11 @@ class MovingStat(SentryModule.SentryModule):
             self.values.remove(val)
 
         def insert(self, val):
+            self._fit(val)
             bisect.insort(self.values, val)
             logger.debug("values: %r", self.values)
 
-        def prediction(self):
+        def prediction(self, t):
             # Nearest rank method: smallest value such that no more than k/q
             # of the data is < value and at least k/q of the data is <= value
             if self.ms_ctx.k == 0:
@@ -211,7 +502,79 @@ class MovingStat(SentryModule.SentryModule):
                 rank = -(-N * self.ms_ctx.k // self.ms_ctx.q) - 1
             return self.values[rank]
 
-    class Mean(StatBase):
+    class SkiplistQuantile(Quantile):
+        __slots__ = ()
+
+        def initialize(self):
+            self.values = Skiplist(sorted(self.vtq.iter_values(self.offset)))
+            logger.debug("sorted: %r", self.values)
+
+        def insert_remove(self, ins_val, rm_val):
+            if ins_val != rm_val:
+                self.values.remove(rm_val)
+                self.values.insert(ins_val)
+            logger.debug("values: %r", self.values)
+
+        def insert(self, val):
+            self.values.insert(val)
+            logger.debug("values: %r", self.values)
+
+    class Min(WindowStat):
+        # Monotonic deque: the values in the window that are not greater
+        # than any value that arrived after them, in arrival order (so the
+        # minimum is at the front).  Each value is appended and popped at
+        # most once, so updates are O(1) amortized.  Values equal to a
+        # later value are kept, so that removing the oldest value from the
+        # window can simply pop the front if it is equal.
+        __slots__ = ('values',)
+
+        def __init__(self, ms_ctx):
+            super().__init__(ms_ctx)
+            self.values = None # monotonic deque of values
+
+        def is_initialized(self):
+            return self.values is not None
+
+        def reset(self):
+            self.values = None
+            logger.debug("reset")
+
+        def initialize(self):
+            self.values = deque()
+            for v in self.vtq.iter_values(self.offset):
+                self.insert(v)
+
+        def insert_remove(self, ins_val, rm_val):
+            self.remove(rm_val)
+            self.insert(ins_val)
+
+        def remove(self, val):
+            # val is always the oldest value in the window
+            if self.values and self.values[0] == val:
+                self.values.popleft()
+
+        def insert(self, val):
+            values = self.values
+            while values and values[-1] > val:
+                values.pop()
+            values.append(val)
+
+        def prediction(self, t):
+            return self.values[0] if self.values else None
+
+    class Max(Min):
+        # Same as Min, with the deque in non-increasing order.
+        __slots__ = ()
+
+        def insert(self, val):
+            values = self.values
+            while values and values[-1] < val:
+                values.pop()
+            values.append(val)
+
+    class Mean(WindowStat):
+        __slots__ = ('sum',)
+
         def __init__(self, ms_ctx):
             super().__init__(ms_ctx)
             self.sum = None # sum of values
@@ -224,24 +587,293 @@ class MovingStat(SentryModule.SentryModule):
             logger.debug("reset")
 
         def initialize(self):
-            self.sum = sum([v for v, t in self.vtq])
-            logger.debug("init: %r / %r", self.sum, len(self.vtq))
+            self.sum = sum(self.vtq.iter_values(self.offset))
+            logger.debug("init: %r / %r", self.sum, self.window_size())
 
         def insert_remove(self, ins_val, rm_val):
             self.sum -= rm_val
             self.sum += ins_val
-            logger.debug("mean: %r / %r", self.sum, len(self.vtq))
+            logger.debug("mean: %r / %r", self.sum, self.window_size())
 
         def remove(self, val):
             self.sum -= val
-            logger.debug("mean: %r / %r", self.sum, len(self.vtq))
+            logger.debug("mean: %r / %r", self.sum, self.window_size())
 
         def insert(self, val):
             self.sum += val
-            logger.debug("mean: %r / %r", self.sum, len(self.vtq))
+            logger.debug("mean: %r / %r", self.sum, self.window_size())
+
+        def prediction(self, t):
+            return self.sum / self.window_size()
+
 
-        def prediction(self):
-            return self.sum / len(self.vtq)
+    class SketchQuantile(StatBase):
+        # Approximate quantile.  Values are counted in a QuantileSketch for
+        # each sub-window (a time interval of ms_ctx.subwindow seconds), and
+        # in a total sketch from which quantiles are selected.  A sub-window
+        # expires when all of its time interval is older than the window,
+        # and its counts are subtracted from the total.
+        __slots__ = ('total', 'subwindows')
+
+        class Subwindow(QuantileSketch):
+            __slots__ = ('idx', 'tmin')
+
+            def __init__(self, idx, t):
+                super().__init__()
+                self.idx = idx # index of time interval
+                self.tmin = t  # minimum time of values in sketch
+
+        def __init__(self, ms_ctx):
+            super().__init__(ms_ctx)
+            self.reset()
+
+        def reset(self):
+            self.total = QuantileSketch()
+            self.subwindows = deque()
+
+        def is_initialized(self):
+            return True
+
+        def initialize(self):
+            pass
+
+        def warming_up(self, t):
+            return not self.subwindows or \
+                self.subwindows[0].tmin > t - self.ms_ctx.warmup
+
+        def add(self, value, t):
+            idx = int(t // self.ms_ctx.subwindow)
+            subwindows = self.subwindows
+            if not subwindows or subwindows[-1].idx < idx:
+                sub = self.Subwindow(idx, t)
+                subwindows.append(sub)
+            else:
+                # out of order; find the sub-window, or use the oldest one
+                for sub in reversed(subwindows):
+                    if sub.idx <= idx:
+                        break
+                if sub.tmin > t:
+                    sub.tmin = t
+            sub.add(self.ms_ctx.mapping, value)
+            self.total.add(self.ms_ctx.mapping, value)
+
+        def expire(self, key, t):
+            subwindows = self.subwindows
+            end = (t - self.ms_ctx.history_duration) / self.ms_ctx.subwindow
+            while subwindows and subwindows[0].idx + 1 <= end:
+                self.total.subtract(subwindows.popleft())
+
+        def push(self, value, t):
+            self.add(value, t)
+
+        def restore(self, vtq):
+            self.reset()
+            for v, t in vtq:
+                self.add(v, t)
+
+        def prediction(self, t):
+            N = self.total.count
+            if N == 0:
+                return None
+            # nearest rank, as in Quantile
+            rank = -(-N * self.ms_ctx.k // self.ms_ctx.q) - 1 \
+                if self.ms_ctx.k else 0
+            return self.total.select(self.ms_ctx.mapping, rank)
+
+
+    class EWMA(StatBase):
+        # Forecast is the exponentially weighted moving average of values.
+        # Subclasses add trend and seasonality.  Times are converted to a
+        # number of steps (the interval between the key's first two values),
+        # so gaps in the data are accounted for.
+        __slots__ = ('level', 'start', 'last_t', 'step')
+
+        def __init__(self, ms_ctx):
+            super().__init__(ms_ctx)
+            self.reset()
+
+        def reset(self):
+            self.level = None
+            self.start = None  # time of first value
+            self.last_t = None # time of latest value
+            self.step = None   # time between values
+
+        def is_initialized(self):
+            return True
+
+        def initialize(self):
+            pass
+
+        def warming_up(self, t):
+            return self.start is None or self.start > t - self.ms_ctx.warmup
+
+        def expire(self, key, t):
+            pass
+
+        def add(self, value, t):
+            if self.level is None:
+                self.start = self.last_t = t
+                self.first(value)
+                return
+            if self.step is None:
+                if t <= self.last_t:
+                    return # can't learn step yet; ignore
+                self.step = t - self.last_t
+            h = self.steps(t)
+            if t > self.last_t:
+                self.last_t = t
+            self.update(value, t, h, self.ms_ctx.alpha or
+                2 * self.step / (self.ms_ctx.history_duration + self.step))
+
+        def push(self, value, t):
+            self.add(value, t)
+
+        def restore(self, vtq):
+            self.reset()
+            for v, t in vtq:
+                self.add(v, t)
+
+        def steps(self, t):
+            # number of steps from latest value to t (at least 1)
+            if self.step is None or t <= self.last_t:
+                return 1
+            return (t - self.last_t) / self.step
+
+        def first(self, value):
+            self.level = value
+
+        def update(self, value, t, h, alpha):
+            self.level += alpha * (value - self.level)
+
+        def prediction(self, t):
+            return self.level
+
+    class Holt(EWMA):
+        __slots__ = ('trend',)
+
+        def first(self, value):
+            self.level = value
+            self.trend = 0
+
+        def update(self, value, t, h, alpha):
+            prev_level = self.level
+            forecast = prev_level + h * self.trend
+            self.level = forecast + alpha * (value - forecast)
+            self.trend += self.ms_ctx.beta * \
+                ((self.level - prev_level) / h - self.trend)
+
+        def prediction(self, t):
+            return self.level + self.steps(t) * self.trend
+
+    class HoltWinters(Holt):
+        # Additive seasonality: season[i] is the deviation from level of the
+        # i'th step of the season.  The first time a slot is seen, it's
+        # initialized to the deviation of that value.
+        __slots__ = ('season',)
+
+        def first(self, value):
+            super().first(value)
+            self.season = None # allocated once step is known
+
+        def slot(self, t):
+            return int(t // self.step) % len(self.season)
+
+        def update(self, value, t, h, alpha):
+            if self.season is None:
+                n = max(1, round(self.ms_ctx.season / self.step))
+                self.season = array('d', [NAN]) * n
+            i = self.slot(t)
+            s = self.season[i]
+            if s != s: # NaN: not yet initialized
+                super().update(value, t, h, alpha)
+                self.season[i] = value - self.level
+                return
+            prev_level = self.level
+            forecast = prev_level + h * self.trend
+            self.level = forecast + alpha * (value - s - forecast)
+            self.trend += self.ms_ctx.beta * \
+                ((self.level - prev_level) / h - self.trend)
+            self.season[i] = s + self.ms_ctx.gamma * (value - self.level - s)
+
+        def prediction(self, t):
+            forecast = super().prediction(t)
+            if self.season is not None:
+                s = self.season[self.slot(t)]
+                if s == s: # not NaN
+                    forecast += s
+            return forecast
+
+
+    class Multi(StatBase):
+        # Several stats of one key (for the stats config parameter).  The
+        # WindowStats share one vtq, which holds the longest of their
+        # windows.  Other stats are given the values separately.
+        __slots__ = ('vtq', 'stats', 'windowstats', 'otherstats')
+
+        def __init__(self, ms_ctx):
+            super().__init__(ms_ctx)
+            self.stats = [cfg.statclass(cfg) for cfg in ms_ctx.statconfigs]
+            self.windowstats = [stat for stat in self.stats
+                if isinstance(stat, MovingStat.WindowStat)]
+            self.otherstats = [stat for stat in self.stats
+                if not isinstance(stat, MovingStat.WindowStat)]
+            self.vtq = RingBuffer() if self.windowstats else None
+            for stat in self.windowstats:
+                stat.vtq = self.vtq
+
+        def warming_up(self, t):
+            return any(stat.warming_up(t) for stat in self.stats)
+
+        def add(self, value, t):
+            if self.vtq is not None:
+                self.vtq.append(value, t)
+            for stat in self.otherstats:
+                stat.add(value, t)
+
+        def is_initialized(self):
+            return all(stat.is_initialized() for stat in self.stats)
+
+        def initialize(self):
+            for stat in self.stats:
+                stat.initialize()
+
+        def trim(self):
+            n = min(stat.offset for stat in self.windowstats)
+            for i in range(n):
+                self.vtq.popleft()
+            for stat in self.windowstats:
+                stat.offset -= n
+
+        def expire(self, key, t):
+            for stat in self.otherstats:
+                stat.expire(key, t)
+            if self.vtq is not None:
+                for stat in self.windowstats:
+                    stat.expire_window(key, t)
+                self.trim()
+
+        def prediction(self, t):
+            return self.stats[0].prediction(t)
+
+        def predictions(self, t):
+            return [stat.prediction(t) for stat in self.stats]
+
+        def push(self, value, t):
+            for stat in self.otherstats:
+                stat.push(value, t)
+            if self.vtq is not None:
+                self.vtq.append(value, t)
+                for stat in self.windowstats:
+                    stat.slide_window(value, t)
+                self.trim()
+
+        def restore(self, vtq):
+            for stat in self.otherstats:
+                stat.restore(vtq)
+            if self.vtq is not None:
+                self.vtq = vtq
+                for stat in self.windowstats:
+                    stat.restore(vtq)
 
 
     def ratio_is_extreme(self, ratio):
@@ -255,20 +887,103 @@ class MovingStat(SentryModule.SentryModule):
             return True
         return False
 
+    def multi_output(self, value, ratio, predictions):
+        if not self.normalize:
+            return tuple(predictions)
+        ratios = [ratio] + [value/p if p else None for p in predictions[1:]]
+        if not self.include_absolute:
+            return tuple(ratios)
+        output = [ratio, value, predictions[0]]
+        for r, p in zip(ratios[1:], predictions[1:]):
+            output += [r, p]
+        return tuple(output)
+
+    def output_value(self, value, ratio, predictions):
+        if self.multi:
+            return self.multi_output(value, ratio, predictions)
+        # if include_absolute is True, then normalize is also True
+        if not self.normalize:
+            return predictions[0]
+        if self.include_absolute:
+            return (ratio, value, predictions[0])
+        return ratio
+
+    # State server read API (see StateServer)
+
+    def new_state_keys(self):
+        if self.new_keys is None:
+            # first call: all keys so far; from now on, new keys are
+            # collected as they're created
+            keys = self.grid.rows if self.grid is not None else self.data
+            self.new_keys = []
+            return list(keys)
+        new = self.new_keys
+        self.new_keys = []
+        return new
+
+    def key_state(self, key, window):
+        if self.grid is not None:
+            return self.grid.key_state(key, window)
+        data = self.data.get(key)
+        if data is None:
+            return None
+        t = self.last_key_time[key]
+        state = {"time": t, "warmingup": not data.is_initialized()}
+        if data.is_initialized():
+            # prediction for the next value
+            state["prediction"] = data.predictions(t) if self.multi \
+                else data.prediction(t)
+        state["inpainting"] = data.raw_vtq.first_time() \
+            if data.raw_vtq else None
+        if window:
+            vtq = getattr(data, 'vtq', None)
+            offset = getattr(data, 'offset', 0)
+            state["window"] = [list(vt) for vt in
+                itertools.islice(vtq, offset, None)] if vtq else None
+            state["raw"] = list(map(list, data.raw_vtq)) \
+                if data.raw_vtq else None
+        return state
+
+    def run_grid(self):
+        grid = self.grid
+        for entry in self.gen():
+            key, value, t = entry
+            if key is None: # marker
+                if value == SentryModule.WATERMARK:
+                    yield from grid.watermark(t)
+                yield entry
+                continue
+            if value is not None:
+                yield from grid.add(key, value, t)
+        yield from grid.flush()
+
     def run(self):
         logger.debug("MovingStatistic.run()")
+        if self.grid is not None:
+            yield from self.run_grid()
+            return
         last_size_log = None
         for entry in self.gen():
             logger.debug("MD: %s", str(entry))
             key, value, t = entry
 
+            if key is None: # marker
+                yield entry
+                continue
+
             if value is None:
                 continue
 
             if key not in self.data:
-                data = self.statclass(self)
+                if self.multi:
+                    data = MovingStat.Multi(self)
+                else:
+                    cfg = self.statconfigs[0]
+                    data = cfg.statclass(cfg)
                 self.data[key] = data
                 self.last_key_time[key] = None
+                if self.new_keys is not None:
+                    self.new_keys.append(key)
             else:
                 data = self.data[key]
 
@@ -286,28 +1001,24 @@ class MovingStat(SentryModule.SentryModule):
                 logging.info("MovingStat: tracking %d keys" % len(self.data))
                 last_size_log = now
 
-            if not data.vtq or data.vtq[0][1] > t - self.warmup:
+            if data.warming_up(t):
                 # not enough points yet.  Just store the new value.
-                data.vtq.append((value, t))
+                data.add(value, t)
                 continue
 
-            window_start = t - self.history_duration
-
             if not data.is_initialized():
                 # Warmup is done; initialize data (not including the new value)
                 data.initialize()
 
-            # If window is overfull, remove old items.  This can happen when
-            # there's a time gap in new arrivals.
-            while data.vtq and data.vtq[0][1] < window_start:
-                oldest = data.vtq.popleft()
-                logger.warning("removing extra old item (%s, %d, %d)",
-                    key, oldest[0], oldest[1])
-                data.remove(oldest[0])
+            data.expire(key, t)
 
             # Calculate predicted value based on data in the window (not
             # including the new value)
-            predicted = data.prediction()
+            if self.multi:
+                predictions = data.predictions(t)
+                predicted = predictions[0]
+            else:
+                predicted = data.prediction(t)
             if self.min_prediction is not None and \
                     predicted is not None and \
                     predicted < self.min_prediction:
@@ -319,34 +1030,39 @@ class MovingStat(SentryModule.SentryModule):
 
             newval = value
 
-            inpaint_started = data.raw_vtq[0][1] if data.raw_vtq else None
+            inpaint_started = data.raw_vtq.first_time() if data.raw_vtq else None
             if self.should_inpaint(ratio):
                 if not inpaint_started:
                     # Start inpainting
                     logger.debug("### extreme value: start inpainting")
-                    data.raw_vtq = deque()
-                    data.raw_vtq.append((value, t))
+                    data.raw_vtq = RingBuffer()
+                    data.raw_vtq.append(value, t)
                     newval = predicted
                 elif inpaint_started > t - self.inpaint_maxduration:
                     # Continue inpainting
                     logger.debug("### extreme value: continue inpainting")
-                    data.raw_vtq.append((value, t))
+                    data.raw_vtq.append(value, t)
                     newval = predicted
                 else:
                     # Extreme is the new normal.  Discard old normal and
                     # inpainted values, and rebuild history using raw values
                     # that had previously been considered extreme.
                     logger.debug("### extreme value: new normal")
-                    data.vtq = data.raw_vtq
+                    data.restore(data.raw_vtq)
                     data.raw_vtq = None
-                    if data.vtq[0][1] > t - self.warmup:
+                    if data.warming_up(t):
                         # Not enough data
-                        data.reset()
-                        data.vtq.append((value, t))
+                        data.add(value, t)
                         continue
                     data.initialize() # not including the new value
+                    # raw values may be older than history
+                    data.expire(key, t)
                     # Recalculate prediction using restored raw data
-                    predicted = data.prediction()
+                    if self.multi:
+                        predictions = data.predictions(t)
+                        predicted = predictions[0]
+                    else:
+                        predicted = data.prediction(t)
                     ratio = newval/predicted if predicted else None
                     logger.debug("new predicted=%r, value=%r, ratio=%r",
                         predicted, value, ratio)
@@ -357,20 +1073,12 @@ class MovingStat(SentryModule.SentryModule):
                 logger.debug("### return to normal: cancel inpainting")
                 data.raw_vtq = None
 
-            data.vtq.append((newval, t))
-
-            if data.vtq[0][1] > window_start:
-                # Window is not full.  Insert newval into the sorted list.
-                logger.debug("insert %d", newval)
-                data.insert(newval)
-            else:
-                # Window is full.  Remove the oldest value and insert the new
-                # value (which may be raw or inpainted).
-                oldest = data.vtq.popleft()
-                data.insert_remove(newval, oldest[0])
+            data.push(newval, t)
 
+            if self.multi:
+                yield (key, self.multi_output(value, ratio, predictions), t)
             # if include_absolute is True, then normalize is also True
-            if not self.normalize:
+            elif not self.normalize:
                 yield (key, predicted, t)
             else:
                 yield (key, ratio if not self.include_absolute else (ratio, value, predicted), t)
@@ -0,0 +1,122 @@
+"""Filter that downsamples each key's values into coarser time intervals.
+
+Configuration parameters ('*' indicates required parameter):
+    interval*: (integer) Length (in seconds) of output intervals.  Intervals
+        are aligned to multiples of interval.
+    function*: (string) How to combine the non-null values in an interval:
+        sum        sum of values
+        mean       mean of values
+        min        minimum value
+        max        maximum value
+        last       last value received
+        If an interval has only null values, its output value is null.
+    inputinterval: (integer) Expected time between input values of a key.
+        If set, an interval is complete (and output is generated) as soon as
+        the value for its last input time arrives.
+
+Input:  (key, value, time)
+
+Output:  (key, value, time)
+    key is the same as input key.
+    value is the aggregate of the values of key in the interval.
+    time is the start of the interval.
+
+An interval of a key is complete when its last value arrives (if
+inputinterval is set), when a value for a later interval of the same key
+arrives, or when a watermark marker at or after the end of the interval
+arrives.  Intervals that are still incomplete at the end of input are output
+then.  Values for an interval that is already complete are dropped.  Only
+the current interval of each key is kept, so state is O(1) per key.
+"""
+
+import logging
+from .. import SentryModule
+
+logger = logging.getLogger(__name__)
+
+add_cfg_schema = {
+    "properties": {
+        "interval":      {"type": "integer", "exclusiveMinimum": 0},
+        "function":      {"enum": ["sum", "mean", "min", "max", "last"]},
+        "inputinterval": {"type": "integer", "exclusiveMinimum": 0},
+    },
+    "required": ["interval", "function"]
+}
+
+combine_functions = {
+    "sum":  lambda acc, v: acc + v,
+    "mean": lambda acc, v: acc + v,
+    "min":  lambda acc, v: v if v < acc else acc,
+    "max":  lambda acc, v: v if v > acc else acc,
+    "last": lambda acc, v: v,
+}
+
+
+class Resample(SentryModule.SentryModule):
+
+    class _Bucket:
+        """State of the current interval of a key"""
+        __slots__ = ('start', 'acc', 'count')
+        def __init__(self, start):
+            self.start = start  # start time of interval
+            self.acc = None     # combined non-null values
+            self.count = 0      # number of non-null values
+
+    def __init__(self, config, gen, ctx):
+        logger.debug("Resample.__init__")
+        super().__init__(config, logger, gen)
+        self.interval = config['interval']
+        self.function = config['function']
+        self.combine = combine_functions[self.function]
+        self.inputinterval = config.get('inputinterval', None)
+        self.buckets = dict() # buckets[key] = _Bucket
+        self.done = dict()    # done[key] = end of key's latest output interval
+
+    def _result(self, key, bucket):
+        value = bucket.acc
+        if self.function == 'mean' and value is not None:
+            value /= bucket.count
+        self.done[key] = bucket.start + self.interval
+        return (key, value, bucket.start)
+
+    def _expire_watermark(self, watermark):
+        expired = [key for key, bucket in self.buckets.items()
+            if bucket.start + self.interval <= watermark]
+        for key in expired:
+            yield self._result(key, self.buckets.pop(key))
+
+    def run(self):
+        logger.debug("Resample.run()")
+        interval = self.interval
+        inputinterval = self.inputinterval
+        combine = self.combine
+        buckets = self.buckets
+        for entry in self.gen():
+            key, value, t = entry
+            if key is None: # marker
+                if value == SentryModule.WATERMARK:
+                    yield from self._expire_watermark(t)
+                yield entry
+                continue
+            start = t - t % interval
+            bucket = buckets.get(key)
+            if bucket is None or bucket.start != start:
+                if bucket is not None and start < bucket.start or \
+                        start < self.done.get(key, start):
+                    logger.warning("Resample: dropping late data (%s, %s, %s)",
+                        key, value, t)
+                    continue
+                if bucket is not None:
+                    yield self._result(key, bucket)
+                bucket = buckets[key] = Resample._Bucket(start)
+            if value is not None:
+                bucket.acc = value if bucket.count == 0 else \
+                    combine(bucket.acc, value)
+                bucket.count += 1
+            if inputinterval and t + inputinterval >= start + interval:
+                # last value of interval
+                yield self._result(key, buckets.pop(key))
+        # output incomplete intervals
+        for key, bucket in buckets.items():
+            yield self._result(key, bucket)
+        logger.debug("Resample.run() done")
@@ -9,9 +9,20 @@ Configuration parameters:
 
 Input:  (key, value, time)
 Output:  tuples with monitonically increasing timestamps. "old" data is dropped
+
+Data that arrives ahead of the next expected time for its key is buffered
+until the missing data arrives, or until timeout seconds have passed since
+the key's last output, at which point the oldest buffered data is released
+(giving up on the missing data).  Timeouts are evaluated whenever input
+arrives for any key, including heartbeat markers, so a source that emits
+heartbeats allows buffered data to be released even while no data is
+arriving.  A watermark marker releases buffered data immediately for keys
+whose missing data is older than the watermark (and so will never arrive).
 """
 
 import logging
+import heapq
+import itertools
 import time
 from .. import SentryModule
 
@@ -33,60 +44,100 @@ class TimeOrder(SentryModule.SentryModule):
         self.interval = config['interval']
         self.timeout = config['timeout']
         self.last_key_time = {}  # last_key_time[key] = ts
-        self.kv_buf = {}         # kv_buf[key][ts] = val
+        self.kv_buf = {}         # kv_buf[key] = heap of (ts, -seq, val)
         self.kv_buf_timer = {}  # kv_buf_timer[key] = last_append_ts
+        # deadlines is a heap of (deadline, seq, key) for keys with buffered
+        # data.  Only the latest entry for a key (deadline_seq[key]) is
+        # valid; others are skipped when they reach the top.
+        self.deadlines = []
+        self.deadline_seq = {}
+        self.seq = itertools.count()
+
+    def _schedule(self, key):
+        # Schedule release of key's buffered data
+        seq = next(self.seq)
+        self.deadline_seq[key] = seq
+        heapq.heappush(self.deadlines,
+            (self.kv_buf_timer[key] + self.timeout, seq, key))
+
+    def _release(self, key, now, force):
+        # Yield buffered data that is next in sequence for key (or, if force
+        # is set, the oldest buffered data regardless)
+        buf = self.kv_buf[key]
+        lkt = self.last_key_time[key]
+        while buf:
+            bt = buf[0][0]
+            if bt <= lkt:
+                heapq.heappop(buf) # duplicate time; drop
+                continue
+            if not force and bt != lkt + self.interval:
+                break
+            val = heapq.heappop(buf)[2]
+            yield (key, val, bt)
+            self.last_key_time[key] = lkt = bt
+            self.kv_buf_timer[key] = now
+            force = False
+        if buf:
+            self._schedule(key)
+
+    def _expire_timeouts(self, now):
+        deadlines = self.deadlines
+        while deadlines and deadlines[0][0] <= now:
+            _, seq, key = heapq.heappop(deadlines)
+            if self.deadline_seq[key] != seq or not self.kv_buf[key]:
+                continue # rescheduled or already released
+            logger.debug("reached timeout for %r", key)
+            yield from self._release(key, now, True)
 
-    def _handle_kvt(self, key, val, t):
+    def _expire_watermark(self, watermark, now):
+        for key, buf in self.kv_buf.items():
+            while buf and self.last_key_time[key] + self.interval < watermark:
+                yield from self._release(key, now, True)
+
+    def _handle_kvt(self, key, val, t, now):
         # special case to handle first time we see a key
         if key not in self.last_key_time:
             self.last_key_time[key] = None
-            self.kv_buf[key] = {}
+            self.kv_buf[key] = []
             self.kv_buf_timer[key] = None
 
-        # precompute some oft used values
         lkt = self.last_key_time[key]
-        now = time.time()
-        kbt = self.kv_buf_timer[key]
-        # decide if we'll check the buffer regardless of what happens
-        # i.e., because it has been a while since we last saw a value
-        # for this key
-        force_buffer_use = (kbt is not None) and ((kbt + self.timeout) <= now)
-        # we need to check the buffer if we're going to force its use
-        check_buffer = force_buffer_use
 
         if lkt is None or t == lkt + self.interval:
             # this is exactly the timestamp we expect to see for this key,
             # simply append it and update tracking info
             yield (key, val, t)
-            self.last_key_time[key] = lkt = t
+            self.last_key_time[key] = t
             self.kv_buf_timer[key] = now
-            force_buffer_use = False
-            check_buffer = True
+            if self.kv_buf[key]:
+                # see if there are things in the buffer we can return
+                yield from self._release(key, now, False)
         elif t > lkt + self.interval:
-            # future data point, buffer it
-            self.kv_buf[key][t] = val
+            # future data point, buffer it (if there are duplicates, the
+            # latest is the one that is kept)
+            buf = self.kv_buf[key]
+            heapq.heappush(buf, (t, -next(self.seq), val))
+            if len(buf) == 1:
+                self._schedule(key)
         # else:
         # (self.msg_time <= lkt), too old, drop
 
-        if check_buffer:
-            # see if there are things in the buffer we can return
-            buf_times = sorted(self.kv_buf[key].keys())
-            for bt in buf_times:
-                if force_buffer_use or bt == lkt + self.interval:
-                    yield (key, self.kv_buf[key][bt], bt)
-                    self.last_key_time[key] = lkt = bt
-                    self.kv_buf_timer[key] = now
-                    del self.kv_buf[key][bt]
-                    force_buffer_use = False
-                else:
-                    break
-
     def run(self):
         logger.debug("TimeOrder.run()")
         for entry in self.gen():
-            for res in self._handle_kvt(*entry):
-                yield res
+            now = time.time()
+            if self.deadlines and self.deadlines[0][0] <= now:
+                yield from self._expire_timeouts(now)
+            if entry[0] is None: # marker
+                if entry[1] == SentryModule.WATERMARK:
+                    yield from self._expire_watermark(entry[2], now)
+                yield entry
+                continue
+            yield from self._handle_kvt(*entry, now)
         # if there is anything left in the buffer, yield it now
-        for key in self.kv_buf:
-            for t in sorted(self.kv_buf[key]):
-                yield (key, self.kv_buf[key][t], t)
+        for key, buf in self.kv_buf.items():
+            lkt = self.last_key_time[key]
+            for bt, _, val in sorted(buf):
+                if bt > lkt:
+                    yield (key, val, bt)
+                    lkt = bt
@@ -34,7 +34,9 @@ class TimeOrderChecker(SentryModule.SentryModule):
     def run(self):
         logger.debug("TimeOrderChecker.run()")
         for (key, val, t) in self.gen():
-            if key not in self.last_key_time:
+            if key is None: # marker
+                pass
+            elif key not in self.last_key_time:
                 self.last_key_time[key] = t
             else:
                 if self.last_key_time[key] >= t:
@@ -37,5 +37,8 @@ class ToSigned(SentryModule.SentryModule):
         for entry in self.gen():
             logger.debug("TS: %s", str(entry))
             key, value, t = entry
+            if key is None: # marker
+                yield entry
+                continue
             value = u_to_s_64(value)
             yield (key, value, t)
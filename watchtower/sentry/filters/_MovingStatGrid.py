@@ -0,0 +1,273 @@
+"""
+Grid mode for MovingStat: process all keys of a timestep at once, with numpy.
+
+All keys' history windows are held in one (keys x slots) float matrix, used
+as a ring buffer of timesteps (NaN means no value).  Incoming values are
+collected per timestep, and when a timestep is complete, predictions,
+inpainting decisions, and history updates for all of its keys are computed
+with vectorized operations.  Only the rare per-key events (starting,
+continuing, or ending inpainting) are handled in python.
+
+A timestep is complete once a value arrives with a time more than lateness
+seconds after it, or a watermark later than it arrives (or the input ends).
+Values for a completed timestep ("stragglers") can't be added to history
+without invalidating predictions already made, so they are dropped and
+counted, as are values whose time is not a multiple of interval.
+"""
+
+import logging
+import numpy as np
+from .. import SentryModule
+
+logger = logging.getLogger(__name__)
+
+INITIAL_ROWS = 64
+
+
+class Grid:
+    def __init__(self, ms, interval, lateness):
+        self.ms = ms
+        self.interval = interval
+        self.lateness = lateness
+        supported = (ms.Quantile, ms.SkiplistQuantile, ms.Mean, ms.Min,
+            ms.Max)
+        for cfg in ms.statconfigs:
+            if cfg.statclass not in supported:
+                raise SentryModule.UserError("module %s: type %s is not "
+                    "supported in grid mode" % (ms.modname, cfg.name))
+            if cfg.history_duration % interval:
+                raise SentryModule.UserError("module %s: history (%d) must be "
+                    "a multiple of grid interval (%d)" %
+                    (ms.modname, cfg.history_duration, interval))
+        # A window at time t holds the slots of [t - history, t), and the
+        # slot of t itself is being filled
+        self.nslots = max(cfg.history_duration
+            for cfg in ms.statconfigs) // interval + 1
+        self.rows = dict()     # rows[key] = row index of key
+        self.values = np.full((INITIAL_ROWS, self.nslots), np.nan)
+        self.start = np.full(INITIAL_ROWS, np.nan) # time of oldest history
+        self.inpaint_start = np.full(INITIAL_ROWS, np.nan)
+        self.raw = dict()      # raw[row] = raw (v,t) collected while inpainting
+        self.pending = dict()  # pending[t] = {key: value} for timestep t
+        self.newest = None     # newest time seen
+        self.last_done = None  # last completed timestep
+        self.last_watermark = None # latest watermark
+        self.dropped = 0       # count of misaligned or late values
+
+    def _row(self, key):
+        row = self.rows.get(key)
+        if row is None:
+            row = self.rows[key] = len(self.rows)
+            if self.ms.new_keys is not None:
+                self.ms.new_keys.append(key)
+            if row == len(self.start):
+                n = len(self.start)
+                self.values = np.vstack([self.values,
+                    np.full((n, self.nslots), np.nan)])
+                self.start = np.concatenate([self.start, np.full(n, np.nan)])
+                self.inpaint_start = np.concatenate([self.inpaint_start,
+                    np.full(n, np.nan)])
+        return row
+
+    def _slot(self, t):
+        return int(t // self.interval) % self.nslots
+
+    def _predict(self, cfg, rows, t):
+        """Return array of predictions at time t for the given rows (NaN
+        where there's no data)."""
+        nwin = cfg.history_duration // self.interval
+        cur = self._slot(t)
+        cols = [(cur - j) % self.nslots for j in range(1, nwin + 1)]
+        window = self.values[np.ix_(rows, cols)]
+        missing = np.isnan(window)
+        count = window.shape[1] - missing.sum(axis=1)
+        result = np.full(len(rows), np.nan)
+        has_data = count > 0
+        if cfg.statclass is self.ms.Mean:
+            total = np.where(missing, 0, window).sum(axis=1)
+            np.divide(total, count, out=result, where=has_data)
+        elif cfg.statclass is self.ms.Min:
+            mins = np.where(missing, np.inf, window).min(axis=1)
+            result[has_data] = mins[has_data]
+        elif cfg.statclass is self.ms.Max:
+            maxs = np.where(missing, -np.inf, window).max(axis=1)
+            result[has_data] = maxs[has_data]
+        else:
+            # Nearest rank method, as in MovingStat.Quantile.  Rows with the
+            # same count have the same rank, so each group of such rows
+            # (usually there's just one) can be partitioned at once.  NaNs
+            # sort after all numbers.
+            if cfg.k == 0:
+                ranks = np.zeros(len(rows), dtype=int)
+            else:
+                ranks = -(-count * cfg.k // cfg.q) - 1
+            for n in np.unique(count[has_data]):
+                group = np.flatnonzero(count == n)
+                rank = ranks[group[0]]
+                result[group] = np.partition(window[group], rank,
+                    axis=1)[:, rank]
+        return result
+
+    def add(self, key, value, t):
+        """Add a value; generate output for any timesteps completed by it."""
+        if t % self.interval or \
+                (self.last_done is not None and t <= self.last_done) or \
+                (self.last_watermark is not None and
+                    t < self.last_watermark):
+            self.dropped += 1
+            return
+        step = self.pending.get(t)
+        if step is None:
+            step = self.pending[t] = dict()
+        step[key] = value
+        if self.newest is None or t > self.newest:
+            self.newest = t
+            for T in sorted(self.pending):
+                if T + self.lateness >= t:
+                    break
+                yield from self._complete(T, self.pending.pop(T))
+
+    def watermark(self, watermark):
+        """Generate output for timesteps before watermark."""
+        if self.last_watermark is None or watermark > self.last_watermark:
+            self.last_watermark = watermark
+        for T in sorted(self.pending):
+            if T >= watermark:
+                break
+            yield from self._complete(T, self.pending.pop(T))
+
+    def flush(self):
+        """Generate output for all pending timesteps."""
+        for T in sorted(self.pending):
+            yield from self._complete(T, self.pending.pop(T))
+
+    def key_state(self, key, window):
+        """Return the state of key for MovingStat.key_state()"""
+        row = self.rows.get(key)
+        if row is None:
+            return None
+        ms = self.ms
+        T = self.last_done
+        start = self.start[row]
+        state = {"time": T,
+            "warmingup": T is None or not start <= T - ms.warmup}
+        if T is not None and not state["warmingup"]:
+            # prediction for the next timestep
+            predictions = [self._predict(cfg, [row], T + self.interval)[0]
+                for cfg in ms.statconfigs]
+            predictions = [None if p != p else float(p) for p in predictions]
+            state["prediction"] = predictions if ms.multi else predictions[0]
+        istart = self.inpaint_start[row]
+        state["inpainting"] = None if istart != istart else float(istart)
+        if window:
+            state["window"] = None if T is None else \
+                [[float(self.values[row, self._slot(t)]), t]
+                for t in range(T - (self.nslots - 2) * self.interval,
+                    T + self.interval, self.interval)
+                if not np.isnan(self.values[row, self._slot(t)])]
+            state["raw"] = [[float(v), t] for v, t in self.raw[row]] \
+                if row in self.raw else None
+        return state
+
+    def _complete(self, T, step):
+        ms = self.ms
+        if self.dropped:
+            logger.warning("MovingStat: dropped %d misaligned or late values",
+                self.dropped)
+            self.dropped = 0
+        keys = list(step)
+        rows = np.array([self._row(key) for key in keys], dtype=int)
+        vals = np.array(list(step.values()), dtype=float)
+        cur = self._slot(T)
+
+        # Expire the slots of this and any skipped timesteps for all keys
+        if self.last_done is None or \
+                T - self.last_done >= self.nslots * self.interval:
+            self.values[:, :] = np.nan
+        else:
+            for t in range(self.last_done + self.interval, T + 1,
+                    self.interval):
+                self.values[:, self._slot(t)] = np.nan
+        self.last_done = T
+
+        # Keys that are warming up just store the new value
+        start = self.start[rows]
+        warming = ~(start <= T - ms.warmup)
+        wrows = rows[warming]
+        self.values[wrows, cur] = vals[warming]
+        self.start[wrows] = np.where(np.isnan(start[warming]), T,
+            start[warming])
+        active = np.flatnonzero(~warming)
+        if len(active) == 0:
+            return
+        rows = rows[active]
+        vals = vals[active]
+        keys = [keys[i] for i in active]
+
+        predictions = [self._predict(cfg, rows, T)
+            for cfg in ms.statconfigs]
+        predicted = predictions[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(np.isnan(predicted) | (predicted == 0), np.nan,
+                vals / predicted)
+        output = np.ones(len(rows), dtype=bool)
+        if ms.min_prediction is not None:
+            # predicted value is too low; don't store or output
+            output = ~(predicted < ms.min_prediction)
+        newvals = vals.copy()
+
+        if ms.inpaint_maxduration is not None:
+            extreme = np.zeros(len(rows), dtype=bool)
+            if ms.inpaint_min:
+                extreme |= ratio < ms.inpaint_min
+            if ms.inpaint_max:
+                extreme |= ratio > ms.inpaint_max
+            extreme &= output
+            istart = self.inpaint_start[rows]
+            inpainting = ~np.isnan(istart) & output
+            recent = istart > T - ms.inpaint_maxduration
+            # Start or continue inpainting
+            paint = extreme & (~inpainting | recent)
+            newvals[paint] = predicted[paint]
+            for i in np.flatnonzero(paint):
+                row = rows[i]
+                if row in self.raw:
+                    self.raw[row].append((vals[i], T))
+                else:
+                    self.raw[row] = [(vals[i], T)]
+                    self.inpaint_start[row] = T
+            # Return to normal: cancel inpainting
+            for i in np.flatnonzero(~extreme & inpainting):
+                del self.raw[rows[i]]
+                self.inpaint_start[rows[i]] = np.nan
+            # Extreme is the new normal: rebuild history from raw values
+            for i in np.flatnonzero(extreme & inpainting & ~recent):
+                row = rows[i]
+                raw = self.raw.pop(row)
+                self.inpaint_start[row] = np.nan
+                self.values[row, :] = np.nan
+                oldest = T - (self.nslots - 1) * self.interval
+                for v, t in raw:
+                    if t >= oldest:
+                        self.values[row, self._slot(t)] = v
+                self.start[row] = raw[0][1]
+                if raw[0][1] > T - ms.warmup:
+                    # Not enough data
+                    output[i] = False
+                    self.values[row, cur] = vals[i]
+                    continue
+                for j, cfg in enumerate(ms.statconfigs):
+                    predictions[j][i] = self._predict(cfg, [row], T)[0]
+                p = predicted[i]
+                ratio[i] = np.nan if np.isnan(p) or p == 0 else vals[i] / p
+
+        keep = np.flatnonzero(output)
+        self.values[rows[keep], cur] = newvals[keep]
+
+        vals = vals.tolist()
+        ratio = [None if r != r else r for r in ratio.tolist()]
+        predictions = [[None if p != p else p for p in pred.tolist()]
+            for pred in predictions]
+        for i in keep.tolist():
+            yield (keys[i], ms.output_value(vals[i], ratio[i],
+                [pred[i] for pred in predictions]), T)
@@ -0,0 +1,119 @@
+"""
+Mergeable approximate quantile sketch with bounded relative error.
+
+Values are counted in logarithmically sized bins (as in DDSketch, Masson et
+al., VLDB 2019): bin i holds positive values in (gamma^(i-1), gamma^i], where
+gamma = (1 + accuracy) / (1 - accuracy), and is represented by the value
+2 * gamma^i / (gamma + 1), which is within `accuracy` (relative) of every
+value in the bin.  Negative values are binned by magnitude in a separate set
+of bins, and zeros are counted separately.
+
+Sketches with the same mapping can be merged or subtracted by adding or
+subtracting bin counts, which is what allows a sliding window built of
+sub-window sketches to expire old data.  Memory depends on the spread of the
+values (on a log scale), not on how many there are.
+"""
+
+import math
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+
+
+class Mapping:
+    """Maps values to bin indexes and back, for a given relative accuracy."""
+
+    def __init__(self, accuracy):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.inv_log_gamma = 1 / math.log(self.gamma)
+
+    def index(self, magnitude):
+        return math.ceil(math.log(magnitude) * self.inv_log_gamma)
+
+    def value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+
+class _Bins:
+    """Dense counts for a contiguous range of bin indexes."""
+    __slots__ = ('offset', 'counts')
+
+    def __init__(self):
+        self.offset = 0
+        self.counts = array('I')
+
+    def add(self, i, n):
+        counts = self.counts
+        if not counts:
+            self.offset = i
+            counts.append(n)
+            return
+        j = i - self.offset
+        if j < 0:
+            counts[0:0] = array('I', bytes(4 * -j))
+            self.offset = i
+            j = 0
+        elif j >= len(counts):
+            counts.frombytes(bytes(4 * (j - len(counts) + 1)))
+        counts[j] += n
+
+    def merge(self, other, sign):
+        for j, n in enumerate(other.counts):
+            if n:
+                self.add(other.offset + j, sign * n)
+
+    def select(self, rank):
+        """Return the index of the bin containing the rank'th (0-based)
+        smallest counted item."""
+        return self.offset + bisect_right(list(accumulate(self.counts)), rank)
+
+
+class QuantileSketch:
+    __slots__ = ('pos', 'neg', 'zeros', 'count')
+
+    def __init__(self):
+        self.pos = _Bins()
+        self.neg = None  # allocated when the first negative value arrives
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, mapping, value, n=1):
+        if value > 0:
+            self.pos.add(mapping.index(value), n)
+        elif value < 0:
+            if self.neg is None:
+                self.neg = _Bins()
+            self.neg.add(mapping.index(-value), n)
+        else:
+            self.zeros += n
+        self.count += n
+
+    def _merge(self, other, sign):
+        self.pos.merge(other.pos, sign)
+        if other.neg is not None:
+            if self.neg is None:
+                self.neg = _Bins()
+            self.neg.merge(other.neg, sign)
+        self.zeros += sign * other.zeros
+        self.count += sign * other.count
+
+    def merge(self, other):
+        """Add the counts of other to this sketch."""
+        self._merge(other, 1)
+
+    def subtract(self, other):
+        """Remove the counts of other (which must have been merged into this
+        sketch) from this sketch."""
+        self._merge(other, -1)
+
+    def select(self, mapping, rank):
+        """Return the approximate rank'th (0-based) smallest value."""
+        nneg = self.count - self.zeros - sum(self.pos.counts)
+        if rank < nneg:
+            # ascending values are descending magnitudes
+            return -mapping.value(self.neg.select(nneg - 1 - rank))
+        rank -= nneg
+        if rank < self.zeros:
+            return 0
+        return mapping.value(self.pos.select(rank - self.zeros))
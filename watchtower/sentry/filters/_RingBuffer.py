@@ -0,0 +1,139 @@
+"""
+Compact FIFO of (value, time) pairs, for per-key history windows.
+
+Values and times are stored in typed arrays used as a ring buffer, so each
+sample costs 8 bytes for the value plus 8 bytes for the time, instead of a
+tuple and two python numbers.  Values are stored as int64 until a value
+that is not an int64 arrives, after which all values are stored as float64.
+
+Most series are sampled at a regular interval, so the time column is not
+stored at all as long as every time is the previous time plus a fixed step
+(learned from the first two times); times are then inferred from the time
+of the oldest value.  The first irregular time materializes the time column.
+
+The buffer grows by doubling when it is full and never shrinks, so its
+capacity settles at the smallest power of two that holds the window.
+"""
+
+from array import array
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+INITIAL_CAPACITY = 8
+
+
+def typecode_for(x):
+    """Return the array typecode needed to store number x."""
+    return 'q' if type(x) is int and INT64_MIN <= x <= INT64_MAX else 'd'
+
+
+class RingBuffer:
+    __slots__ = ('values', 'times', 'head', 'size', 't0', 'step')
+
+    def __init__(self):
+        self.values = array('q', bytes(8 * INITIAL_CAPACITY))
+        self.times = None # None means times are inferred from t0 and step
+        self.head = 0     # index of oldest item
+        self.size = 0
+        self.t0 = None    # time of oldest item (if times is None)
+        self.step = None  # time between items (if times is None)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield self[i]
+
+    def __repr__(self):
+        return 'RingBuffer(%r)' % list(self)
+
+    def __getitem__(self, i):
+        """Return the i'th oldest (value, time)."""
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError('RingBuffer index out of range')
+        return (self.values[(self.head + i) % len(self.values)], self.time(i))
+
+    def value(self, i):
+        """Return the value of the i'th oldest item."""
+        return self.values[(self.head + i) % len(self.values)]
+
+    def time(self, i):
+        """Return the time of the i'th oldest item."""
+        if self.times is None:
+            return self.t0 + i * self.step if i else self.t0
+        return self.times[(self.head + i) % len(self.times)]
+
+    def first_time(self):
+        return self.time(0)
+
+    def last_time(self):
+        return self.time(self.size - 1)
+
+    def iter_values(self, start=0):
+        """Iterate over values, starting with the start'th oldest."""
+        values = self.values
+        cap = len(values)
+        begin = (self.head + start) % cap
+        end = begin + self.size - start
+        if end <= cap:
+            return iter(values[begin:end])
+        return iter(values[begin:] + values[:end - cap])
+
+    def _resize(self, capacity):
+        def linearized(a):
+            new = a[self.head:] + a[:self.head]
+            return new + array(a.typecode, bytes(8 * (capacity - len(a))))
+        self.values = linearized(self.values)
+        if self.times is not None:
+            self.times = linearized(self.times)
+        self.head = 0
+
+    def _materialize_times(self):
+        tc = typecode_for(self.t0)
+        if self.step is not None and typecode_for(self.step) != 'q':
+            tc = 'd'
+        times = array(tc, bytes(8 * len(self.values)))
+        cap = len(times)
+        for i in range(self.size):
+            times[(self.head + i) % cap] = self.time(i)
+        self.times = times
+
+    def append(self, value, t):
+        if self.size == len(self.values):
+            self._resize(2 * self.size)
+        if self.values.typecode == 'q' and typecode_for(value) != 'q':
+            self.values = array('d', self.values)
+        if self.times is None:
+            if self.size == 0:
+                self.t0 = t
+            elif self.step is None: # size is 1
+                if t > self.t0:
+                    self.step = t - self.t0
+                else:
+                    self._materialize_times()
+            elif t != self.t0 + self.size * self.step:
+                self._materialize_times()
+        i = (self.head + self.size) % len(self.values)
+        self.values[i] = value
+        if self.times is not None:
+            if self.times.typecode == 'q' and typecode_for(t) != 'q':
+                self.times = array('d', self.times)
+            self.times[i] = t
+        self.size += 1
+
+    def popleft(self):
+        """Remove and return the oldest (value, time)."""
+        if self.size == 0:
+            raise IndexError('pop from an empty RingBuffer')
+        item = self[0]
+        self.head = (self.head + 1) % len(self.values)
+        self.size -= 1
+        if self.times is None:
+            if self.size == 0:
+                self.step = None
+            else:
+                self.t0 += self.step
+        return item
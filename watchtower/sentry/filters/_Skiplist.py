@@ -0,0 +1,126 @@
+"""
+Indexable skiplist: a sorted multiset with O(log n) expected time insert,
+remove, and access by rank.
+
+Each node stores, for each of its levels, a link to the next node at that
+level and the "width" of the link, i.e. the number of level-0 links it spans.
+Summing widths along a search path gives the rank of a node, which is what
+makes the skiplist indexable.  (After R. Hettinger's recipe,
+https://code.activestate.com/recipes/576930/.)
+"""
+
+import random
+
+MAX_LEVEL = 32
+
+# One generator for the node levels of all skiplists (seeded, so results are
+# reproducible), since there may be a skiplist per key, and a Random instance
+# has a few KB of state.
+_random = random.Random(0).random
+
+
+class _Node:
+    __slots__ = ('value', 'next', 'width')
+
+    def __init__(self, value, level):
+        self.value = value
+        self.next = [None] * level  # None is the end of the list
+        self.width = [1] * level
+
+
+class Skiplist:
+    """Sorted multiset of mutually comparable values.  Supports len(), access
+    by index (in sorted order), and iteration."""
+
+    def __init__(self, values=()):
+        self.head = _Node(None, MAX_LEVEL)
+        self.level = 1  # number of levels in use
+        self.size = 0
+        for value in values:
+            self.insert(value)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        node = self.head.next[0]
+        while node is not None:
+            yield node.value
+            node = node.next[0]
+
+    def __repr__(self):
+        return 'Skiplist(%r)' % list(self)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError('Skiplist index out of range')
+        node = self.head
+        i += 1  # number of links to follow
+        for level in reversed(range(self.level)):
+            while node.width[level] <= i:
+                i -= node.width[level]
+                node = node.next[level]
+        return node.value
+
+    def insert(self, value):
+        # Find the last node at each level with node.value <= value, so equal
+        # values are kept in insertion order.
+        chain = [None] * MAX_LEVEL
+        steps_at_level = [0] * MAX_LEVEL
+        node = self.head
+        for level in reversed(range(self.level)):
+            nxt = node.next[level]
+            while nxt is not None and nxt.value <= value:
+                steps_at_level[level] += node.width[level]
+                node = nxt
+                nxt = node.next[level]
+            chain[level] = node
+
+        # Choose the new node's level with a geometric distribution
+        d = 1
+        rand = _random
+        while d < MAX_LEVEL and rand() < 0.5:
+            d += 1
+        if d > self.level:
+            for level in range(self.level, d):
+                self.head.width[level] = self.size + 1
+                chain[level] = self.head
+            self.level = d
+
+        newnode = _Node(value, d)
+        steps = 0
+        for level in range(d):
+            prev = chain[level]
+            newnode.next[level] = prev.next[level]
+            prev.next[level] = newnode
+            newnode.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(d, self.level):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, value):
+        """Remove one occurrence of value; raise ValueError if not found."""
+        chain = [None] * MAX_LEVEL
+        node = self.head
+        for level in reversed(range(self.level)):
+            nxt = node.next[level]
+            while nxt is not None and nxt.value < value:
+                node = nxt
+                nxt = node.next[level]
+            chain[level] = node
+
+        target = chain[0].next[0]
+        if target is None or target.value != value:
+            raise ValueError('Skiplist.remove(x): x not in list')
+        d = len(target.next)
+        for level in range(d):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(d, self.level):
+            chain[level].width[level] -= 1
+        self.size -= 1
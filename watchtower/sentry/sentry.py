@@ -9,6 +9,7 @@ import argparse
 import importlib
 import yaml
 from . import SentryModule as SM
+from . import StateServer
 
 exitstatus = 0
 COMMENT_RE = re.compile(r'//\s+.*$', re.M)
@@ -20,6 +21,7 @@ cfg_schema = {
     "type": "object",
     "properties": {
         "loglevel": {"type": "string"},                # global loglevel
+        "stateserver": StateServer.cfg_schema,         # state query server
         "pipeline": {                                  # list of modules
             "type": "array",
             "items": SM.base_cfg_schema(),             # generic module
@@ -102,10 +104,21 @@ class Sentry:
         # Validate config against the full schema we just built.
         SM.schema_validate(self.config, cfg_schema, cfg_name, logger)
 
+        self.stateserver = None
+        if 'stateserver' in self.config:
+            self.stateserver = StateServer.StateServer(
+                self.config['stateserver'])
+
         # Construct instances of each class and chain them together.
         self.run_last_mod = None
         for i, item in enumerate(pipeline):
-            mod = item['pyclass'](item['modconfig'], self.run_last_mod, ctx)
+            gen = self.run_last_mod
+            if i == 1 and self.stateserver:
+                # answer state queries between entries from the source
+                gen = self.stateserver.wrap(gen)
+            mod = item['pyclass'](item['modconfig'], gen, ctx)
+            if self.stateserver and hasattr(mod, 'key_state'):
+                self.stateserver.register(mod)
             self.run_last_mod = mod.run
 
 
@@ -124,7 +137,13 @@ class Sentry:
 
     def run(self):
         logger.debug("sentry.run()")
-        self.run_last_mod()
+        if self.stateserver:
+            self.stateserver.start()
+        try:
+            self.run_last_mod()
+        finally:
+            if self.stateserver:
+                self.stateserver.stop()
         logger.debug("sentry done")
 
 # end class Sentry
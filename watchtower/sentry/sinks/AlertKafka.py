@@ -8,10 +8,34 @@ Configuration parameters ('*' indicates required parameter):
     minduraton: (number) Only generate alerts for events at least this long.
     brokers*: (string) Comma-separated list of kafka brokers.
     topic*: (string) Kafka topic prefix.
+    coalesce: (object) Combine the violations of all keys with the same
+        level (critical or normal) and time window into one alert record,
+        instead of producing a record per key.  During a large outage, this
+        turns thousands of messages per timestep into a few.
+        window: (integer, default 0) Length (in seconds) of time windows;
+            the record's time is the start of the window.  0 means each
+            distinct time is its own window.
+        maxwait: (number, default 10) Max time (in seconds) to hold a record
+            open waiting for more violations.  A record is also produced as
+            soon as data for a time after its window, or a watermark marker
+            after its window, arrives.
+        maxviolations: (integer, default 1000) Max number of violations per
+            record; more violations are split into multiple records.
+    linger: (number) Time (in milliseconds) for the kafka producer to wait
+        to batch messages together (kafka linger.ms).
+    compression: (string) Compression codec for kafka messages: "none",
+        "gzip", "snappy", "lz4", or "zstd" (kafka compression.type).
+    database: (string) Also store each alert violation in the alerts table of
+        this SQLite database (which may be shared with sinks.SQLite).
 
     At least one of {min} or {max} is required.
 
-Input context variables: expression*, method*
+Input context variables: expression*, method*, includeabsolute, lag
+    If the value is a tuple (from MovingStat with stats), its first element is
+    the ratio to alert on; actual and predicted values are reported only if
+    includeabsolute is set.
+    If lag is set by the source and it is in catch-up mode, delivery reports
+    are polled less frequently and per-tuple debug logging is suppressed.
 
 Input:  (key, value, time)
 
@@ -20,8 +44,10 @@ Sink result:  alert objects sent to kafka cluster.
 
 import json
 import logging
+import time
 import confluent_kafka
 from .. import SentryModule
+from ._ResultStore import ResultStore
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +60,18 @@ add_cfg_schema = {
         "minduration": {"type": "number"},
         "brokers":     {"type": "string"},
         "topic": {"type": "string"},
+        "coalesce":    {
+            "type": "object",
+            "properties": {
+                "window":        {"type": "integer", "minimum": 0},
+                "maxwait":       {"type": "number", "minimum": 0},
+                "maxviolations": {"type": "integer", "exclusiveMinimum": 0},
+            },
+            "additionalProperties": False,
+        },
+        "linger":      {"type": "number", "minimum": 0},
+        "compression": {"enum": ["none", "gzip", "snappy", "lz4", "zstd"]},
+        "database":    {"type": "string"},
         "disable":     {"type": "boolean"}, # for debugging
     },
     "required": ["fqid", "name", "brokers", "topic"],
@@ -44,6 +82,11 @@ STATUS_NORMAL = 0
 STATUS_HIGH = 1
 STATUS_LOW = -1
 
+# Poll for delivery reports once per this many tuples (and at every marker)
+POLL_INTERVAL = 100
+# In catch-up mode, poll for delivery reports once per this many tuples
+CATCHUP_POLL_INTERVAL = 1000
+
 
 class AlertKafka(SentryModule.Sink):
     def __init__(self, config, gen, ctx):
@@ -63,36 +106,76 @@ class AlertKafka(SentryModule.Sink):
             "> %r" % self.max    # 1
         ]
 
-        self.alert_status = dict()  # alert_status[key] = [0,1,-1]
+        self.alert_status = dict()  # alert_status[key] = [1,-1] (not normal)
         self.alert_state = dict()  # alert_state[key] = (time, value, actual, predicted)
+        self.state_keys_indexed = set() # keys returned by new_state_keys
+
+        coalesce = config.get('coalesce', None)
+        self.coalesce = coalesce is not None
+        if self.coalesce:
+            self.window = coalesce.get('window', 0)
+            self.maxwait = coalesce.get('maxwait', 10)
+            self.maxviolations = coalesce.get('maxviolations', 1000)
+        # records[(level, window_start)] = (created, violations) for
+        # coalesced records that have not yet been produced
+        self.records = dict()
+        self.last_t = None
+        self.database = config.get('database', None)
+        self.store = None # ResultStore, while running
+
         kp_cfg = {
             'bootstrap.servers': self.brokers,
         }
+        if 'linger' in config:
+            kp_cfg['linger.ms'] = config['linger']
+        if 'compression' in config:
+            kp_cfg['compression.type'] = config['compression']
         self.kproducer = confluent_kafka.Producer(kp_cfg)
         try:
             self.method = ctx['method']
         except KeyError as e:
             raise RuntimeError('%s expects ctx[%s] to be set by a previous '
                 'module' % (self.modname, str(e)))
+        self.includeabsolute = ctx.get('includeabsolute', False)
+        self.lag = ctx.get('lag', None)
 
     def _produce_alert(self, status, t, key, value, actual, predicted):
+        level = "critical" if status != 0 else "normal"
+        violation = {
+            "expression": str(key, 'ascii'),
+            "condition": self.condition_label[status + 1],
+            "value": value if actual is None else actual,
+            "history_value": predicted,  # may be None
+            "history": None,
+            "time": t,
+        }
+        if self.store is not None:
+            self.store.add_alert(key, t, level, violation["condition"],
+                violation["value"], predicted)
+        if not self.coalesce:
+            self._produce_record(level, t, [violation], key)
+            return
+        window_start = t - t % self.window if self.window else t
+        record = self.records.get((level, window_start))
+        if record is None:
+            record = self.records[(level, window_start)] = (time.time(), [])
+        violations = record[1]
+        violations.append(violation)
+        if len(violations) >= self.maxviolations:
+            del self.records[(level, window_start)]
+            self._produce_record(level, window_start, violations, None)
+
+    def _produce_record(self, level, t, violations, key):
         # Cram our alert data into the watchtower-alert legacy format
         record = {
             "fqid": self.fqid,
             "name": self.name,
-            "level": "critical" if status != 0 else "normal",
+            "level": level,
             "time": t,
             "expression": None,
             "history_expression": None,
             "method": self.method,
-            "violations": [{
-                "expression": str(key, 'ascii'),
-                "condition": self.condition_label[status + 1],
-                "value": value if actual is None else actual,
-                "history_value": predicted,  # may be None
-                "history": None,
-                "time": t,
-            }],
+            "violations": violations,
         }
 
         # Asynchonously produce a message.  The delivery report
@@ -108,103 +191,197 @@ class AlertKafka(SentryModule.Sink):
                                    key=key,
                                    on_delivery=self.kp_delivery_report)
 
+    def _produce_records(self, before, now):
+        # Produce coalesced records whose windows end at or before time
+        # before, or that were created more than maxwait seconds before now
+        window = self.window
+        done = [rkey for rkey, (created, violations) in self.records.items()
+            if (before is not None and rkey[1] + window <= before and
+                rkey[1] < before) or created + self.maxwait <= now]
+        for rkey in done:
+            created, violations = self.records.pop(rkey)
+            self._produce_record(rkey[0], rkey[1], violations, None)
+
+    def _update_status(self, key, alert_status, t, value, actual, predicted):
+        old_status = self.alert_status.get(key, STATUS_NORMAL)
+        # XXX: following can probably be refactored
+        if alert_status != old_status:
+            # change in status, either trigger an alert or defer and keep
+            # state
+            if alert_status == STATUS_NORMAL:
+                del self.alert_status[key]
+            else:
+                self.alert_status[key] = alert_status
+
+            if self.minduration is None or self.minduration == 0:
+                # minduration is disabled, so trigger alert now
+                self._produce_alert(alert_status, t, key, value,
+                                    actual, predicted)
+            elif alert_status == STATUS_NORMAL:
+                # back to normal
+                if key not in self.alert_state:
+                    # back to normal, but we have a minduration set, so we
+                    # would have tracked state for this event. given that
+                    # there is no state, it means the event was long enough
+                    # to trigger an alert, so we need to trigger the
+                    # normal event
+                    logger.info("Creating normal alert for %s at %d",
+                                key, t)
+                    self._produce_alert(alert_status, t, key, value,
+                                        actual, predicted)
+                else:
+                    # back to normal, and we have a minduration, so given
+                    # that there is state being tracked, we haven't yet
+                    # reached the minduration, so the outage must have been
+                    # too short, just clean up state
+                    (init_t, init_v, init_a, init_p) = self.alert_state[key]
+                    logger.info("Discarding suppressed alert for '%s' "
+                                "(init_t: %d, t: %d, minduration: %d)",
+                                key, init_t, t, self.minduration)
+                    if (t - init_t) > self.minduration:
+                        logger.warning("Discarding suppressed alert for "
+                                       "'%s' that exceeds minduration "
+                                       "(init_t: %d, t: %d, minduration: %d)",
+                                       key, init_t, t, self.minduration)
+                    del self.alert_state[key]
+            else:
+                # we have a minduration, and this is an "outage" event,
+                # start tracking state
+                self.alert_state[key] = (t, value, actual, predicted)
+                logger.info("Suppressing alert for %s", key)
+        elif alert_status != STATUS_NORMAL:
+            # continuation of the event (but not continuation of normal)
+            if key in self.alert_state:
+                # we're tracking state about this event, so we haven't
+                # yet triggered the alert. check the duration and maybe
+                # trigger the alert
+                (init_t, init_v, init_a, init_p) = self.alert_state[key]
+                if (init_t + self.minduration) <= t:
+                    logger.info("Suppressed alert for '%s' passed minduration "
+                                "(init_t: %d, t: %d, minduration: %d)",
+                                key, init_t, t, self.minduration)
+                    self._produce_alert(alert_status, init_t, key, init_v,
+                                        init_a, init_p)
+                    del self.alert_state[key]
+                else:
+                    logger.info("Continuing to suppress alert for %s "
+                                "(duration: %d)", key, t - init_t)
+
+    # State server read API (see StateServer)
+
+    def new_state_keys(self):
+        # only keys that have been out of normal are indexed
+        new = [key for key in self.alert_status
+            if key not in self.state_keys_indexed]
+        self.state_keys_indexed.update(new)
+        return new
+
+    def key_state(self, key, window):
+        status = self.alert_status.get(key, STATUS_NORMAL)
+        state = {"status": self.condition_label[status + 1]}
+        if key in self.alert_state:
+            # alert is suppressed until it lasts minduration
+            state["suppressedsince"] = self.alert_state[key][0]
+        return state
+
     def run(self):
         logger.debug("AlertKafka.run()")
+        if self.database is not None:
+            self.store = ResultStore(self.database)
+        try:
+            self._run()
+        finally:
+            if self.store is not None:
+                self.store.close()
+                self.store = None
+        logger.debug("AlertKafka.run() done")
+
+    def _run(self):
+        lag = self.lag
+        store = self.store
+        debug = logger.isEnabledFor(logging.DEBUG)
+        poll = self.kproducer.poll
+        # NaN is neither too low nor too high
+        low = self.min if self.min is not None else float('-inf')
+        high = self.max if self.max is not None else float('inf')
+        # alert_status holds only keys whose status is not normal
+        abnormal = self.alert_status
+        unpolled = 0
         for entry in self.gen():
-            logger.debug("AK: %s", str(entry))
             key, value, t = entry
 
-            # Trigger any available delivery report callacks from previous
-            # produce() calls
-            self.kproducer.poll(0)
+            # Trigger any available delivery report callbacks from previous
+            # produce() calls, once per poll_interval tuples
+            unpolled += 1
+            if lag is not None and lag.catchup:
+                if unpolled >= CATCHUP_POLL_INTERVAL:
+                    poll(0)
+                    unpolled = 0
+            else:
+                if debug:
+                    logger.debug("AK: %s", entry)
+                if unpolled >= POLL_INTERVAL:
+                    poll(0)
+                    unpolled = 0
+
+            if self.records:
+                # produce coalesced records that are complete or too old
+                # (the first record is the oldest)
+                now = time.time()
+                if key is None: # marker
+                    self._produce_records(
+                        t if value == SentryModule.WATERMARK else None, now)
+                elif t != self.last_t or \
+                        next(iter(self.records.values()))[0] + \
+                        self.maxwait <= now:
+                    self._produce_records(t, now)
+            if key is None: # marker
+                # the source may be idle, so poll now
+                poll(0)
+                unpolled = 0
+                if store is not None:
+                    store.commit()
+                continue
+            if store is not None and t != self.last_t:
+                store.maybe_commit()
+            self.last_t = t
 
-            if isinstance(value, tuple):
-                (value, actual, predicted) = value
+            if type(value) is tuple:
+                # (ratio, actual, predicted) if includeabsolute is set,
+                # otherwise (ratio), possibly followed by other stats' values
+                # (see MovingStat stats parameter)
+                ratio = value[0]
             else:
-                actual = None
-                predicted = None
+                ratio = value
 
-            if value is None:
+            if ratio is None:
                 continue
 
-            if key not in self.alert_status:
-                # default to normal status
-                self.alert_status[key] = STATUS_NORMAL
-            if self.min is not None and value < self.min:
+            if ratio < low:
                 # "too-low" alert
                 alert_status = STATUS_LOW
-            elif self.max is not None and value > self.max:
+            elif ratio > high:
                 # "too-high" alert
                 alert_status = STATUS_HIGH
+            elif key not in abnormal:
+                # continuation of normal, who cares
+                continue
             else:
                 # "normal" alert
                 alert_status = STATUS_NORMAL
 
-            # XXX: following can probably be refactored
-            if alert_status != self.alert_status[key]:
-                # change in status, either trigger an alert or defer and keep
-                # state
-                self.alert_status[key] = alert_status
-
-                if self.minduration is None or self.minduration == 0:
-                    # minduration is disabled, so trigger alert now
-                    self._produce_alert(alert_status, t, key, value,
-                                        actual, predicted)
-                elif alert_status == STATUS_NORMAL:
-                    # back to normal
-                    if key not in self.alert_state:
-                        # back to normal, but we have a minduration set, so we
-                        # would have tracked state for this event. given that
-                        # there is no state, it means the event was long enough
-                        # to trigger an alert, so we need to trigger the
-                        # normal event
-                        logger.info("Creating normal alert for %s at %d" %
-                                    (key, t))
-                        self._produce_alert(alert_status, t, key, value,
-                                            actual, predicted)
-                    else:
-                        # back to normal, and we have a minduration, so given
-                        # that there is state being tracked, we haven't yet
-                        # reached the minduration, so the outage must have been
-                        # too short, just clean up state
-                        (init_t, init_v, init_a, init_p) = self.alert_state[key]
-                        logger.info("Discarding suppressed alert for '%s' "
-                                    "(init_t: %d, t: %d, minduration: %d)"
-                                    % (key, init_t, t, self.minduration))
-                        if (t - init_t) > self.minduration:
-                            logger.warning("Discarding suppressed alert for "
-                                           "'%s' that exceeds minduration "
-                                           "(init_t: %d, t: %d, minduration: %d)"
-                                           % (key, init_t, t, self.minduration))
-                        del self.alert_state[key]
-                else:
-                    # we have a minduration, and this is an "outage" event,
-                    # start tracking state
-                    self.alert_state[key] = (t, value, actual, predicted)
-                    logger.info("Suppressing alert for %s" % key)
-            elif alert_status != STATUS_NORMAL:
-                # continuation of the event (but not continuation of normal)
-                if key in self.alert_state:
-                    # we're tracking state about this event, so we haven't
-                    # yet triggered the alert. check the duration and maybe
-                    # trigger the alert
-                    (init_t, init_v, init_a, init_p) = self.alert_state[key]
-                    if (init_t + self.minduration) <= t:
-                        logger.info("Suppressed alert for '%s' passed minduration "
-                                    "(init_t: %d, t: %d, minduration: %d)" %
-                                    (key, init_t, t, self.minduration))
-                        self._produce_alert(alert_status, init_t, key, init_v,
-                                            init_a, init_p)
-                        del self.alert_state[key]
-                    else:
-                        logger.info("Continuing to suppress alert for %s "
-                                    "(duration: %d)" % (key, t - init_t))
+            if type(value) is tuple and self.includeabsolute:
+                (value, actual, predicted) = value[:3]
             else:
-                # continuation of normal, who cares
-                pass
+                value = ratio
+                actual = None
+                predicted = None
+            self._update_status(key, alert_status, t, value, actual,
+                predicted)
 
+        if self.records:
+            self._produce_records(None, float('inf'))
         self.kproducer.flush()
-        logger.debug("AlertKafka.run() done")
 
     def kp_delivery_report(self, err, msg):
         if err is not None:
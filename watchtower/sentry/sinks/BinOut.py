@@ -0,0 +1,48 @@
+"""Sink that writes (k,v,t) tuples to a columnar binary file.
+
+See BinFormat for a description of the file format.  The file can be read
+with the BinIn source.
+
+Configuration parameters ('*' indicates required parameter):
+    file*: (string) Name of output file.
+    blocksize: (integer, default 65536) Number of tuples per block.
+
+Input:  (key, value, time)
+    value may be a number, null, or a tuple of numbers or nulls.
+
+Sink result:  tuples written to specified file.
+"""
+
+import logging
+from .. import SentryModule
+from .. import BinFormat
+
+logger = logging.getLogger(__name__)
+
+add_cfg_schema = {
+    "properties": {
+        "file":      {"type": "string"},
+        "blocksize": {"type": "integer", "exclusiveMinimum": 0},
+    },
+    "required": ["file"]
+}
+
+class BinOut(SentryModule.Sink):
+    def __init__(self, config, gen, ctx):
+        logger.debug("BinOut.__init__")
+        super().__init__(config, logger, gen)
+        self.filename = config['file']
+        self.blocksize = config.get('blocksize', 65536)
+
+    def run(self):
+        logger.debug("BinOut.run()")
+        writer = BinFormat.Writer(self.filename, self.blocksize)
+        try:
+            write = writer.write
+            for entry in self.gen():
+                if entry[0] is None: # marker
+                    continue
+                write(*entry)
+        finally:
+            writer.close()
+        logger.debug("BinOut.run() done")
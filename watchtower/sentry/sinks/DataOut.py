@@ -31,6 +31,8 @@ class DataOut(SentryModule.Sink):
         logger.debug("DataOut.run()")
         for entry in self.gen():
             key, value, t = entry
+            if key is None: # marker
+                continue
             key = str(key, 'ascii')
             self.output.append((key, value, t))
         logger.debug("DataOut.run() done")
@@ -1,28 +1,82 @@
 """Sink that writes (k,v,t) tuples to a JSON file.
 
+Each tuple is written as a JSON array on its own line.
+
 Configuration parameters ('*' indicates required parameter):
     file: (string) Name of output file.  If "-" or omitted, write to stdout.
+        If rotate is set, the name may contain strftime() conversions (e.g.
+        "out-%Y%m%d-%H%M.jsonl"), which are expanded with the start time (in
+        UTC) of each file: the start of its interval if rotate.interval is
+        set, otherwise the time of its first tuple.
     compact: (boolean, default true)
+    compression: (string) Compress output with "gzip" or "zstd" (zstd
+        requires the zstandard package).
+    rotate: (object) Write a sequence of files instead of a single file.  A
+        new file is started when either limit is reached.
+        size: (integer) Max number of bytes of (uncompressed) JSON in a file.
+            A file may exceed this by at most one line.
+        interval: (integer) Length of time (in seconds) covered by a file.
+            Files are aligned to multiples of interval.  A new file is
+            started when a tuple for a later interval arrives; tuples for an
+            earlier interval go in the current file.
+    buffersize: (integer, default 1048576) Size (in bytes) of the output
+        file buffer.
+    thread: (boolean) Encode and write output in a background thread, so
+        that the rest of the pipeline doesn't wait for it.
 
 Input:  (key, value, time)
 
-Sink result:  tuples written to specified file.
+Sink result:  tuples written to specified file(s).
+
+Without rotate, output is written directly to file (so it can be followed
+with e.g. "tail -f").  With rotate, each file is written under a temporary
+name (its final name with ".part" appended), and renamed to its final name
+when it is complete, so a file with its final name can safely be read or
+archived.  If the pipeline fails, the incomplete file keeps its ".part"
+name.  If a rotated file's name is the same as an earlier file's, a
+sequence number is inserted before the extension (e.g. "out-1.jsonl").
+Tuples are encoded and written in batches; a marker in the input writes
+out the current batch.
 """
 
-import sys
-import logging
+import gzip
 import json
+import logging
+import math
+import os
+import queue
+import sys
+import threading
+import time
 from .. import SentryModule
 
 logger = logging.getLogger(__name__)
 
 add_cfg_schema = {
     "properties": {
-        "file": {"type": "string"},
-        "compact": {"type": "boolean"}
+        "file":        {"type": "string"},
+        "compact":     {"type": "boolean"},
+        "compression": {"enum": ["gzip", "zstd"]},
+        "rotate": {
+            "type": "object",
+            "properties": {
+                "size":     {"type": "integer", "exclusiveMinimum": 0},
+                "interval": {"type": "integer", "exclusiveMinimum": 0},
+            },
+            "additionalProperties": False,
+            "minProperties": 1,
+        },
+        "buffersize":  {"type": "integer", "exclusiveMinimum": 0},
+        "thread":      {"type": "boolean"},
     },
 }
 
+BATCH_SIZE = 1000 # max number of tuples to encode and write at once
+QUEUE_SIZE = 100  # max number of batches waiting for the writer thread
+# Batch queue items that tell the writer thread to stop
+END = None        # input ended normally
+ABORT = False     # pipeline failed
+
 class JsonOut(SentryModule.Sink):
     def __init__(self, config, gen, ctx):
         logger.debug("JsonOut.__init__")
@@ -30,19 +84,214 @@ class JsonOut(SentryModule.Sink):
         self.filename = config.get('file', '-')
         self.separators = (',', ':') if config.get('compact', True) \
             else (', ', ': ')
+        self.compression = config.get('compression', None)
+        rotate = config.get('rotate', None)
+        self.rotating = rotate is not None
+        if self.rotating and self.filename == '-':
+            raise SentryModule.UserError("module %s: rotate requires file"
+                % self.modname)
+        rotate = rotate or {}
+        self.maxsize = rotate.get('size', math.inf)
+        self.interval = rotate.get('interval', None)
+        self.buffersize = config.get('buffersize', 1 << 20)
+        self.threaded = config.get('thread', False)
+        if self.compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise SentryModule.UserError("module %s: zstd compression "
+                    "requires the zstandard package" % self.modname)
+            self.zstd = zstandard.ZstdCompressor()
+
+        self.encode = json.JSONEncoder(separators=self.separators).encode
+        self.prefixes = dict() # prefixes[key] = encoded start of key's lines
+        self.names = set()     # names of files written
+        self.name = None       # final name of current file (None for stdout)
+        self.raw = None        # current file
+        self.stream = None     # current file, or compressor writing to it
+        self.size = 0          # bytes written to current file
+        self.next_rotation = -math.inf # time at which to start a new file
+        self.writer_exc = None
+
+    def _unique_name(self, name):
+        """Return name, modified if necessary to differ from the names of
+        files already written"""
+        dirname, basename = os.path.split(name)
+        dot = basename.find('.', 1)
+        if dot < 0:
+            dot = len(basename)
+        base = os.path.join(dirname, basename[:dot])
+        n = 0
+        while name in self.names:
+            n += 1
+            name = '%s-%d%s' % (base, n, basename[dot:])
+        self.names.add(name)
+        return name
+
+    def _open(self, start):
+        if self.filename == '-':
+            self.name = None
+            self.raw = sys.stdout.buffer if self.compression else sys.stdout
+        else:
+            if self.rotating:
+                self.name = self._unique_name(
+                    time.strftime(self.filename, time.gmtime(start)))
+                path = self.name + '.part'
+            else:
+                self.name = path = self.filename
+            self.raw = open(path, 'wb', buffering=self.buffersize)
+        if self.compression == 'gzip':
+            self.stream = gzip.GzipFile(filename='', mode='wb',
+                fileobj=self.raw, compresslevel=6)
+        elif self.compression == 'zstd':
+            self.stream = self.zstd.stream_writer(self.raw, closefd=False)
+        else:
+            self.stream = self.raw
+
+    # Close the current file.  If complete is false, a rotated file keeps
+    # its ".part" name.
+    def _close(self, complete):
+        stream = self.stream
+        self.stream = None
+        try:
+            if stream is not self.raw:
+                stream.close() # finish compressed data; leaves raw open
+        finally:
+            if self.name is None:
+                self.raw.flush()
+            else:
+                self.raw.close()
+        if self.name is None:
+            pass
+        elif not self.rotating:
+            logger.info("JsonOut: wrote %s", self.name)
+        elif complete:
+            os.replace(self.name + '.part', self.name)
+            logger.info("JsonOut: wrote %s", self.name)
+        else:
+            logger.warning("JsonOut: left incomplete %s.part", self.name)
+
+    # Start a new file for a tuple with time t, and return the time at which
+    # the file after that should start.
+    def _rotate(self, t):
+        if self.stream is not None:
+            self._close(True)
+        if not self.rotating:
+            self._open(None)
+            return math.inf
+        if self.interval:
+            start = t - t % self.interval
+            self._open(start)
+            return start + self.interval
+        self._open(t)
+        return math.inf
+
+    def _output(self, lines):
+        data = ''.join(lines)
+        if self.stream is sys.stdout:
+            self.stream.write(data)
+        else:
+            self.stream.write(data.encode('ascii'))
+
+    def _write(self, entries):
+        """Encode and write a batch of tuples"""
+        prefixes = self.prefixes
+        encode = self.encode
+        sep = self.separators[0]
+        maxsize = self.maxsize
+        next_rotation = self.next_rotation
+        size = self.size
+        lines = []
+        for key, value, t in entries:
+            prefix = prefixes.get(key)
+            if prefix is None:
+                prefix = prefixes[key] = '[' + encode(str(key, 'ascii')) + sep
+            # encode((value, t)) is '[value,t]'; replace its '[' with prefix
+            line = prefix + encode((value, t))[1:] + '\n'
+            if t >= next_rotation or size >= maxsize:
+                if lines:
+                    self._output(lines)
+                    lines = []
+                next_rotation = self._rotate(t)
+                size = 0
+            lines.append(line)
+            size += len(line)
+        if lines:
+            self._output(lines)
+        self.next_rotation = next_rotation
+        self.size = size
+
+    # Close the output.  complete is true if the input ended normally.
+    def _finish(self, complete):
+        if complete and self.stream is None and not self.rotating:
+            self._rotate(None) # create the (empty) file
+        if self.stream is not None:
+            self._close(complete)
+
+    def _write_inline(self, batch):
+        try:
+            self._write(batch)
+        except BaseException as e:
+            self.writer_exc = e
+            self._finish(False)
+            raise
+
+    def _writer_body(self, batches):
+        complete = False
+        try:
+            while True:
+                batch = batches.get()
+                if batch is END:
+                    complete = True
+                    break
+                if batch is ABORT:
+                    break
+                self._write(batch)
+        except BaseException as e:
+            self.writer_exc = e
+            # discard remaining batches, so the main thread doesn't block
+            while batches.get() not in (END, ABORT):
+                pass
+        try:
+            self._finish(complete)
+        except BaseException as e:
+            if self.writer_exc is None:
+                self.writer_exc = e
 
     def run(self):
         logger.debug("JsonOut.run()")
-        f = sys.stdout
+        if self.threaded:
+            batches = queue.Queue(QUEUE_SIZE)
+            writer = threading.Thread(target=self._writer_body,
+                args=(batches,), name="JsonOut")
+            writer.start()
+            write = batches.put
+        else:
+            write = self._write_inline
+        complete = False
         try:
-            if self.filename != '-':
-                f = open(self.filename, 'w')
+            batch = []
             for entry in self.gen():
-                key, value, t = entry
-                key = str(key, 'ascii')
-                json.dump((key, value, t), f, separators=self.separators)
-                f.write('\n')
+                if entry[0] is None: # marker
+                    if batch:
+                        write(batch)
+                        batch = []
+                    continue
+                batch.append(entry)
+                if len(batch) >= BATCH_SIZE:
+                    write(batch)
+                    batch = []
+                    if self.writer_exc is not None:
+                        break
+            if batch:
+                write(batch)
+            complete = True
         finally:
-            if f is not sys.stdout:
-                f.close()
+            if self.threaded:
+                batches.put(END if complete else ABORT)
+                writer.join()
+            elif self.writer_exc is None:
+                self._finish(complete)
+        if self.writer_exc is not None:
+            raise self.writer_exc
         logger.debug("JsonOut.run() done")
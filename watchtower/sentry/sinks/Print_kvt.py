@@ -12,5 +12,7 @@ class Print_kvt(SentryModule.Sink):
     def run(self):
         logger.debug("Print_kvt.run()")
         for entry in self.gen():
+            if entry[0] is None: # marker
+                continue
             print(str(entry))
         logger.debug("Print_kvt.run() done")
@@ -0,0 +1,87 @@
+"""Sink that writes (k,v,t) tuples to a SQLite database.
+
+The database can be queried by key pattern and time range while the
+pipeline is running, e.g. for post-incident analysis of MovingStat output.
+See _ResultStore for the schema and an example query.
+
+Configuration parameters ('*' indicates required parameter):
+    file*: (string) Name of database file.  It is created if it doesn't
+        exist; otherwise, new rows are added to it.
+    batchsize: (integer, default 10000) Max number of rows to insert in one
+        transaction.
+    commitinterval: (number, default 5) Max time (in seconds) to hold rows
+        before committing them.  Rows are also committed when a marker
+        arrives and at the end of input.
+
+Input context variables: includeabsolute
+    Set by MovingStat.
+
+Input:  (key, value, time)
+    value may be a number or null, which is stored in the value column; or,
+    if includeabsolute is set, a (ratio, actual, predicted, ...) tuple from
+    MovingStat, which is stored in the value, actual, and predicted
+    columns (additional values from the MovingStat stats parameter are not
+    stored).  Any other tuple (e.g. the ratios of several statistics from
+    MovingStat without includeabsolute) is an error.
+
+Sink result:  tuples written to the results table of the database.
+"""
+
+import logging
+from .. import SentryModule
+from ._ResultStore import ResultStore
+
+logger = logging.getLogger(__name__)
+
+add_cfg_schema = {
+    "properties": {
+        "file":           {"type": "string"},
+        "batchsize":      {"type": "integer", "exclusiveMinimum": 0},
+        "commitinterval": {"type": "number", "minimum": 0},
+    },
+    "required": ["file"]
+}
+
+class SQLite(SentryModule.Sink):
+    def __init__(self, config, gen, ctx):
+        logger.debug("SQLite.__init__")
+        super().__init__(config, logger, gen)
+        self.filename = config['file']
+        self.batchsize = config.get('batchsize', 10000)
+        self.commitinterval = config.get('commitinterval', 5)
+        self.includeabsolute = ctx.get('includeabsolute', False)
+
+    def run(self):
+        logger.debug("SQLite.run()")
+        store = ResultStore(self.filename, self.batchsize,
+            self.commitinterval)
+        try:
+            # Appending to store.results directly, instead of calling
+            # store.add_result(), saves a call per tuple
+            results = store.results
+            batchsize = self.batchsize
+            includeabsolute = self.includeabsolute
+            last_t = None
+            for entry in self.gen():
+                key, value, t = entry
+                if key is None: # marker
+                    store.commit()
+                    continue
+                if t != last_t:
+                    # check the clock only when the time changes
+                    store.maybe_commit()
+                    last_t = t
+                if type(value) is tuple:
+                    if not includeabsolute:
+                        raise SentryModule.UserError("module %s: can't store "
+                            "tuple value %r of %s (only MovingStat output "
+                            "with includeabsolute is supported)" %
+                            (self.modname, value, key))
+                    results.append((key, t, *value[:3]))
+                else:
+                    results.append((key, t, value, None, None))
+                if len(results) >= batchsize:
+                    store.commit()
+        finally:
+            store.close()
+        logger.debug("SQLite.run() done")
@@ -0,0 +1,164 @@
+"""SQLite database of pipeline results and alerts.
+
+Used by the SQLite sink (results) and AlertKafka (alerts); both may write to
+the same database file.  The schema is:
+
+    keys (id INTEGER PRIMARY KEY, key TEXT UNIQUE)
+    results (key_id, time, value, actual, predicted)
+        indexed on (key_id, time)
+    alerts (key_id, time, level, condition, value, predicted)
+        indexed on (key_id, time)
+
+For a MovingStat result, value is the ratio of actual to predicted; for any
+other result, value is the input value, and actual and predicted are null.
+Null and NaN values are stored as NULL.
+
+The database uses write-ahead logging, so it can be queried while the
+pipeline is writing to it.  For example, to get the results for the keys
+matching "geo.US.*" in a time range:
+
+    SELECT key, time, value, actual, predicted
+        FROM keys JOIN results ON results.key_id = keys.id
+        WHERE key GLOB 'geo.US.*' AND time >= 1600000000 AND time < 1600086400
+        ORDER BY key, time;
+"""
+
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS keys (
+    id INTEGER PRIMARY KEY,
+    key TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS results (
+    key_id INTEGER NOT NULL REFERENCES keys(id),
+    time INTEGER NOT NULL,
+    value REAL,
+    actual REAL,
+    predicted REAL);
+CREATE INDEX IF NOT EXISTS results_key_time ON results (key_id, time);
+CREATE TABLE IF NOT EXISTS alerts (
+    key_id INTEGER NOT NULL REFERENCES keys(id),
+    time INTEGER NOT NULL,
+    level TEXT NOT NULL,
+    condition TEXT NOT NULL,
+    value REAL,
+    predicted REAL);
+CREATE INDEX IF NOT EXISTS alerts_key_time ON alerts (key_id, time);
+"""
+
+
+class ResultStore:
+    """Writes results and alerts to a SQLite database.
+
+    Rows are buffered and inserted in one transaction per batch: when
+    batchsize rows are pending, when the owner calls commit(), or when it
+    calls maybe_commit() more than commitinterval seconds after the last
+    commit.
+    """
+    def __init__(self, filename, batchsize=10000, commitinterval=5):
+        self.filename = filename
+        self.batchsize = batchsize
+        self.commitinterval = commitinterval
+        # Transactions are managed explicitly.  The timeout lets another
+        # ResultStore on the same file finish its transaction.
+        self.conn = sqlite3.connect(filename, timeout=60,
+            isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # Checkpoint the WAL less often than the default 1000 pages, since
+        # checkpoints dominate the cost of frequent commits; and keep more of
+        # the (key_id, time) indexes in memory.
+        self.conn.execute("PRAGMA wal_autocheckpoint=10000")
+        self.conn.execute("PRAGMA cache_size=-65536") # KiB
+        self.conn.executescript(SCHEMA)
+        self.key_ids = dict() # key_ids[key] = id of key in keys table
+        self.max_key_id = 0
+        self._load_keys()
+        self.results = [] # pending (key, time, value, actual, predicted)
+        self.alerts = []  # pending (key, time, level, condition, value,
+                          #     predicted)
+        self.last_commit = time.time()
+
+    def add_result(self, key, t, value, actual, predicted):
+        self.results.append((key, t, value, actual, predicted))
+        if len(self.results) >= self.batchsize:
+            self.commit()
+
+    def add_alert(self, key, t, level, condition, value, predicted):
+        self.alerts.append((key, t, level, condition, value, predicted))
+        if len(self.alerts) >= self.batchsize:
+            self.commit()
+
+    def _load_keys(self):
+        # Keys are only ever added, with increasing ids, so we need only
+        # those with ids greater than any we already have.
+        key_ids = self.key_ids
+        for key_id, key in self.conn.execute(
+                "SELECT id, key FROM keys WHERE id > ?", (self.max_key_id,)):
+            key_ids[bytes(key, 'ascii')] = key_id
+            self.max_key_id = key_id
+
+    def _add_keys(self, rows):
+        key_ids = self.key_ids
+        new_keys = [key for key in dict.fromkeys(row[0] for row in rows)
+            if key not in key_ids]
+        # Another ResultStore may have added some of these keys already.
+        self.conn.executemany("INSERT OR IGNORE INTO keys (key) VALUES (?)",
+            [(str(key, 'ascii'),) for key in new_keys])
+        self._load_keys()
+
+    def _insert_results(self):
+        key_ids = self.key_ids
+        try:
+            rows = [(key_ids[key], t, value, actual, predicted)
+                for key, t, value, actual, predicted in self.results]
+        except KeyError:
+            self._add_keys(self.results)
+            rows = [(key_ids[key], t, value, actual, predicted)
+                for key, t, value, actual, predicted in self.results]
+        self.conn.executemany("INSERT INTO results VALUES (?,?,?,?,?)", rows)
+
+    def _insert_alerts(self):
+        self._add_keys(self.alerts)
+        key_ids = self.key_ids
+        self.conn.executemany("INSERT INTO alerts VALUES (?,?,?,?,?,?)",
+            [(key_ids[row[0]],) + row[1:] for row in self.alerts])
+
+    def commit(self):
+        self.last_commit = time.time()
+        if not self.results and not self.alerts:
+            return
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self.results:
+                self._insert_results()
+            if self.alerts:
+                self._insert_alerts()
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            # key ids added in the failed transaction are not valid
+            self.key_ids = dict()
+            self.max_key_id = 0
+            self._load_keys()
+            raise
+        logger.debug("ResultStore: committed %d results and %d alerts to %s",
+            len(self.results), len(self.alerts), self.filename)
+        # clear in place; the SQLite sink appends to self.results directly
+        self.results.clear()
+        self.alerts.clear()
+
+    def maybe_commit(self):
+        if self.last_commit + self.commitinterval <= time.time():
+            self.commit()
+
+    def close(self):
+        try:
+            self.commit()
+        finally:
+            self.conn.close()
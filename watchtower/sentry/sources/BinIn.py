@@ -0,0 +1,61 @@
+"""Source that reads (k,v,t) tuples from a columnar binary file.
+
+The file is memory-mapped, and blocks whose time range lies entirely outside
+of [starttime, endtime) are skipped without being read.  See BinFormat for a
+description of the file format.  Files can be written with the BinOut sink.
+
+Configuration parameters ('*' indicates required parameter):
+    file*: (string) Name of input file.
+    starttime: (string) Read data at or after this time.
+        Format: 'YYYY-mm-dd [HH:MM[:SS]]'.
+    endtime: (string) Read data before this time.
+        Format: 'YYYY-mm-dd [HH:MM[:SS]]'.
+
+Output context variables: expression
+
+Output:  (key, value, time)
+"""
+
+import logging
+from .. import SentryModule
+from .. import BinFormat
+
+logger = logging.getLogger(__name__)
+
+add_cfg_schema = {
+    "properties": {
+        "file":      {"type": "string"},
+        "starttime": {"type": "string"},
+        "endtime":   {"type": "string"},
+    },
+    "required": ["file"]
+}
+
+class BinIn(SentryModule.Source):
+
+    def __init__(self, config, gen, ctx):
+        logger.debug("BinIn.__init__")
+        super().__init__(config, logger, gen)
+        self.filename = config['file']
+        self.start_time = SentryModule.strtimegm(config['starttime']) \
+            if 'starttime' in config else None
+        self.end_time = SentryModule.strtimegm(config['endtime']) \
+            if 'endtime' in config else None
+        ctx['expression'] = self.filename # for AlertKafka
+
+    def run(self):
+        logger.debug("BinIn.run()")
+        try:
+            reader = BinFormat.Reader(self.filename)
+        except ValueError as e:
+            raise SentryModule.UserError("module %s: %s" %
+                (self.modname, str(e))) from None
+        entries = reader.read(self.start_time, self.end_time)
+        try:
+            yield from entries
+        finally:
+            logger.debug("BinIn.run() finally")
+            entries.close() # release references into the mapped file
+            reader.close()
+
+        logger.debug("BinIn.run() done")
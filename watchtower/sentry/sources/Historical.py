@@ -13,10 +13,14 @@ Configuration parameters ('*' indicates required parameter):
     ignorenull: (boolean, default false) If true, null values will be skipped.
         If false, null values will be treated as 0.
     queryparams: (object) Dictionary of extra parameters to pass to the API.
+    heartbeat: (number) Emit a heartbeat marker after this many seconds
+        without data.
 
 Output context variables: expression
 
 Output:  (key, value, time)
+    After the data of each batch, a watermark marker with the end time of
+    the batch.
 """
 
 import logging
@@ -35,6 +39,7 @@ add_cfg_schema = {
         "batchduration": {"type": "integer", "exclusiveMinimum": 0},
         "ignorenull":    {"type": "boolean"},
         "queryparams":   {"type": "object"},
+        "heartbeat":     {"type": "number", "exclusiveMinimum": 0},
     },
     "required": ["expression", "starttime", "endtime", "url", "batchduration"]
 }
@@ -99,6 +104,7 @@ class Historical(Datasource):
             for value in record['values']:
                 self.incoming.append((ascii_key, value, t))
                 t += step
+        self.incoming.append((None, SentryModule.WATERMARK, self.end_batch))
         # tell computation thread that self.incoming is now full
         with self.cond_consumable:
             logger.debug("cond_consumable.notify")
@@ -1,7 +1,22 @@
-"""Source that reads (k,v,t) tuples from a JSON file.
+"""Source that reads (k,v,t) tuples from JSON files.
 
 Configuration parameters ('*' indicates required parameter):
     file: (string) Name of input file.  If "-" or omitted, read from stdin.
+    files: (array) Names or glob patterns of input files, read in the order
+        listed (files matching a single glob pattern are read in sorted
+        order).  May not be combined with {file}.
+    workers: (integer, default 0) Number of worker processes used to parse
+        JSON.  If 0, parsing is done in the main process.  Parsed records
+        are pickled back from the workers, which costs a good part of what
+        parsing in them saves, so this only helps when JSON parsing is the
+        bottleneck and there are spare CPU cores; with a single core it is
+        slower.  Use test/bench_jsonin.py to compare settings.
+    chunksize: (integer, default 4194304) Approximate number of bytes of input
+        to hand to a worker process at once.
+
+Input files may be compressed with gzip, bzip2, xz, or zstd (the latter
+requires the zstandard package); compression is detected automatically.
+Records are output in the same order they appear in the input files.
 
 Output context variables: expression
 
@@ -10,7 +25,13 @@ Output:  (key, value, time)
 
 import logging
 import json
-import fileinput
+import sys
+import glob
+import gzip
+import bz2
+import lzma
+import collections
+import concurrent.futures
 from .. import SentryModule
 
 logger = logging.getLogger(__name__)
@@ -18,25 +39,140 @@ logger = logging.getLogger(__name__)
 add_cfg_schema = {
     "properties": {
         "file": {"type": "string"},  # omitted or "-" means stdin
-    }
+        "files": {
+            "type": "array",
+            "items": {"type": "string"},
+            "minItems": 1
+        },
+        "workers":   {"type": "integer", "minimum": 0},
+        "chunksize": {"type": "integer", "exclusiveMinimum": 0},
+    },
+    "not": {"required": ["file", "files"]}
 }
 
+# magic number prefixes of compressed file formats
+MAGIC_GZIP = b'\x1f\x8b'
+MAGIC_BZIP2 = b'BZh'
+MAGIC_XZ = b'\xfd7zXZ\x00'
+MAGIC_ZSTD = b'\x28\xb5\x2f\xfd'
+
+
+def _open(filename):
+    """Open a binary stream for filename ("-" means stdin), transparently
+    decompressing it if needed.  Closing the stream closes the underlying
+    file (but not stdin)."""
+    if filename == '-':
+        src = sys.stdin.buffer
+        magic = src.peek(6)[:6]
+    else:
+        src = filename
+        with open(filename, 'rb') as f:
+            magic = f.read(6)
+    if magic.startswith(MAGIC_GZIP):
+        return gzip.open(src, 'rb')
+    if magic.startswith(MAGIC_BZIP2):
+        return bz2.open(src, 'rb')
+    if magic.startswith(MAGIC_XZ):
+        return lzma.open(src, 'rb')
+    if magic.startswith(MAGIC_ZSTD):
+        try:
+            import zstandard
+        except ImportError:
+            raise SentryModule.UserError("%s is zstd-compressed, but the "
+                "zstandard package is not installed" % filename) from None
+        # read_across_frames: multi-frame files (e.g. from pzstd, or
+        # concatenated .zst files) would otherwise end after the first frame
+        if filename == '-':
+            return zstandard.ZstdDecompressor().stream_reader(src,
+                read_across_frames=True, closefd=False)
+        return zstandard.ZstdDecompressor().stream_reader(open(src, 'rb'),
+            read_across_frames=True, closefd=True)
+    return src if filename == '-' else open(src, 'rb')
+
+
+def _read_chunks(f, chunksize):
+    """Read f in chunks of approximately chunksize bytes, each ending on a
+    line boundary."""
+    tail = b''
+    while True:
+        buf = f.read(chunksize)
+        if not buf:
+            break
+        i = buf.rfind(b'\n')
+        if i < 0:
+            tail += buf
+            continue
+        yield tail + buf[:i+1]
+        tail = buf[i+1:]
+    if tail:
+        yield tail
+
+
+def _parse_chunk(chunk):
+    """Parse a chunk of JSONL text into a list of (key, value, time) tuples.
+    (Module-level so it can be called in a worker process.)"""
+    result = []
+    append = result.append
+    loads = json.loads
+    for line in chunk.splitlines():
+        if not line.strip():
+            continue
+        key, value, t = loads(line)
+        append((bytes(key, 'ascii'), value, t))
+    return result
+
+
 class JsonIn(SentryModule.Source):
 
     def __init__(self, config, gen, ctx):
         logger.debug("JsonIn.__init__")
         super().__init__(config, logger, gen)
-        self.filenames = [config['file']] if 'file' in config else []
-        ctx['expression'] = config.get('file', '-') # for AlertKafka
+        patterns = config.get('files', [config.get('file', '-')])
+        self.filenames = []
+        for pattern in patterns:
+            if pattern == '-' or not any(c in pattern for c in '*?['):
+                self.filenames.append(pattern)
+                continue
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise SentryModule.UserError("module %s: no files match %r"
+                    % (self.modname, pattern))
+            self.filenames += matches
+        self.workers = config.get('workers', 0)
+        self.chunksize = config.get('chunksize', 4 * 1024 * 1024)
+        ctx['expression'] = ','.join(patterns) # for AlertKafka
+
+    def _chunks(self):
+        for filename in self.filenames:
+            logger.debug("JsonIn: reading %s", filename)
+            f = _open(filename)
+            try:
+                yield from _read_chunks(f, self.chunksize)
+            finally:
+                if f is not sys.stdin.buffer:
+                    f.close()
+
+    def _parsed_chunks(self):
+        if self.workers == 0:
+            for chunk in self._chunks():
+                yield _parse_chunk(chunk)
+            return
+        # Keep a bounded number of chunks in flight, and collect their
+        # results in submission order to preserve record order.
+        with concurrent.futures.ProcessPoolExecutor(self.workers) as pool:
+            pending = collections.deque()
+            for chunk in self._chunks():
+                pending.append(pool.submit(_parse_chunk, chunk))
+                if len(pending) > 2 * self.workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
 
     def run(self):
         logger.debug("JsonIn.run()")
         try:
-            with fileinput.input(files=self.filenames) as f:
-                for line in f:
-                    key, value, t = json.loads(line)
-                    key = bytes(key, 'ascii')
-                    yield (key, value, t)
+            for records in self._parsed_chunks():
+                yield from records
         finally:
             logger.debug("JsonIn.run() finally")
 
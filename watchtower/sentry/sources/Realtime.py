@@ -7,12 +7,28 @@ Configuration parameters ('*' indicates required parameter):
     consumergroup*: (string) Kafka consumer group.
     topicprefix*: (string) Kafka topic prefix.
     channelname*: (string) Kafka channel name.
+    catchup: (object) Switch the pipeline to a throughput-optimized mode
+        while consumer lag (wall time minus message time) is high.
+        lag*: (number) Enter catch-up mode when lag exceeds this many
+            seconds; leave it when lag falls below half of this.
+        batchsize: (integer, default 100) In catch-up mode, hand off the
+            data from up to this many TSK messages at once.
+        maxdelay: (number, default 1) In catch-up mode, hand off data no
+            later than this many seconds after its TSK message arrived, even
+            if fewer than batchsize messages have arrived.
+    heartbeat: (number) Emit a heartbeat marker after this many seconds
+        without data.
+    watermarks: (boolean) Emit a watermark marker whenever the TSK message
+        time increases, i.e. assume that all data for a time has been
+        delivered once data for a later time arrives.  Set this only if the
+        TSK channel doesn't deliver data out of time order.
 
-Output context variables: expression
+Output context variables: expression, lag
 
 Output:  (key, value, time)
    Output will include some amount (perhaps several days worth) of buffered
    data prior to the near-realtime data.
+   If watermarks is set, watermark markers are interleaved with the data.
 """
 
 import confluent_kafka
@@ -42,6 +58,18 @@ add_cfg_schema = {
         "consumergroup": {"type": "string"},
         "topicprefix":   {"type": "string"},
         "channelname":   {"type": "string"},
+        "heartbeat":     {"type": "number", "exclusiveMinimum": 0},
+        "watermarks":    {"type": "boolean"},
+        "catchup": {
+            "type": "object",
+            "properties": {
+                "lag":       {"type": "number", "exclusiveMinimum": 0},
+                "batchsize": {"type": "integer", "exclusiveMinimum": 0},
+                "maxdelay":  {"type": "number", "minimum": 0},
+            },
+            "additionalProperties": False,
+            "required": ["lag"],
+        },
     },
     "required": ["expressions", "brokers", "consumergroup",
                  "topicprefix", "channelname"]
@@ -61,14 +89,23 @@ class Realtime(Datasource):
                 commit_offsets=True
         )
         self.msg_time = None
+        self.watermarks = config.get('watermarks', False)
         regexes = [SentryModule.glob_to_regex(exp) for exp in self.expressions]
         logger.debug("expressions: %s", self.expressions)
         logger.debug("regexes:     %s", regexes)
         self.expression_res = [re.compile(bytes(regex, 'ascii')) for regex in regexes]
         self.kv_cnt = 0
         self.kv_match_cnt = 0
+        catchup = config.get('catchup', {})
+        self.batchsize = catchup.get('batchsize', 100)
+        self.maxdelay = catchup.get('maxdelay', 1)
+        self.lag = SentryModule.ConsumerLag(catchup.get('lag', None))
+        ctx['lag'] = self.lag # for downstream modules
 
     def _msg_cb(self, msg_time, version, channel, msgbuf, msgbuflen):
+        if self.watermarks and self.msg_time is not None and \
+                msg_time > self.msg_time:
+            self.incoming.append((None, SentryModule.WATERMARK, msg_time))
         self.msg_time = msg_time
 
     def _kv_cb(self, key, val):
@@ -79,17 +116,29 @@ class Realtime(Datasource):
                 self.incoming.append((key, val, self.msg_time))
                 return
 
+    # Hand off the contents of self.incoming to the computation thread.
+    def _handoff(self):
+        with self.cond_consumable:
+            logger.debug("cond_consumable.notify")
+            self.consumable = True
+            self.cond_consumable.notify()
+
     def reader_body(self):
         logger.debug("realtime.run_reader()")
         last_log_time = time.time()
+        pending = 0 # number of messages in self.incoming not yet handed off
+        pending_since = None # time of the first of those messages
         while not self.done:
             now = time.time()
             if last_log_time + 60 <= now:
                 logging.info("Realtime: %d KVs (%f per sec.), "
-                             "%d matched kvs (%f per sec.)" %
+                             "%d matched kvs (%f per sec.)%s%s" %
                              (self.kv_cnt, self.kv_cnt/(now-last_log_time),
                               self.kv_match_cnt,
-                              self.kv_match_cnt/(now-last_log_time)))
+                              self.kv_match_cnt/(now-last_log_time),
+                              "" if self.lag.lag is None else
+                                  ", lag %ds" % self.lag.lag,
+                              " (catch-up mode)" if self.lag.catchup else ""))
                 self.kv_cnt = 0
                 self.kv_match_cnt = 0
                 last_log_time = now
@@ -97,29 +146,48 @@ class Realtime(Datasource):
             msg = self.tsk_reader.poll(10000)
             if msg is None:
                 logger.debug("TSK msg: None")
+                if pending > 0:
+                    self._handoff()
                 break
             if not msg.error():
-                # wait for self.incoming to be empty
-                logger.debug("TSK msg: non-error")
-                with self.cond_producable:
-                    logger.debug("cond_producable check")
-                    while not self.producable and not self.done:
-                        logger.debug("cond_producable.wait")
-                        self.cond_producable.wait()
-                    self.incoming = []
-                    self.producable = False
-                    logger.debug("cond_producable.wait DONE")
-                if self.done: # in case consumer stopped early
-                    break
+                if pending == 0:
+                    pending_since = time.time()
+                    # wait for self.incoming to be empty
+                    logger.debug("TSK msg: non-error")
+                    with self.cond_producable:
+                        logger.debug("cond_producable check")
+                        while not self.producable and not self.done:
+                            logger.debug("cond_producable.wait")
+                            self.cond_producable.wait()
+                        self.incoming = []
+                        self.producable = False
+                        logger.debug("cond_producable.wait DONE")
+                    if self.done: # in case consumer stopped early
+                        break
                 self.tsk_reader.handle_msg(msg.value(),
                     self._msg_cb, self._kv_cb)
-                # tell computation thread that self.incoming is now full
-                with self.cond_consumable:
-                    logger.debug("cond_consumable.notify")
-                    self.consumable = True
-                    self.cond_consumable.notify()
+                pending += 1
+                if self.msg_time is not None and \
+                        self.lag.update(self.msg_time, time.time()):
+                    logger.info("Realtime: lag %ds; %s catch-up mode",
+                        self.lag.lag,
+                        "entering" if self.lag.catchup else "leaving")
+                # In catch-up mode, accumulate several messages before handing
+                # them off, to amortize the per-handoff overhead; but don't
+                # hold them longer than maxdelay.
+                if not self.lag.catchup or pending >= self.batchsize or \
+                        pending_since + self.maxdelay <= time.time():
+                    # tell computation thread that self.incoming is now full
+                    self._handoff()
+                    pending = 0
             elif msg.error().code() in KAFKA_IGNORED_ERRS:
                 logger.debug("Ignoring benign kafka 'error': %s" % msg.error().code())
+                # No more messages are immediately available (e.g. we've
+                # caught up with a partition), so don't hold the data
+                # accumulated so far.
+                if pending > 0:
+                    self._handoff()
+                    pending = 0
             else:
                 logger.error("Unhandled Kafka error, shutting down")
                 logger.error(msg.error())
@@ -127,6 +195,8 @@ class Realtime(Datasource):
                     logger.debug("cond_consumable.notify (error)")
                     self.reader_exc = RuntimeError("kafka: %s" % msg.error())
                     self.done = True
+                    # deliver any data accumulated before the error
+                    self.consumable = pending > 0
                     self.cond_consumable.notify()
                 break
         logger.debug("realtime done")
@@ -0,0 +1,259 @@
+"""Source that receives (k,v,t) tuples pushed by clients over sockets.
+
+Listens on TCP and/or Unix domain sockets, and accepts any number of
+concurrent client connections.  Each client sends a stream of records in one
+of two formats:
+
+    line: Graphite-style plaintext lines of the form "key value time\\n".
+        A value of "nan", "null", or "None" is a null value.
+    binary: length-prefixed binary records.  Each record is a 4-byte
+        big-endian length N, followed by N bytes: a big-endian int64 time, a
+        big-endian IEEE float64 value (NaN means null), and the key
+        (N - 16 bytes).
+
+Records are parsed in bulk for each buffer read from a client.  Parsed
+batches are held in a bounded queue; when it is full, reading from clients
+pauses until the pipeline catches up, so that slow processing applies
+backpressure to the clients instead of consuming unbounded memory.
+
+Configuration parameters ('*' indicates required parameter):
+    listen*: (array) Addresses to listen on, in the form "HOST:PORT" for TCP
+        or "unix:PATH" for a Unix domain socket.
+    format: (string, default "line") "line" or "binary".
+    queuesize: (integer, default 16) Maximum number of parsed batches to
+        buffer before applying backpressure.
+    maxrecord: (integer, default 65536) Maximum length (in bytes) of a line
+        or binary record.  Longer lines are skipped.  A client that sends an
+        unterminated line or a binary record longer than this (e.g. because
+        of a bogus length prefix) is disconnected, so that it can't make us
+        buffer unbounded data.
+    idletimeout: (number) If set, stop (end the stream) after this many
+        seconds with no connected clients and no data.
+    heartbeat: (number) Emit a heartbeat marker after this many seconds
+        without data.
+
+Output context variables: expression
+
+Output:  (key, value, time)
+"""
+
+import asyncio
+import logging
+import os
+import stat
+import struct
+import time
+from .. import SentryModule
+from ._Datasource import Datasource
+
+logger = logging.getLogger(__name__)
+
+add_cfg_schema = {
+    "properties": {
+        "listen": {
+            "type": "array",
+            "items": {"type": "string"},
+            "minItems": 1
+        },
+        "format":      {"enum": ["line", "binary"]},
+        "queuesize":   {"type": "integer", "exclusiveMinimum": 0},
+        "maxrecord":   {"type": "integer", "exclusiveMinimum": 0},
+        "idletimeout": {"type": "number", "exclusiveMinimum": 0},
+        "heartbeat":   {"type": "number", "exclusiveMinimum": 0},
+    },
+    "required": ["listen"]
+}
+
+READ_SIZE = 65536
+BINARY_LEN = struct.Struct('!I')
+BINARY_VT = struct.Struct('!qd')
+NULL_VALUES = (b'nan', b'null', b'None')
+
+
+def _parse_lines(lines, batch):
+    """Parse complete lines of "key value time" text into batch.  Returns the
+    number of malformed lines."""
+    bad = 0
+    append = batch.append
+    for line in lines:
+        parts = line.split()
+        if len(parts) != 3:
+            if parts:
+                bad += 1
+            continue
+        key, value, t = parts
+        try:
+            try:
+                value = int(value)
+            except ValueError:
+                value = None if value in NULL_VALUES else float(value)
+            try:
+                t = int(t)
+            except ValueError:
+                t = int(float(t))
+        except ValueError:
+            bad += 1
+            continue
+        append((key, value, t))
+    return bad
+
+
+def _parse_binary(buf, batch, maxrecord):
+    """Parse complete binary records from buf into batch.  Returns the number
+    of bytes consumed, and the length of the incomplete record that follows
+    them (0 if unknown).  Parsing stops at a record longer than maxrecord."""
+    pos = 0
+    end = len(buf)
+    append = batch.append
+    unpack_len = BINARY_LEN.unpack_from
+    unpack_vt = BINARY_VT.unpack_from
+    while pos + 4 <= end:
+        n, = unpack_len(buf, pos)
+        if pos + 4 + n > end or n > maxrecord:
+            return pos, n
+        if n < BINARY_VT.size:
+            raise ValueError("binary record too short (%d bytes)" % n)
+        t, value = unpack_vt(buf, pos + 4)
+        key = bytes(buf[pos + 4 + BINARY_VT.size : pos + 4 + n])
+        append((key, None if value != value else value, t))
+        pos += 4 + n
+    return pos, 0
+
+
+class SocketIn(Datasource):
+
+    def __init__(self, config, gen, ctx):
+        logger.debug("SocketIn.__init__")
+        super().__init__(config, logger, gen, ctx)
+        self.addresses = config['listen']
+        self.binary = config.get('format', 'line') == 'binary'
+        self.queuesize = config.get('queuesize', 16)
+        self.maxrecord = config.get('maxrecord', 65536)
+        self.idle_timeout = config.get('idletimeout', None)
+        self.queue = None
+        self.writers = set() # open client connections
+        self.last_activity = time.time()
+        ctx['expression'] = ','.join(self.addresses) # for AlertKafka
+
+    async def _handle_client(self, reader, writer):
+        peer = writer.get_extra_info('peername') or 'unix client'
+        logger.debug("SocketIn: connection from %s", peer)
+        self.writers.add(writer)
+        buf = b''
+        try:
+            while not self.done:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                self.last_activity = time.time()
+                buf += data
+                batch = []
+                if self.binary:
+                    n, pending = _parse_binary(buf, batch, self.maxrecord)
+                    buf = buf[n:]
+                else:
+                    i = buf.rfind(b'\n')
+                    if i >= 0:
+                        lines = buf[:i].split(b'\n')
+                        bad = 0
+                        if i > self.maxrecord:
+                            n = len(lines)
+                            lines = [line for line in lines
+                                if len(line) <= self.maxrecord]
+                            bad = n - len(lines)
+                        bad += _parse_lines(lines, batch)
+                        if bad:
+                            logger.warning("SocketIn: skipped %d malformed "
+                                "or too long lines from %s", bad, peer)
+                        buf = buf[i+1:]
+                    pending = len(buf)
+                if batch:
+                    # blocks (applying backpressure) if the queue is full
+                    await self.queue.put(batch)
+                if pending > self.maxrecord:
+                    raise ValueError("%s longer than maxrecord (%d bytes); "
+                        "disconnecting" % ("binary record" if self.binary
+                        else "line", self.maxrecord))
+            if buf.strip():
+                logger.warning("SocketIn: discarding %d bytes of incomplete "
+                    "data from %s", len(buf), peer)
+        except ValueError as e:
+            logger.error("SocketIn: %s: %s", peer, str(e))
+        finally:
+            self.writers.discard(writer)
+            self.last_activity = time.time()
+            writer.close()
+            logger.debug("SocketIn: closed connection from %s", peer)
+
+    # Blocking handoff of a batch to the computation thread; runs in an
+    # executor thread so the event loop can keep accepting data.
+    def _handoff(self, batch):
+        with self.cond_producable:
+            while not self.producable and not self.done:
+                self.cond_producable.wait()
+            if self.done:
+                return
+            self.incoming = batch
+            self.producable = False
+        with self.cond_consumable:
+            self.consumable = True
+            self.cond_consumable.notify()
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while not self.done:
+            try:
+                batch = await asyncio.wait_for(self.queue.get(), timeout=1)
+            except asyncio.TimeoutError:
+                if self.idle_timeout is not None and not self.writers \
+                        and self.last_activity + self.idle_timeout <= time.time():
+                    logger.info("SocketIn: idle timeout")
+                    break
+                continue
+            # merge any other queued batches into one handoff
+            while not self.queue.empty():
+                batch += self.queue.get_nowait()
+            await loop.run_in_executor(None, self._handoff, batch)
+
+    async def _serve(self):
+        self.queue = asyncio.Queue(maxsize=self.queuesize)
+        servers = []
+        for address in self.addresses:
+            if address.startswith('unix:'):
+                path = address[5:]
+                # remove a stale socket left by a previous run, but never
+                # anything else
+                try:
+                    mode = os.lstat(path).st_mode
+                except FileNotFoundError:
+                    mode = None
+                if mode is not None:
+                    if not stat.S_ISSOCK(mode):
+                        raise SentryModule.UserError("module %s: %s exists "
+                            "and is not a socket" % (self.modname, path))
+                    os.unlink(path)
+                servers.append(await asyncio.start_unix_server(
+                    self._handle_client, path=path))
+            else:
+                host, sep, port = address.rpartition(':')
+                if not sep or not port.isdigit():
+                    raise SentryModule.UserError("module %s: invalid listen "
+                        "address %r" % (self.modname, address))
+                servers.append(await asyncio.start_server(
+                    self._handle_client, host=host.strip('[]') or None,
+                    port=int(port)))
+            logger.info("SocketIn: listening on %s", address)
+        try:
+            await self._dispatch()
+        finally:
+            for server in servers:
+                server.close()
+            for writer in list(self.writers):
+                writer.close()
+            for server in servers:
+                await server.wait_closed()
+
+    def reader_body(self):
+        logger.debug("SocketIn.reader_body()")
+        asyncio.run(self._serve())
+        logger.debug("SocketIn done")
@@ -0,0 +1,180 @@
+"""Source that generates synthetic IODA-like (k,v,t) tuples.
+
+Intended for testing and load testing without external data.  Data is
+generated lazily, one timestep at a time.
+
+Configuration parameters ('*' indicates required parameter):
+    hierarchy*: (array of integers) Number of children at each level of the
+        key hierarchy.  E.g., [5, 20] generates 100 series with keys
+        "{prefix}.a0.b0.{suffix}" through "{prefix}.a4.b19.{suffix}".
+    prefix: (string, default "synthetic") First component(s) of keys.
+    suffix: (string, default "cnt") Last component(s) of keys.
+    steps*: (integer) Number of timesteps to generate.
+    starttime: (string, default '2019-01-01') Time of first timestep.
+        Format: 'YYYY-mm-dd [HH:MM[:SS]]'.
+    interval: (integer, default 600) Seconds between timesteps.
+    baseline: (array of 2 numbers, default [100, 10000]) Range from which
+        each series' baseline value is chosen at random.
+    diurnal: (number, default 0.2) Amplitude of daily cycle, as a fraction of
+        baseline.  Each series has a random phase.
+    noise: (number, default 0.05) Standard deviation of gaussian noise, as a
+        fraction of baseline.
+    outagerate: (number, default 0) Probability, per series per timestep,
+        that an outage starts.
+    outageduration: (array of 2 integers, default [1, 12]) Range of outage
+        durations, in timesteps.
+    outagedepth: (number, default 0.1) Fraction of the normal value that
+        remains during an outage.
+    shiftrate: (number, default 0) Probability, per series per timestep, of a
+        permanent level shift.
+    shiftfactor: (array of 2 numbers, default [0.5, 2]) Range of factors by
+        which a level shift multiplies the baseline.
+    outoforder: (number, default 0) Probability that a point is delayed by one
+        timestep, so it arrives after the following point for the same key.
+    late: (number, default 0) Probability that a point is delayed by
+        {latedelay} timesteps.
+    latedelay: (integer, default 6) Delay of late points, in timesteps.
+    seed: (integer, default 0) Random seed.
+
+Output context variables: expression
+
+Output:  (key, value, time)
+    value is a non-negative integer.
+"""
+
+import logging
+import math
+import random
+from .. import SentryModule
+
+logger = logging.getLogger(__name__)
+
+add_cfg_schema = {
+    "properties": {
+        "hierarchy": {
+            "type": "array",
+            "items": {"type": "integer", "exclusiveMinimum": 0},
+            "minItems": 1
+        },
+        "prefix":     {"type": "string"},
+        "suffix":     {"type": "string"},
+        "steps":      {"type": "integer", "minimum": 0},
+        "starttime":  {"type": "string"},
+        "interval":   {"type": "integer", "exclusiveMinimum": 0},
+        "baseline": {
+            "type": "array",
+            "items": {"type": "number", "minimum": 0},
+            "minItems": 2, "maxItems": 2
+        },
+        "diurnal":    {"type": "number", "minimum": 0, "maximum": 1},
+        "noise":      {"type": "number", "minimum": 0},
+        "outagerate": {"type": "number", "minimum": 0, "maximum": 1},
+        "outageduration": {
+            "type": "array",
+            "items": {"type": "integer", "exclusiveMinimum": 0},
+            "minItems": 2, "maxItems": 2
+        },
+        "outagedepth": {"type": "number", "minimum": 0, "maximum": 1},
+        "shiftrate":  {"type": "number", "minimum": 0, "maximum": 1},
+        "shiftfactor": {
+            "type": "array",
+            "items": {"type": "number", "exclusiveMinimum": 0},
+            "minItems": 2, "maxItems": 2
+        },
+        "outoforder": {"type": "number", "minimum": 0, "maximum": 1},
+        "late":       {"type": "number", "minimum": 0, "maximum": 1},
+        "latedelay":  {"type": "integer", "exclusiveMinimum": 0},
+        "seed":       {"type": "integer"},
+    },
+    "required": ["hierarchy", "steps"]
+}
+
+class Synthetic(SentryModule.Source):
+
+    def __init__(self, config, gen, ctx):
+        logger.debug("Synthetic.__init__")
+        super().__init__(config, logger, gen)
+        self.steps = config['steps']
+        self.start_time = SentryModule.strtimegm(
+            config.get('starttime', '2019-01-01'))
+        self.interval = config.get('interval', 600)
+        self.diurnal = config.get('diurnal', 0.2)
+        self.noise = config.get('noise', 0.05)
+        self.outage_rate = config.get('outagerate', 0)
+        self.outage_duration = config.get('outageduration', [1, 12])
+        self.outage_depth = config.get('outagedepth', 0.1)
+        self.shift_rate = config.get('shiftrate', 0)
+        self.shift_factor = config.get('shiftfactor', [0.5, 2])
+        self.outoforder = config.get('outoforder', 0)
+        self.late = config.get('late', 0)
+        self.late_delay = config.get('latedelay', 6)
+        self.random = random.Random(config.get('seed', 0))
+
+        prefix = config.get('prefix', 'synthetic')
+        suffix = config.get('suffix', 'cnt')
+        names = [prefix]
+        for level, fanout in enumerate(config['hierarchy']):
+            letter = chr(ord('a') + level)
+            names = ['%s.%s%d' % (name, letter, i)
+                for name in names for i in range(fanout)]
+        self.keys = [bytes('%s.%s' % (name, suffix), 'ascii')
+            for name in names]
+        lo, hi = config.get('baseline', [100, 10000])
+        self.baselines = [self.random.uniform(lo, hi) for key in self.keys]
+        self.phases = [self.random.uniform(0, 2 * math.pi)
+            for key in self.keys]
+        logger.debug("generating %d series", len(self.keys))
+        ctx['expression'] = '%s.%s.%s' % (prefix,
+            '.'.join(['*'] * len(config['hierarchy'])), suffix) # for AlertKafka
+
+    def run(self):
+        logger.debug("Synthetic.run()")
+        rand = self.random.random
+        gauss = self.random.gauss
+        randint = self.random.randint
+        uniform = self.random.uniform
+        sin = math.sin
+        keys = self.keys
+        baselines = list(self.baselines)
+        phases = self.phases
+        nkeys = len(keys)
+        outage_left = [0] * nkeys # remaining timesteps of outage, per series
+        diurnal = self.diurnal
+        noise = self.noise
+        outage_rate = self.outage_rate
+        shift_rate = self.shift_rate
+        p_ooo = self.outoforder
+        p_late = self.late
+        p_delay = p_ooo + p_late
+        omega = 2 * math.pi / 86400
+        delayed = dict() # delayed[step] = list of entries to yield at step
+
+        for step in range(self.steps):
+            t = self.start_time + step * self.interval
+            wt = omega * t
+            for i in range(nkeys):
+                value = baselines[i] * \
+                    (1 + diurnal * sin(wt + phases[i]) + noise * gauss(0, 1))
+                if outage_left[i]:
+                    outage_left[i] -= 1
+                    value *= self.outage_depth
+                elif outage_rate and rand() < outage_rate:
+                    outage_left[i] = randint(*self.outage_duration) - 1
+                    value *= self.outage_depth
+                if shift_rate and rand() < shift_rate:
+                    baselines[i] *= uniform(*self.shift_factor)
+                entry = (keys[i], max(0, int(value)), t)
+                if p_delay:
+                    r = rand()
+                    if r < p_delay:
+                        delay = 1 if r < p_ooo else self.late_delay
+                        delayed.setdefault(step + delay, []).append(entry)
+                        continue
+                yield entry
+            if step in delayed:
+                yield from delayed.pop(step)
+
+        for step in sorted(delayed):
+            yield from delayed[step]
+
+        logger.debug("Synthetic.run() done")
@@ -1,4 +1,9 @@
-"""Provides base class and common methods for threaded source modules."""
+"""Provides base class and common methods for threaded source modules.
+
+Threaded sources accept this configuration parameter:
+    heartbeat: (number) If set, emit a HEARTBEAT marker whenever this many
+        seconds pass without new data from the reader thread.
+"""
 
 import sys
 import logging
@@ -18,6 +23,7 @@ class Datasource(SentryModule.Source):
         self.producable = True
         self.consumable = False
         self.reader_exc = None
+        self.heartbeat = config.get('heartbeat', None)
         # The reader thread produces data by reading it from its source and
         # appending it to self.incoming.
         self.reader = threading.Thread(target=self.reader_thread,
@@ -57,12 +63,17 @@ class Datasource(SentryModule.Source):
             while True:
                 # wait for reader thread to fill self.incoming
                 data = None
+                idle = False
                 with self.cond_consumable:
                     logger.debug("cond_consumable check")
                     while not self.consumable and not self.done:
                         logger.debug("cond_consumable.wait")
-                        self.cond_consumable.wait()
-                    if self.consumable:
+                        if not self.cond_consumable.wait(self.heartbeat):
+                            idle = True
+                            break
+                    if idle:
+                        pass
+                    elif self.consumable:
                         data = self.incoming
                         self.incoming = None
                     elif self.reader_exc:
@@ -72,9 +83,14 @@ class Datasource(SentryModule.Source):
                     else: # if self.done:
                         logger.debug("Datasource.run: end-of-stream")
                         break
-                    self.consumable = False
-                    logger.debug("cond_consumable.wait DONE (%d items)",
-                        len(data))
+                    if not idle:
+                        self.consumable = False
+                        logger.debug("cond_consumable.wait DONE (%d items)",
+                            len(data))
+                if idle:
+                    logger.debug("Datasource.run: heartbeat")
+                    yield (None, SentryModule.HEARTBEAT, time.time())
+                    continue
                 # Tell reader thread that self.incoming is ready to be refilled
                 with self.cond_producable:
                     logger.debug("cond_producable.notify")